@@ -0,0 +1,159 @@
+#appl/availability.py
+"""
+Motore di disponibilità per /orari basato su una matrice di occupazione NumPy.
+
+Per il giorno richiesto costruisce UNA matrice booleana (operatori x minuti)
+con i minuti occupati da appuntamenti e blocchi OFF, più le fasce di turno di
+ogni operatore. Tutti gli orari di partenza candidati (passo 15 minuti) vengono
+poi valutati insieme con operazioni vettoriali: il costo non cresce più con
+(slot x operatori x servizi x appuntamenti) ma resta praticamente costante.
+
+L'assegnazione degli operatori alla catena è delegata a chain_solver, che
+applica le stesse priorità dei due pass storici di orari_disponibili (stesso
+operatore per tutta la catena, poi a cascata) in un'unica passata.
+"""
+import numpy as np
+
+from appl.chain_solver import risolvi_catene
+from appl.occupancy import minuti, minuti_su
+
+MINUTI_GIORNO = 24 * 60
+DURATA_DEFAULT = 30
+
+
+def _intervalli_uniti(turni_per_operatore):
+    """Unione (ordinata) dei turni di tutti gli operatori, come (inizio, fine) in minuti."""
+    tmp = sorted(
+        (minuti_su(s), minuti(e))
+        for turni in turni_per_operatore.values()
+        for s, e in turni
+    )
+    uniti = []
+    for s, e in tmp:
+        if uniti and s <= uniti[-1][1]:
+            uniti[-1] = (uniti[-1][0], max(uniti[-1][1], e))
+        else:
+            uniti.append((s, e))
+    return uniti
+
+
+def costruisci_occupazione(operatori, indice, giorno_minuti):
+    """
+    Matrice booleana (len(operatori), giorno_minuti): True = minuto occupato,
+    riempita dagli intervalli già fusi dell'OccupancyIndex (blocchi OFF globali inclusi).
+    """
+    occupato = np.zeros((len(operatori), giorno_minuti), dtype=bool)
+    for riga, op in enumerate(operatori):
+        for a, b in indice.intervalli_occupati(op.id):
+            occupato[riga, max(a, 0):min(b, giorno_minuti)] = True
+    return occupato
+
+
+def calcola_slot_disponibili(servizi_items, servizi, servizi_operatori, operatori,
+                             turni_per_operatore, indice, slot_step=15, capacita=None,
+                             minuti_prenotati=None):
+    """
+    Calcola gli orari di partenza prenotabili e la catena di operatori per ciascuno.
+
+    servizi_items: lista di dict {"servizio_id", "operatore_id"} nell'ordine della catena.
+    servizi: oggetti Service caricati (servizio_durata); servizi_operatori: sid -> [op_id].
+    operatori: Operator candidati, nell'ordine in cui vanno provati.
+    turni_per_operatore: op_id -> [(time inizio, time fine)].
+    indice: OccupancyIndex degli appuntamenti + blocchi OFF del giorno.
+    capacita: ResourceCapacity del giorno (servizi con max_concurrent), opzionale.
+    minuti_prenotati: op_id -> minuti già prenotati nel giorno (scelta a minor carico).
+
+    Ritorna (orari, slot_operatori): orari "HH:MM" ordinati e dict ora -> [op_id, ...].
+    """
+    if not servizi_items or not turni_per_operatore:
+        return [], {}
+
+    durate_servizi = {s.id: (s.servizio_durata or DURATA_DEFAULT) for s in servizi}
+    # Come in passato: la finestra di partenza usa la somma dei servizi distinti.
+    durata_finestra = sum(durate_servizi.values())
+
+    catena_sid = [int(item.get("servizio_id")) for item in servizi_items]
+    catena_durate = [durate_servizi.get(sid, DURATA_DEFAULT) for sid in catena_sid]
+    catena_offset = np.cumsum([0] + catena_durate[:-1])
+    durata_catena = int(sum(catena_durate))
+
+    # Orari di partenza candidati: ogni 15' dentro l'unione dei turni
+    starts = []
+    for s, e in _intervalli_uniti(turni_per_operatore):
+        starts.extend(range(s, e - durata_finestra + 1, slot_step))
+    if not starts or not operatori:
+        return [], {}
+    starts = np.array(starts, dtype=np.int64)
+
+    n_op = len(operatori)
+    giorno_minuti = MINUTI_GIORNO + durata_catena + 1
+    occupato = costruisci_occupazione(operatori, indice, giorno_minuti)
+    # Somme prefisse per riga: minuti occupati in [a, b) = cum[:, b] - cum[:, a]
+    cum = np.zeros((n_op, giorno_minuti + 1), dtype=np.int32)
+    np.cumsum(occupato, axis=1, out=cum[:, 1:])
+
+    # libero[i][p, k]: operatore p può svolgere il servizio i della catena
+    # partendo allo slot k (dentro UN suo turno e senza sovrapposizioni)
+    libero = []
+    for sid, durata, offset in zip(catena_sid, catena_durate, catena_offset):
+        a = starts + int(offset)
+        b = a + durata
+        abilitati = set(servizi_operatori.get(sid, []))
+        mask = np.zeros((n_op, len(starts)), dtype=bool)
+        for p, op in enumerate(operatori):
+            if op.id not in abilitati:
+                continue
+            in_turno = np.zeros(len(starts), dtype=bool)
+            for ts, te in turni_per_operatore.get(op.id, []):
+                in_turno |= (a >= minuti_su(ts)) & (b <= minuti(te))
+            mask[p] = in_turno & (cum[p, b] == cum[p, a])
+        # Risorsa condivisa al completo: lo slot non va bene per nessun operatore
+        if capacita is not None and capacita.vincolato(sid):
+            mask &= capacita.libera(sid, a, b)
+        libero.append(mask)
+
+    preferenze = [item.get("operatore_id") for item in servizi_items]
+    ha_preferenze = False
+    for p in preferenze:
+        try:
+            if p is not None:
+                int(p)
+                ha_preferenze = True
+        except Exception:
+            pass
+    ha_preferenze_diverse = len(set(p for p in preferenze if p is not None)) > 1
+
+    # Operatori ammessi per ogni servizio: abilitati e, se scelto, solo il preferito
+    riga_di = {op.id: p for p, op in enumerate(operatori)}
+    ammessi = []
+    for item, sid in zip(servizi_items, catena_sid):
+        abilitati = servizi_operatori.get(sid, [])
+        mask = np.zeros(n_op, dtype=bool)
+        prefer_op = item.get("operatore_id")
+        if prefer_op:
+            try:
+                prefer_op = int(prefer_op)
+            except Exception:
+                prefer_op = None
+            if prefer_op is not None and prefer_op in abilitati and prefer_op in riga_di:
+                mask[riga_di[prefer_op]] = True
+        else:
+            for op_id in abilitati:
+                if op_id in riga_di:
+                    mask[riga_di[op_id]] = True
+        ammessi.append(mask)
+
+    ordine_nome = sorted(range(n_op), key=lambda p: operatori[p].user_nome or '')
+    carico = [(minuti_prenotati or {}).get(op.id, 0) for op in operatori]
+    assegnati = risolvi_catene(
+        libero, ammessi, ordine_nome,
+        # Stesso operatore per tutta la catena: solo senza preferenze per-servizio
+        stesso_operatore=not ha_preferenze and not ha_preferenze_diverse,
+        carico=carico
+    )
+
+    orari = {}
+    for k in np.flatnonzero(assegnati[0] >= 0):
+        start = int(starts[k])
+        orari[f"{start // 60:02d}:{start % 60:02d}"] = [operatori[int(p)].id for p in assegnati[:, k]]
+    return list(orari.keys()), orari
@@ -0,0 +1,160 @@
+#appl/availability_cache.py
+"""
+Cache in memoria (per processo) dei risultati di /orari.
+
+Chiave: (tenant, data, catena servizi[] normalizzata, operatore_id). Ogni voce
+ricorda la "versione" del giorno letta dal DB al momento del calcolo
+(vedi snapshot.versione_giorno): se il gestionale scrive sullo stesso giorno la
+versione cambia e la voce non viene più servita. Le scritture fatte da qui
+(prenota / annulla) invalidano subito tutte le voci di quel giorno.
+
+Limiti: numero massimo di voci (LRU) e due soglie di età:
+- entro ttl la voce è fresca e viene servita così com'è;
+- tra ttl e max_stale viene servita ma si chiede un ricalcolo in background
+  (stale-while-revalidate), così la latenza resta piatta;
+- oltre max_stale si ricalcola in linea.
+
+SingleFlight evita che richieste identiche e contemporanee (stessa chiave e
+stessa versione del giorno) ricalcolino tutte la stessa risposta: la prima
+calcola, le altre aspettano e ricevono lo stesso risultato.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class VoceCache:
+    __slots__ = ('versione', 'creata', 'valore')
+
+    def __init__(self, versione, valore):
+        self.versione = versione
+        self.creata = time.monotonic()
+        self.valore = valore
+
+    def eta(self):
+        return time.monotonic() - self.creata
+
+
+def chiave_orari(tenant_id, data, servizi_items, operatore_id):
+    """Chiave normalizzata: l'ordine dei servizi conta (è la catena), i tipi no."""
+    catena = []
+    for item in servizi_items:
+        op = item.get("operatore_id")
+        try:
+            op = int(op) if op not in (None, "") else None
+        except (TypeError, ValueError):
+            op = str(op)
+        catena.append((int(item.get("servizio_id")), op))
+    return (str(tenant_id), data, tuple(catena), str(operatore_id) if operatore_id else None)
+
+
+class AvailabilityCache:
+    """LRU con TTL, thread-safe, con invalidazione per (tenant, data)."""
+
+    def __init__(self, max_voci=512, ttl=30, max_stale=300):
+        self.max_voci = max_voci
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._voci = OrderedDict()
+        self._in_refresh = set()
+        self._lock = threading.Lock()
+        self.trovate = 0
+        self.mancate = 0
+
+    def get(self, chiave):
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is not None:
+                self._voci.move_to_end(chiave)
+                self.trovate += 1
+            else:
+                self.mancate += 1
+            return voce
+
+    def put(self, chiave, versione, valore):
+        with self._lock:
+            self._voci[chiave] = VoceCache(versione, valore)
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.max_voci:
+                self._voci.popitem(last=False)
+
+    def invalida(self, tenant_id, data):
+        """Elimina tutte le voci del tenant per quel giorno (prenotazione/annullamento)."""
+        tenant_id = str(tenant_id)
+        with self._lock:
+            for chiave in [k for k in self._voci if k[0] == tenant_id and k[1] == data]:
+                del self._voci[chiave]
+
+    def inizia_refresh(self, chiave):
+        """True se il chiamante deve avviare il ricalcolo (uno solo per chiave)."""
+        with self._lock:
+            if chiave in self._in_refresh:
+                return False
+            self._in_refresh.add(chiave)
+            return True
+
+    def fine_refresh(self, chiave):
+        with self._lock:
+            self._in_refresh.discard(chiave)
+
+    def statistiche(self):
+        with self._lock:
+            return {"voci": len(self._voci), "trovate": self.trovate, "mancate": self.mancate}
+
+
+class _Volo:
+    __slots__ = ('evento', 'risultato', 'errore')
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.risultato = None
+        self.errore = None
+
+
+class SingleFlight:
+    """Coalescenza di calcoli identici in corso nello stesso processo."""
+
+    def __init__(self, timeout=20):
+        self.timeout = timeout
+        self._in_volo = {}
+        self._lock = threading.Lock()
+        self.calcolate = 0
+        self.coalizzate = 0
+
+    def esegui(self, chiave, calcola):
+        """
+        Esegue calcola() una sola volta per chiave tra i chiamanti concorrenti.
+        Chi arriva mentre il calcolo è in corso attende il risultato (o l'eccezione)
+        del primo; se l'attesa supera il timeout calcola da sé.
+        """
+        with self._lock:
+            volo = self._in_volo.get(chiave)
+            primo = volo is None
+            if primo:
+                volo = _Volo()
+                self._in_volo[chiave] = volo
+                self.calcolate += 1
+            else:
+                self.coalizzate += 1
+
+        if not primo:
+            if not volo.evento.wait(self.timeout):
+                return calcola()
+            if volo.errore is not None:
+                raise volo.errore
+            return volo.risultato
+
+        try:
+            volo.risultato = calcola()
+            return volo.risultato
+        except Exception as e:
+            volo.errore = e
+            raise
+        finally:
+            with self._lock:
+                self._in_volo.pop(chiave, None)
+            volo.evento.set()
+
+    def statistiche(self):
+        with self._lock:
+            return {"calcolate": self.calcolate, "coalizzate": self.coalizzate, "in_corso": len(self._in_volo)}
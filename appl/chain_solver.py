@@ -0,0 +1,94 @@
+#appl/chain_solver.py
+"""
+Assegnazione degli operatori alla catena di servizi, per tutti gli orari di
+partenza in un solo passaggio.
+
+Ingresso: per ogni servizio i della catena una matrice booleana libero[i]
+(operatori x slot) = "l'operatore p può svolgere il servizio i se la catena
+parte allo slot k" (turno + nessuna sovrapposizione, già calcolata UNA volta per
+ogni terna operatore/inizio/fine), più gli operatori ammessi per il servizio
+(abilitati e, se indicato, quello preferito dal cliente).
+
+Programmazione dinamica all'indietro su (indice servizio, slot):
+    fattibile[i][p, k] = ammesso[i][p, k] AND coda[i+1][k]
+    coda[i][k]         = OR_p fattibile[i][p, k]
+coda[0][k] dice se esiste ALMENO una catena completa partendo da k, quindi la
+ricostruzione in avanti non deve mai tornare indietro. Le priorità restano
+quelle storiche:
+1. stesso operatore per tutta la catena (se consentito);
+2. a cascata: primo servizio nell'ordine base, poi l'operatore del servizio
+   precedente e, se occupato, gli altri in ordine di nome.
+Nel pass "stesso operatore", tra più operatori idonei vince quello con meno
+minuti già prenotati nel giorno (a parità, il primo nell'ordine base): il
+carico si bilancia e, come in tutto il resto, il risultato è deterministico
+(stessa richiesta -> stessi operatori_assegnati, quindi cacheabile).
+"""
+import numpy as np
+
+
+def _prima_riga(maschera, righe):
+    """Per ogni slot, la prima riga (nell'ordine dato) con True; -1 se nessuna."""
+    if not len(righe):
+        return np.full(maschera.shape[1], -1, dtype=np.int64)
+    sub = maschera[righe]
+    primo = np.argmax(sub, axis=0)
+    return np.where(sub.any(axis=0), np.asarray(righe)[primo], -1)
+
+
+def risolvi_catene(libero, ammessi, ordine_nome, stesso_operatore=True, carico=None):
+    """
+    libero: lista (una per servizio) di array bool (n_operatori, n_slot).
+    ammessi: lista (una per servizio) di array bool (n_operatori,) con gli operatori consentiti.
+    ordine_nome: indici di riga ordinati per nome operatore (ordine della cascata).
+    stesso_operatore: prova prima un unico operatore per tutta la catena.
+    carico: minuti già prenotati per riga; ordina i candidati del pass "stesso operatore".
+
+    Ritorna un array int (n_servizi, n_slot) con la riga assegnata a ogni servizio
+    per ogni slot; -1 sulle colonne in cui non esiste nessuna catena.
+    """
+    n_servizi = len(libero)
+    n_op, n_slot = libero[0].shape
+    ammesso = [libero[i] & ammessi[i][:, None] for i in range(n_servizi)]
+
+    # DP all'indietro: il servizio i con l'operatore p allo slot k è utile solo
+    # se anche il resto della catena ha soluzione da quello slot.
+    fattibile = [None] * n_servizi
+    coda = np.ones(n_slot, dtype=bool)
+    for i in reversed(range(n_servizi)):
+        fattibile[i] = ammesso[i] & coda
+        coda = fattibile[i].any(axis=0)
+    esiste = coda
+
+    assegnati = np.full((n_servizi, n_slot), -1, dtype=np.int64)
+    risolti = np.zeros(n_slot, dtype=bool)
+
+    # 1. Stesso operatore per tutti i servizi
+    if stesso_operatore:
+        stesso = np.logical_and.reduce(ammesso)
+        if carico is None:
+            ordine_carico = np.arange(n_op)
+        else:
+            ordine_carico = np.lexsort((np.arange(n_op), np.asarray(carico)))
+        scelto = _prima_riga(stesso, ordine_carico)
+        risolti = scelto >= 0
+        assegnati[:, risolti] = scelto[risolti]
+
+    # 2. A cascata sugli slot rimasti
+    resto = esiste & ~risolti
+    if not resto.any():
+        return assegnati
+    colonne = np.flatnonzero(resto)
+    base = np.flatnonzero(ammessi[0])
+    assegnati[0, colonne] = _prima_riga(fattibile[0][:, colonne], base)
+    for i in range(1, n_servizi):
+        f = fattibile[i][:, colonne]
+        prev = assegnati[i - 1, colonne]
+        prev_ammesso = ammessi[i][prev]
+        prev_libero = f[prev, np.arange(len(colonne))]
+        per_nome = [p for p in ordine_nome if ammessi[i][p]]
+        assegnati[i, colonne] = np.where(
+            prev_ammesso,
+            np.where(prev_libero, prev, _prima_riga(f, per_nome)),
+            _prima_riga(f, np.flatnonzero(ammessi[i]))
+        )
+    return assegnati
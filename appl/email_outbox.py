@@ -0,0 +1,278 @@
+#appl/email_outbox.py
+"""
+Outbox persistente delle email (tabella email_outbox) e pool di worker che la
+svuota.
+
+Prima ogni email era un thread daemon con il suo EmailClient (e, per le notifiche
+all'admin, 65 secondi di sleep): un recycle del worker gunicorn perdeva tutto ciò
+che era in attesa. Ora:
+- accoda_email inserisce una riga (not_before = adesso + ritardo) e sveglia i worker;
+- un numero fisso di thread (EMAIL_OUTBOX_WORKERS) gira su tutti i tenant, prende
+  un lotto di righe pronte con FOR UPDATE SKIP LOCKED (due worker/processi non
+  prendono mai la stessa riga), le segna 'sending' e le spedisce fuori dalla
+  transazione;
+- l'invio vero passa dal trasporto configurato (appl/transports.py), che con
+  Azure usa un EmailClient per connection string condiviso tra i worker;
+- errore -> di nuovo 'pending' con backoff esponenziale, oltre MAX_TENTATIVI 'failed';
+- righe rimaste 'sending' (worker morto a metà) tornano disponibili dopo
+  BLOCCO_SCADUTO_SECONDI.
+Su database senza SKIP LOCKED (SQLite in locale) la presa in carico è serializzata
+da un lock di processo.
+
+Rate shaping: le righe vengono prese in ordine di priorità (codici OTP, poi
+conferme, poi notifiche admin e riepiloghi) e ogni invio consuma un gettone del
+token bucket del mittente (EMAIL_RATE_PER_MINUTE, EMAIL_RATE_BURST, per processo).
+Le classi meno urgenti lasciano sempre una riserva di gettoni ai codici OTP; se
+il gettone non arriva a breve le righe tornano in coda invece di bloccare il
+worker, e un 429 di Azure svuota il secchio per PENALITA_429_SECONDI.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, func, or_
+
+from appl.models import EmailOutbox
+from appl.rate_limit import StatisticheAttesa, TokenBucket
+from appl.transports import trasporto_email
+
+PRIORITA_OTP = 0
+PRIORITA_CONFERMA = 1
+PRIORITA_NOTIFICA = 2
+NOMI_PRIORITA = {PRIORITA_OTP: "otp", PRIORITA_CONFERMA: "conferma", PRIORITA_NOTIFICA: "notifica"}
+RISERVA_GETTONI = {PRIORITA_OTP: 0, PRIORITA_CONFERMA: 2, PRIORITA_NOTIFICA: 5}
+
+MAX_TENTATIVI = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', '6'))
+BACKOFF_BASE_SECONDI = 30     # 30s, 60s, 120s, ... fino a BACKOFF_MAX_SECONDI
+BACKOFF_MAX_SECONDI = 3600
+LOTTO = 10                    # righe prese in carico per giro
+POLL_SECONDI = float(os.environ.get('EMAIL_OUTBOX_POLL_SECONDS', '5'))
+BLOCCO_SCADUTO_SECONDI = 600
+CONSERVA_INVIATE_GIORNI = 7   # le righe 'sent' più vecchie vengono eliminate
+
+_PRESA_LOCK = threading.Lock()
+_RISVEGLIO = threading.Event()
+_ULTIMA_PULIZIA = {}          # tenant_id -> datetime
+
+RATE_PER_MINUTO = float(os.environ.get('EMAIL_RATE_PER_MINUTE', '30'))
+RATE_BURST = float(os.environ.get('EMAIL_RATE_BURST', '10'))
+ATTESA_MAX_IN_LINEA = 2.0     # oltre, la riga torna in coda e il worker passa oltre
+PENALITA_429_SECONDI = 60
+
+_BUCKETS = {}                 # mittente -> TokenBucket
+_BUCKETS_LOCK = threading.Lock()
+_ATTESE = StatisticheAttesa() # classe -> secondi tra "pronta" e inviata
+
+
+def _bucket(mittente):
+    with _BUCKETS_LOCK:
+        bucket = _BUCKETS.get(mittente)
+        if bucket is None:
+            bucket = _BUCKETS[mittente] = TokenBucket(RATE_PER_MINUTO / 60.0, RATE_BURST)
+        return bucket
+
+
+def _mittente(from_email):
+    return (from_email or os.environ.get('AZURE_EMAIL_SENDER') or "").strip().lower()
+
+
+def _attendi_gettone(bucket, priorita):
+    """Prende un gettone per la classe; None se l'attesa supera ATTESA_MAX_IN_LINEA (in secondi)."""
+    riserva = RISERVA_GETTONI.get(priorita, RISERVA_GETTONI[PRIORITA_NOTIFICA])
+    attesa = bucket.prova(riserva)
+    while 0 < attesa <= ATTESA_MAX_IN_LINEA:
+        time.sleep(attesa)
+        attesa = bucket.prova(riserva)
+    return None if attesa == 0 else attesa
+
+
+def accoda_email(session, to_email, subject, html_content, plain_text=None, from_email=None, delay_seconds=0,
+                 priorita=PRIORITA_CONFERMA):
+    """Inserisce l'email nell'outbox del tenant (commit incluso) e sveglia i worker. Ritorna l'id."""
+    riga = EmailOutbox(
+        priority=priorita,
+        to_email=to_email,
+        from_email=from_email,
+        subject=subject,
+        html_content=html_content,
+        plain_text=plain_text,
+        status='pending',
+        attempts=0,
+        not_before=datetime.now(timezone.utc) + timedelta(seconds=max(0, delay_seconds or 0)),
+    )
+    session.add(riga)
+    session.flush()
+    email_id = riga.id
+    session.commit()
+    _RISVEGLIO.set()
+    return email_id
+
+
+def backoff_secondi(tentativi):
+    return min(BACKOFF_BASE_SECONDI * (2 ** max(0, tentativi - 1)), BACKOFF_MAX_SECONDI)
+
+
+def _prendi_lotto(session, limite):
+    """Segna 'sending' fino a `limite` righe pronte e ne ritorna i dati (già committati)."""
+    adesso = datetime.now(timezone.utc)
+    query = session.query(EmailOutbox).filter(or_(
+        and_(EmailOutbox.status == 'pending', EmailOutbox.not_before <= adesso),
+        and_(EmailOutbox.status == 'sending',
+             EmailOutbox.locked_at <= adesso - timedelta(seconds=BLOCCO_SCADUTO_SECONDI)),
+    )).order_by(EmailOutbox.priority, EmailOutbox.not_before, EmailOutbox.id).limit(limite)
+
+    if session.get_bind().dialect.name == 'postgresql':
+        righe = query.with_for_update(skip_locked=True).all()
+        return _segna_in_invio(session, righe, adesso)
+    with _PRESA_LOCK:
+        return _segna_in_invio(session, query.all(), adesso)
+
+
+def _segna_in_invio(session, righe, adesso):
+    lotto = []
+    for r in righe:
+        r.status = 'sending'
+        r.locked_at = adesso
+        r.attempts = (r.attempts or 0) + 1
+        lotto.append({
+            "id": r.id, "attempts": r.attempts, "priority": r.priority,
+            "pronta": max(_utc(r.created_at), _utc(r.not_before)),
+            "to_email": r.to_email, "from_email": r.from_email,
+            "subject": r.subject, "html_content": r.html_content, "plain_text": r.plain_text,
+        })
+    session.commit()
+    return lotto
+
+
+def _utc(dt):
+    if dt is None:
+        return datetime.now(timezone.utc)
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def _rimetti_in_coda(session, email_ids, attesa):
+    """Righe prese ma non spedite per mancanza di gettoni: di nuovo 'pending', tentativo non contato."""
+    session.query(EmailOutbox).filter(EmailOutbox.id.in_(email_ids)).update({
+        "status": 'pending',
+        "locked_at": None,
+        "attempts": EmailOutbox.attempts - 1,
+        "not_before": datetime.now(timezone.utc) + timedelta(seconds=attesa),
+    }, synchronize_session=False)
+    session.commit()
+
+
+def elabora_outbox(session, tenant_id, invia=None, limite=LOTTO):
+    """Un giro del worker su un tenant: prende un lotto, spedisce, registra l'esito. Ritorna quante."""
+    invia = invia or trasporto_email().invia_email
+    lotto = _prendi_lotto(session, limite)
+    for pos, email in enumerate(lotto):
+        bucket = _bucket(_mittente(email["from_email"]))
+        attesa = _attendi_gettone(bucket, email["priority"])
+        if attesa is not None:
+            # il lotto è in ordine di priorità: anche le righe seguenti aspetterebbero
+            _rimetti_in_coda(session, [e["id"] for e in lotto[pos:]], attesa)
+            return pos
+        try:
+            invia(email["to_email"], email["subject"], email["html_content"],
+                  plain_text=email["plain_text"], from_email=email["from_email"])
+            adesso = datetime.now(timezone.utc)
+            esito = {"status": 'sent', "sent_at": adesso, "last_error": None}
+            _ATTESE.registra(NOMI_PRIORITA.get(email["priority"], str(email["priority"])),
+                             max(0.0, (adesso - email["pronta"]).total_seconds()))
+            print(f"[EMAIL-OUTBOX][{tenant_id}] SENT id={email['id']} to={email['to_email']}")
+        except Exception as e:
+            errore = f"{type(e).__name__}: {e}"[:2000]
+            if getattr(e, 'status_code', None) == 429:
+                bucket.penalizza(PENALITA_429_SECONDI)
+            if email["attempts"] >= MAX_TENTATIVI:
+                esito = {"status": 'failed', "last_error": errore}
+                print(f"[EMAIL-OUTBOX][{tenant_id}] FAILED id={email['id']} to={email['to_email']} "
+                      f"dopo {email['attempts']} tentativi: {errore}")
+            else:
+                attesa = backoff_secondi(email["attempts"])
+                esito = {
+                    "status": 'pending',
+                    "not_before": datetime.now(timezone.utc) + timedelta(seconds=attesa),
+                    "last_error": errore,
+                }
+                print(f"[EMAIL-OUTBOX][{tenant_id}] RETRY id={email['id']} tra {attesa}s "
+                      f"(tentativo {email['attempts']}): {errore}")
+        esito["locked_at"] = None
+        session.query(EmailOutbox).filter(EmailOutbox.id == email["id"]).update(esito, synchronize_session=False)
+        session.commit()
+    return len(lotto)
+
+
+def statistiche_outbox(session):
+    """Profondità della coda per classe (dal DB del tenant), attese di processo e gettoni."""
+    adesso = datetime.now(timezone.utc)
+    coda = {}
+    righe = session.query(
+        EmailOutbox.priority, EmailOutbox.status, func.count(EmailOutbox.id), func.min(EmailOutbox.not_before)
+    ).filter(EmailOutbox.status.in_(('pending', 'sending', 'failed'))).group_by(
+        EmailOutbox.priority, EmailOutbox.status
+    ).all()
+    for priorita, status, n, prima in righe:
+        voce = coda.setdefault(NOMI_PRIORITA.get(priorita, str(priorita)), {})
+        voce[status] = n
+        if status == 'pending':
+            voce["attesa_piu_vecchia_s"] = max(0, round((adesso - _utc(prima)).total_seconds()))
+    with _BUCKETS_LOCK:
+        buckets = dict(_BUCKETS)
+    return {
+        "coda": coda,
+        "attese_invio": _ATTESE.riepilogo(),
+        "gettoni": {mittente: b.gettoni() for mittente, b in buckets.items()},
+        "rate_per_minuto": RATE_PER_MINUTO,
+    }
+
+
+def _pulisci_inviate(session, tenant_id):
+    """Al più una volta l'ora per tenant: elimina in blocco le righe 'sent' vecchie."""
+    adesso = datetime.now(timezone.utc)
+    ultima = _ULTIMA_PULIZIA.get(tenant_id)
+    if ultima is not None and adesso - ultima < timedelta(hours=1):
+        return
+    _ULTIMA_PULIZIA[tenant_id] = adesso
+    session.query(EmailOutbox).filter(
+        EmailOutbox.status == 'sent',
+        EmailOutbox.created_at < adesso - timedelta(days=CONSERVA_INVIATE_GIORNI)
+    ).delete(synchronize_session=False)
+    session.commit()
+
+
+def _ciclo_worker(app, nome):
+    while True:
+        lavorate = 0
+        try:
+            with app.app_context():
+                for tenant_id, SessionFactory in list(app.config.get('DB_SESSIONS', {}).items()):
+                    session = SessionFactory()
+                    try:
+                        lavorate += elabora_outbox(session, tenant_id)
+                        _pulisci_inviate(session, tenant_id)
+                    except Exception as e:
+                        session.rollback()
+                        print(f"[EMAIL-OUTBOX][{tenant_id}] {nome} errore: {repr(e)}")
+                    finally:
+                        try:
+                            session.close()
+                        finally:
+                            try:
+                                SessionFactory.remove()
+                            except Exception:
+                                pass
+        except Exception as e:
+            print(f"[EMAIL-OUTBOX] {nome} loop error: {repr(e)}")
+        if not lavorate:
+            # niente da fare: aspetta una nuova email accodata o il prossimo poll
+            _RISVEGLIO.wait(POLL_SECONDI)
+            _RISVEGLIO.clear()
+
+
+def avvia_worker_outbox(app, n_worker):
+    """Avvia il pool fisso di worker dell'outbox (thread daemon)."""
+    for i in range(max(1, n_worker)):
+        nome = f"email_outbox_{i}"
+        threading.Thread(target=_ciclo_worker, args=(app, nome), name=nome, daemon=True).start()
@@ -0,0 +1,55 @@
+#appl/email_templates.py
+"""
+Registro dei template email (templates/email/<nome>.html e <nome>.txt).
+
+Ogni template viene letto e compilato da Jinja UNA volta per processo, al primo
+utilizzo, e poi riusato: niente render_template_string su grandi stringhe HTML
+a ogni prenotazione. La versione testo ha il suo template .txt compilato insieme
+all'HTML, quindi all'invio non serve più convertire l'HTML in testo con le regex.
+L'HTML ha l'autoescape attivo, il testo no.
+"""
+import os
+import threading
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined, select_autoescape
+
+TEMPLATE_EMAIL = (
+    'conferma_prenotazione',   # al cliente, dopo /prenota
+    'admin_prenotazione',      # all'admin, dopo /prenota
+    'admin_annullamento',      # all'admin, annullamento dal link in email
+    'admin_digest',            # all'admin, notifiche raggruppate (BusinessInfo.admin_digest_enabled)
+    'codice_conferma',         # codice OTP di /invia-codice
+    'riepilogo_errori',        # riepilogo orario BookingErrorLog
+    'riepilogo_errori_crm',    # riepilogo giornaliero CrmErrorLog
+)
+
+_CARTELLA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates', 'email')
+
+_ENV = Environment(
+    loader=FileSystemLoader(_CARTELLA),
+    autoescape=select_autoescape(enabled_extensions=('html',), default_for_string=False),
+    undefined=StrictUndefined,
+    trim_blocks=True,
+    lstrip_blocks=True,
+    auto_reload=False,
+)
+
+_COMPILATI = {}
+_LOCK = threading.Lock()
+
+
+def _compilati():
+    if not _COMPILATI:
+        with _LOCK:
+            if not _COMPILATI:
+                _COMPILATI.update({
+                    nome: (_ENV.get_template(f"{nome}.html"), _ENV.get_template(f"{nome}.txt"))
+                    for nome in TEMPLATE_EMAIL
+                })
+    return _COMPILATI
+
+
+def render_email(template, **contesto):
+    """Ritorna (html, testo) del template indicato con lo stesso contesto."""
+    html, testo = _compilati()[template]
+    return html.render(**contesto), testo.render(**contesto).strip() + "\n"
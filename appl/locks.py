@@ -0,0 +1,65 @@
+#appl/locks.py
+"""
+Lock per (operatore, giorno) usati da /prenota per serializzare SOLO le
+prenotazioni che possono scontrarsi: due clienti sullo stesso operatore e
+lo stesso giorno si mettono in fila, tutto il resto procede in parallelo.
+
+Su PostgreSQL si usa pg_advisory_xact_lock: il lock vale per la transazione
+corrente e viene rilasciato da solo al commit/rollback, quindi vale anche tra
+processi/istanze diverse. Su altri database (es. SQLite in locale) si ricade
+su un threading.Lock per processo, rilasciato all'uscita del blocco with.
+I lock vengono presi sempre in ordine crescente per evitare deadlock.
+"""
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+# Spazio delle chiavi riservato alle prenotazioni: bit alti fissi, poi
+# operator_id (32 bit) e giorno (20 bit, giorni dal 01/01/2000 circa).
+_NAMESPACE = 0x42
+_BASE_ORDINALE = 730000
+
+_LOCK_LOCALI = {}
+_LOCK_LOCALI_GUARD = threading.Lock()
+
+
+def chiave_lock(operator_id, data):
+    """Chiave bigint di pg_advisory_xact_lock per (operatore, giorno)."""
+    giorno = (data.toordinal() - _BASE_ORDINALE) & 0xFFFFF
+    return (_NAMESPACE << 52) | ((int(operator_id) & 0xFFFFFFFF) << 20) | giorno
+
+
+def _lock_locale(tenant_id, operator_id, data):
+    chiave = (str(tenant_id), int(operator_id), data)
+    with _LOCK_LOCALI_GUARD:
+        lock = _LOCK_LOCALI.get(chiave)
+        if lock is None:
+            lock = _LOCK_LOCALI[chiave] = threading.Lock()
+        return lock
+
+
+@contextmanager
+def lock_operatori_giorno(session, tenant_id, operatori_ids, data):
+    """
+    Blocca (operatore, giorno) per tutti gli operatori indicati fino alla fine
+    della transazione (PostgreSQL) o del blocco with (fallback locale).
+    Il commit va fatto DENTRO il blocco.
+    """
+    operatori = sorted({int(op_id) for op_id in operatori_ids})
+    if session.get_bind().dialect.name == 'postgresql':
+        for op_id in operatori:
+            session.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": chiave_lock(op_id, data)})
+        yield
+        return
+
+    presi = []
+    try:
+        for op_id in operatori:
+            lock = _lock_locale(tenant_id, op_id, data)
+            lock.acquire()
+            presi.append(lock)
+        yield
+    finally:
+        for lock in reversed(presi):
+            lock.release()
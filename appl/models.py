@@ -351,6 +351,21 @@ class BusinessInfo(db.Model):
     crm_error_summary_time = db.Column(db.Time, nullable=False, default=datetime.strptime("21:00", "%H:%M").time())
     crm_error_summary_last_sent_date = db.Column(db.Date, nullable=True)
 
+    # Digest delle notifiche admin del booking online (routes/booking.py:
+    # process_admin_digest_tick). Se attivo, le email "nuova prenotazione" e
+    # "annullamento" non partono una per una: restano in admin_notification_buffer
+    # e ogni admin_digest_minutes minuti (dalla prima in attesa) ne parte una sola
+    # con tutto il riepilogo.
+    admin_digest_enabled = db.Column(db.Boolean, nullable=False, default=False)
+    admin_digest_minutes = db.Column(db.Integer, nullable=False, default=5)
+
+    # Ritmo degli invii WhatsApp automatici (memo mattutino, turni operatori) per
+    # l'account Unipile del negozio: messaggi al minuto (token bucket con piccole
+    # pause casuali tra un invio e l'altro) e tetto massimo di messaggi al giorno.
+    # Limiti prudenti contro i blocchi anti-spam di WhatsApp.
+    whatsapp_rate_per_minute = db.Column(db.Integer, nullable=False, default=10)
+    whatsapp_daily_cap = db.Column(db.Integer, nullable=False, default=500)
+
     @property
     def closing_days_list(self):
         """Ritorna una lista di stringhe (es. ["Domenica","Sabato"]) se presente, altrimenti vuota."""
@@ -775,4 +790,117 @@ class CrmErrorLog(db.Model):
 
     reason = db.Column(db.String(255), nullable=False)
     client_id = db.Column(db.Integer, db.ForeignKey('clienti.id'), nullable=True)
-    context = db.Column(db.JSON, nullable=True)  # dettagli extra (appuntamento, errCode RCH, endpoint, eccezione, ecc.)
\ No newline at end of file
+    context = db.Column(db.JSON, nullable=True)  # dettagli extra (appuntamento, errCode RCH, endpoint, eccezione, ecc.)
+
+class BookingIdempotencyKey(db.Model):
+    """Chiavi di idempotenza di /prenota (header Idempotency-Key o campo idempotency_key).
+    Una richiesta ripetuta con la stessa chiave riceve la risposta salvata, senza
+    rifare validazione e INSERT: niente prenotazioni doppie sui retry da mobile.
+    La riga viene scritta nella STESSA transazione degli appuntamenti e scade
+    dopo expires_at (le righe scadute vengono ripulite alle scritture successive)."""
+    __tablename__ = 'booking_idempotency_keys'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    key = db.Column(db.String(128), nullable=False, unique=True)
+    request_hash = db.Column(db.String(64), nullable=False)  # sha256 del payload: stessa chiave, richiesta diversa -> rifiuto
+    booking_session_id = db.Column(db.String(64), nullable=True)
+    status_code = db.Column(db.Integer, nullable=False, default=200)
+    response = db.Column(db.JSON, nullable=False)
+
+class SlotHold(db.Model):
+    """Blocco temporaneo (hold) di uno slot scelto dal cliente sul booking online,
+    tenuto tra la selezione dell'orario e /prenota (che intanto passa dall'email
+    con il codice di conferma). Una riga per servizio della catena; finché non
+    scade l'operatore risulta occupato per tutti gli altri clienti, e /prenota
+    trasforma l'hold in appuntamenti. Le righe scadute vengono eliminate in blocco."""
+    __tablename__ = 'slot_holds'
+    __table_args__ = (
+        db.Index('ix_slot_holds_data_expires_at', 'data', 'expires_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+    token = db.Column(db.String(64), nullable=False, index=True)  # uno per sessione browser
+    data = db.Column(db.Date, nullable=False)
+    operator_id = db.Column(db.Integer, nullable=False)
+    service_id = db.Column(db.Integer, nullable=False)
+    start_time = db.Column(db.DateTime, nullable=False)  # ora locale, come Appointment.start_time
+    duration = db.Column(db.Integer, nullable=False)
+
+class EmailOutbox(db.Model):
+    """Coda persistente delle email in uscita (conferme, codici, annullamenti,
+    riepiloghi errori). Chi invia inserisce solo una riga; la spedizione la fa il
+    pool di worker (appl/email_outbox.py) che si prende le righe pronte con
+    FOR UPDATE SKIP LOCKED, quindi un riavvio del processo non perde le email.
+    not_before sostituisce i thread che dormivano prima dell'invio; gli errori
+    vengono ritentati con backoff esponenziale fino a status 'failed'.
+    priority: 0 codici OTP, 1 conferme al cliente, 2 notifiche admin e riepiloghi
+    (vengono presi in carico in quest'ordine)."""
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_priority_not_before', 'status', 'priority', 'not_before'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    not_before = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending / sending / sent / failed
+    priority = db.Column(db.Integer, nullable=False, default=1)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    locked_at = db.Column(db.DateTime(timezone=True), nullable=True)  # presa in carico da un worker
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    to_email = db.Column(db.String(255), nullable=False)
+    from_email = db.Column(db.String(255), nullable=True)
+    subject = db.Column(db.String(500), nullable=False)
+    html_content = db.Column(db.Text, nullable=False)
+    plain_text = db.Column(db.Text, nullable=True)
+
+class AdminNotificationBuffer(db.Model):
+    """Notifiche admin (nuova prenotazione / annullamento) in attesa del digest
+    (BusinessInfo.admin_digest_enabled). Sta su DB e non in memoria, così un
+    riavvio non le perde; il flusher in background le raccoglie in una sola
+    email e le elimina nella stessa transazione in cui accoda l'email."""
+    __tablename__ = 'admin_notification_buffer'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'prenotazione' / 'annullamento'
+    payload = db.Column(db.JSON, nullable=False)     # contesto del template (cliente, appuntamenti, totali)
+
+class WaOutbox(db.Model):
+    """Coda persistente dei messaggi WhatsApp automatici (memo mattutino ai clienti,
+    turni di domani agli operatori). Il tick inserisce i messaggi GIÀ renderizzati;
+    dedupe_key (es. 'morning:2025-03-01:1234') è unica, quindi un secondo worker o un
+    riavvio che ricostruisce la coda non crea doppioni. Chi invia si prende le righe
+    con FOR UPDATE SKIP LOCKED: status, attempts e sent_at sostituiscono lo stato in
+    memoria (idx / last_sent_minute) dei vecchi _MORNING_STATE e _OP_STATE_MAP."""
+    __tablename__ = 'wa_outbox'
+    __table_args__ = (
+        db.Index('ix_wa_outbox_kind_status_not_before', 'kind', 'status', 'not_before'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+    not_before = db.Column(db.DateTime(timezone=True), nullable=False)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=True)  # oltre non ha più senso inviarlo (memo di ieri)
+
+    kind = db.Column(db.String(20), nullable=False)               # 'morning' / 'operator'
+    dedupe_key = db.Column(db.String(128), nullable=False, unique=True)
+    ref_id = db.Column(db.Integer, nullable=True)                 # appointment_id (morning) / operator_id (operator)
+
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending / sending / sent / failed / expired
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    locked_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    to_phone = db.Column(db.String(64), nullable=False)
+    text = db.Column(db.Text, nullable=False)
@@ -0,0 +1,121 @@
+#appl/occupancy.py
+"""
+Indice di occupazione giornaliero condiviso da tutti i controlli di disponibilità.
+
+Gli appuntamenti del giorno vengono trasformati UNA volta in intervalli occupati
+(minuti dalla mezzanotte), ordinati e fusi per operatore, più l'elenco dei blocchi
+OFF globali (senza operatore). La domanda "l'operatore X è libero in [a, b)?"
+costa poi O(log n) con bisect, senza rifare ogni volta to_naive/timedelta su
+tutti gli appuntamenti.
+"""
+from bisect import bisect_left
+
+
+def minuti(t):
+    """Minuti dalla mezzanotte di un time/datetime (ora "da parete", tzinfo ignorato)."""
+    return t.hour * 60 + t.minute
+
+
+def minuti_su(t):
+    """Come minuti(), ma arrotonda per eccesso eventuali secondi: un turno che inizia
+    alle 09:00:30 non copre uno slot delle 09:00."""
+    m = minuti(t)
+    if t.second or t.microsecond:
+        m += 1
+    return m
+
+
+def _chiave(operator_id):
+    try:
+        return int(operator_id)
+    except (TypeError, ValueError):
+        return operator_id
+
+
+def _fondi(intervalli):
+    """Ordina e fonde intervalli (inizio, fine) sovrapposti o adiacenti."""
+    fusi = []
+    for s, e in sorted(intervalli):
+        if fusi and s <= fusi[-1][1]:
+            if e > fusi[-1][1]:
+                fusi[-1][1] = e
+        else:
+            fusi.append([s, e])
+    return [s for s, _ in fusi], [e for _, e in fusi]
+
+
+def _sovrappone(inizi, fini, a, b):
+    # Intervalli disgiunti e ordinati: tra quelli che iniziano prima di b,
+    # l'ultimo è anche quello che finisce più tardi.
+    j = bisect_left(inizi, b)
+    return j > 0 and fini[j - 1] > a
+
+
+class OccupancyIndex:
+    """Intervalli occupati del giorno, per operatore e globali (blocchi OFF)."""
+
+    def __init__(self, occupati_per_operatore=None, off_globali=None):
+        self._operatori = {
+            _chiave(op_id): _fondi(intervalli)
+            for op_id, intervalli in (occupati_per_operatore or {}).items()
+        }
+        self._off_globali = _fondi(off_globali or [])
+
+    @classmethod
+    def from_appuntamenti(cls, appuntamenti, salta_annullati=False):
+        """
+        Costruisce l'indice da oggetti Appointment (start_time, _duration, operator_id, note).
+        - appuntamento con operatore (OFF o no): occupa quell'operatore
+        - blocco OFF senza operatore: occupa tutti
+        salta_annullati: ignora anche i blocchi annullati dal cliente (is_calendar_closed).
+        """
+        return cls._da_righe(
+            (a.operator_id, a.start_time, a._duration, bool(a.note and "OFF" in a.note))
+            for a in appuntamenti
+            if not (salta_annullati and getattr(a, 'is_cancelled_by_client', False))
+        )
+
+    @classmethod
+    def from_records(cls, records):
+        """Come from_appuntamenti, da record proiettati (duration, is_off) del DaySnapshot."""
+        return cls._da_righe((r.operator_id, r.start_time, r.duration, r.is_off) for r in records)
+
+    @classmethod
+    def _da_righe(cls, righe):
+        per_operatore = {}
+        off_globali = []
+        for operator_id, start_time, durata, is_off in righe:
+            if start_time is None:
+                continue
+            inizio = minuti(start_time)
+            intervallo = (inizio, inizio + int(durata or 0))
+            if operator_id is None:
+                if is_off:
+                    off_globali.append(intervallo)
+                continue
+            per_operatore.setdefault(operator_id, []).append(intervallo)
+        return cls(per_operatore, off_globali)
+
+    def off_globale(self, inizio, fine):
+        """True se [inizio, fine) tocca un blocco OFF globale."""
+        return _sovrappone(*self._off_globali, inizio, fine)
+
+    def occupato(self, operator_id, inizio, fine):
+        """True se l'operatore ha un appuntamento/blocco proprio in [inizio, fine)."""
+        intervalli = self._operatori.get(_chiave(operator_id))
+        return intervalli is not None and _sovrappone(*intervalli, inizio, fine)
+
+    def libero(self, operator_id, inizio, fine):
+        """True se l'operatore è libero in [inizio, fine) (minuti dalla mezzanotte)."""
+        return not self.off_globale(inizio, fine) and not self.occupato(operator_id, inizio, fine)
+
+    def intervalli_occupati(self, operator_id):
+        """Intervalli occupati dell'operatore, blocchi OFF globali inclusi (ordinati, fusi)."""
+        propri = self._operatori.get(_chiave(operator_id), ([], []))
+        inizi, fini = _fondi(list(zip(*propri)) + list(zip(*self._off_globali)))
+        return list(zip(inizi, fini))
+
+
+def in_turno(turni, inizio, fine):
+    """True se [inizio, fine) (minuti) sta dentro UNO dei turni (time inizio, time fine)."""
+    return any(minuti_su(s) <= inizio and fine <= minuti(e) for s, e in turni)
@@ -0,0 +1,87 @@
+#appl/rate_limit.py
+"""
+Token bucket (per processo) per dosare gli invii verso provider esterni con
+limiti di frequenza.
+
+Il secchio si riempie di `rate` gettoni al secondo fino a `burst`; ogni invio
+ne consuma uno. `riserva` permette le classi di priorità: una richiesta a bassa
+priorità passa solo se dopo l'invio restano almeno `riserva` gettoni, così
+l'ultima capacità disponibile resta a chi ha priorità più alta (riserva 0).
+`penalizza` svuota il secchio per un certo tempo dopo un 429 del provider.
+"""
+import threading
+import time
+from collections import deque
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)          # gettoni al secondo
+        self.burst = float(burst)
+        self._gettoni = float(burst)
+        self._aggiornato = time.monotonic()
+        self._bloccato_fino = 0.0
+        self._lock = threading.Lock()
+
+    def _ricarica(self, adesso):
+        self._gettoni = min(self.burst, self._gettoni + (adesso - self._aggiornato) * self.rate)
+        self._aggiornato = adesso
+
+    def prova(self, riserva=0):
+        """Prende un gettone se disponibile (lasciandone almeno `riserva`): ritorna 0,
+        altrimenti i secondi da attendere prima di riprovare (senza prendere nulla)."""
+        with self._lock:
+            adesso = time.monotonic()
+            if adesso < self._bloccato_fino:
+                return self._bloccato_fino - adesso
+            self._ricarica(adesso)
+            necessari = 1 + min(riserva, max(0.0, self.burst - 1))
+            if self._gettoni >= necessari:
+                self._gettoni -= 1
+                return 0.0
+            return (necessari - self._gettoni) / self.rate
+
+    def restituisci(self):
+        """Rende un gettone preso con prova() ma poi non usato (niente da inviare)."""
+        with self._lock:
+            self._gettoni = min(self.burst, self._gettoni + 1)
+
+    def penalizza(self, secondi):
+        """Dopo un rifiuto per troppe richieste: nessun gettone per `secondi`."""
+        with self._lock:
+            self._gettoni = 0.0
+            self._aggiornato = time.monotonic()
+            self._bloccato_fino = max(self._bloccato_fino, self._aggiornato + secondi)
+
+    def gettoni(self):
+        with self._lock:
+            self._ricarica(time.monotonic())
+            return round(self._gettoni, 2)
+
+
+class StatisticheAttesa:
+    """Conteggio e attese (secondi) degli ultimi N eventi per classe, thread-safe."""
+
+    def __init__(self, ultimi=500):
+        self._ultimi = ultimi
+        self._attese = {}
+        self._totali = {}
+        self._lock = threading.Lock()
+
+    def registra(self, classe, attesa):
+        with self._lock:
+            self._attese.setdefault(classe, deque(maxlen=self._ultimi)).append(float(attesa))
+            self._totali[classe] = self._totali.get(classe, 0) + 1
+
+    def riepilogo(self):
+        with self._lock:
+            out = {}
+            for classe, attese in self._attese.items():
+                ordinate = sorted(attese)
+                out[classe] = {
+                    "totale": self._totali[classe],
+                    "media_s": round(sum(ordinate) / len(ordinate), 2),
+                    "p95_s": round(ordinate[min(len(ordinate) - 1, int(len(ordinate) * 0.95))], 2),
+                    "max_s": round(ordinate[-1], 2),
+                }
+            return out
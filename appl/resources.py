@@ -0,0 +1,110 @@
+#appl/resources.py
+"""
+Capacità delle risorse condivise (Service.max_concurrent / Service.resource_name).
+
+Un servizio con max_concurrent = N può avere al massimo N appuntamenti
+contemporanei; i servizi con lo stesso resource_name condividono la risorsa
+(es. un solo macchinario usato da più trattamenti). Per ogni risorsa si
+costruisce una volta il numero di appuntamenti in corso minuto per minuto con un
+array delle differenze (+1 all'inizio, -1 alla fine) e una somma cumulativa; poi
+la somma prefissa dei minuti "saturi" (in corso >= N) rende ogni controllo
+"[a, b) è libero?" O(1), anche in forma vettoriale per tutti gli slot insieme.
+"""
+import numpy as np
+
+from appl.occupancy import minuti
+
+MINUTI_GIORNO = 24 * 60
+
+
+def chiave_risorsa(servizio_id, resource_name):
+    """Servizi con lo stesso resource_name condividono la risorsa; senza nome ogni servizio è a sé."""
+    nome = (resource_name or '').strip().lower()
+    return nome if nome else f"servizio:{servizio_id}"
+
+
+class ResourceCapacity:
+    """Occupazione per risorsa del giorno e controlli di capacità O(1)."""
+
+    def __init__(self, vincoli, appuntamenti, giorno_minuti=2 * MINUTI_GIORNO):
+        """
+        vincoli: servizio_id -> (resource_name o None, max_concurrent, nome servizio)
+                 solo per i servizi con max_concurrent > 0.
+        appuntamenti: record con service_id, start_time, duration, is_off (DaySnapshot).
+        """
+        self._giorno_minuti = giorno_minuti
+        self._risorsa_di = {}
+        self._capacita = {}
+        self._nomi = {}
+        for sid, (resource_name, max_concurrent, servizio_nome) in vincoli.items():
+            chiave = chiave_risorsa(sid, resource_name)
+            self._risorsa_di[sid] = chiave
+            self._capacita[sid] = int(max_concurrent)
+            self._nomi.setdefault(chiave, (resource_name or '').strip() or servizio_nome or chiave)
+
+        # Array delle differenze per risorsa, poi conteggio minuto per minuto
+        diff = {}
+        for app in appuntamenti:
+            chiave = self._risorsa_di.get(app.service_id)
+            if chiave is None or app.is_off or app.start_time is None:
+                continue
+            a = min(max(minuti(app.start_time), 0), giorno_minuti)
+            b = min(a + int(app.duration or 0), giorno_minuti)
+            if b <= a:
+                continue
+            d = diff.get(chiave)
+            if d is None:
+                d = diff[chiave] = np.zeros(giorno_minuti + 1, dtype=np.int32)
+            d[a] += 1
+            d[b] -= 1
+        self._in_corso = {chiave: np.cumsum(d[:-1]) for chiave, d in diff.items()}
+        self._saturi = {}
+
+    def vincolato(self, servizio_id):
+        return servizio_id in self._capacita
+
+    def nome_risorsa(self, servizio_id):
+        chiave = self._risorsa_di.get(servizio_id)
+        return self._nomi.get(chiave) if chiave else None
+
+    def _saturazione(self, servizio_id):
+        """Somma prefissa dei minuti in cui la risorsa del servizio è già al completo."""
+        chiave = self._risorsa_di[servizio_id]
+        capacita = self._capacita[servizio_id]
+        cum = self._saturi.get((chiave, capacita))
+        if cum is None:
+            cum = np.zeros(self._giorno_minuti + 1, dtype=np.int32)
+            in_corso = self._in_corso.get(chiave)
+            if in_corso is not None:
+                np.cumsum(in_corso >= capacita, out=cum[1:])
+            self._saturi[(chiave, capacita)] = cum
+        return cum
+
+    def libera(self, servizio_id, inizio, fine):
+        """True se la risorsa del servizio ha posto in tutto [inizio, fine) (minuti, scalari o array)."""
+        if servizio_id not in self._capacita:
+            return True if np.isscalar(inizio) else np.ones(np.shape(inizio), dtype=bool)
+        cum = self._saturazione(servizio_id)
+        a = np.clip(inizio, 0, self._giorno_minuti)
+        b = np.clip(fine, 0, self._giorno_minuti)
+        return cum[b] == cum[a]
+
+    def risorsa_satura(self, servizio_id, inizio, fine):
+        """Nome della risorsa al completo in [inizio, fine), oppure None se c'è posto."""
+        if self.libera(servizio_id, inizio, fine):
+            return None
+        return self.nome_risorsa(servizio_id)
+
+    def fasce_sature(self, servizio_id):
+        """Fasce "HH:MM-HH:MM" del giorno in cui la risorsa del servizio è al completo."""
+        if servizio_id not in self._capacita:
+            return []
+        in_corso = self._in_corso.get(self._risorsa_di[servizio_id])
+        if in_corso is None:
+            return []
+        saturo = np.concatenate(([False], in_corso[:MINUTI_GIORNO] >= self._capacita[servizio_id], [False]))
+        bordi = np.flatnonzero(saturo[1:] != saturo[:-1])
+        return [
+            f"{a // 60:02d}:{a % 60:02d}-{b // 60:02d}:{b % 60:02d}"
+            for a, b in zip(bordi[::2], bordi[1::2])
+        ]
@@ -0,0 +1,272 @@
+#appl/snapshot.py
+"""
+Caricamento "leggero" dei dati di disponibilità di un giorno (DaySnapshot).
+
+Al posto di due query ORM complete su Appointment (attivi + blocchi OFF, poi fuse
+con un confronto O(n²) tra entità) si esegue UNA sola query che proietta solo le
+colonne che servono al calcolo (operatore, inizio, durata, flag OFF, servizio).
+Ogni riga compare una volta sola perché il filtro unisce le due condizioni in SQL.
+Turni, operatori visibili e abilitazioni servizio->operatore vengono caricati
+nella stessa chiamata, anch'essi proiettati su tuple compatte.
+load_range fa lo stesso per un intervallo di giorni senza moltiplicare le query.
+Gli hold attivi (SlotHold, slot scelti da altri clienti e non ancora prenotati)
+entrano tra gli appuntamenti come occupazioni normali finché non scadono.
+"""
+from datetime import datetime, time, timedelta, timezone
+
+from sqlalchemy import case, func, or_, select, true
+
+from appl.models import Appointment, Operator, OperatorShift, Service, SlotHold, service_operator
+from appl.occupancy import OccupancyIndex
+from appl.resources import ResourceCapacity
+
+
+class AppuntamentoSnapshot:
+    """Appuntamento/blocco ridotto ai campi usati dal motore di disponibilità."""
+    __slots__ = ('id', 'operator_id', 'start_time', 'duration', 'is_off', 'service_id')
+
+    def __init__(self, id, operator_id, start_time, duration, is_off, service_id):
+        self.id = id
+        self.operator_id = operator_id
+        self.start_time = start_time
+        self.duration = duration
+        self.is_off = bool(is_off)
+        self.service_id = service_id
+
+
+class OperatoreSnapshot:
+    __slots__ = ('id', 'user_nome')
+
+    def __init__(self, id, user_nome):
+        self.id = id
+        self.user_nome = user_nome
+
+
+class DaySnapshot:
+    """Operatori, turni, abilitazioni e appuntamenti di un giorno, pronti per il calcolo."""
+
+    def __init__(self, data, operatori, turni, appuntamenti, servizi_operatori, vincoli_risorse=None):
+        self.data = data
+        self.operatori = operatori                  # [OperatoreSnapshot] visibili e non eliminati
+        self.turni = turni                          # [(operator_id, time inizio, time fine)]
+        self.appuntamenti = appuntamenti            # [AppuntamentoSnapshot]
+        self.servizi_operatori = servizi_operatori  # servizio_id -> [operator_id]
+        self.vincoli_risorse = vincoli_risorse or {}  # servizio_id -> (resource_name, max_concurrent, nome)
+        self._indice = None
+        self._capacita = None
+        self._minuti_prenotati = None
+
+    @classmethod
+    def load(cls, session, data, servizi_ids=(), escludi_hold=None):
+        return cls.load_range(session, data, data, servizi_ids, escludi_hold=escludi_hold)[data]
+
+    @classmethod
+    def load_range(cls, session, data_da, data_a, servizi_ids=(), giorni=None, escludi_hold=None):
+        """
+        Snapshot di tutti i giorni da data_da a data_a (inclusi) con UNA query per
+        tabella: operatori e abilitazioni sono condivisi, turni e appuntamenti
+        vengono ripartiti per giorno in memoria. Ritorna {date: DaySnapshot}.
+
+        giorni: se indicato, solo queste date dell'intervallo (es. senza i giorni di chiusura).
+        escludi_hold: token degli hold da NON contare come occupati (quelli di chi prenota).
+        """
+        operatori = [
+            OperatoreSnapshot(op_id, nome)
+            for op_id, nome in session.query(Operator.id, Operator.user_nome).filter(
+                Operator.is_deleted == False,
+                Operator.is_visible == True
+            ).all()
+        ]
+        turni = session.query(
+            OperatorShift.shift_date,
+            OperatorShift.operator_id, OperatorShift.shift_start_time, OperatorShift.shift_end_time
+        ).filter(
+            OperatorShift.operator_id.in_([op.id for op in operatori]),
+            OperatorShift.shift_date >= data_da,
+            OperatorShift.shift_date <= data_a
+        ).all()
+
+        if giorni is None:
+            giorni = [data_da + timedelta(days=i) for i in range((data_a - data_da).days + 1)]
+        giorni = {d: ([], []) for d in sorted(giorni) if data_da <= d <= data_a}
+        for shift_date, op_id, s, e in turni:
+            if shift_date in giorni:
+                giorni[shift_date][0].append((op_id, s, e))
+        if not giorni:
+            return {}
+
+        servizi_operatori = _carica_servizi_operatori(session, servizi_ids)
+        vincoli_risorse = _carica_vincoli_risorse(session, servizi_ids)
+        inizio = datetime.combine(min(giorni), time.min)
+        fine = datetime.combine(max(giorni) + timedelta(days=1), time.min)
+        for app in _carica_appuntamenti(session, inizio, fine) + _carica_hold(session, giorni, escludi_hold):
+            giorno = giorni.get(app.start_time.date())
+            if giorno is not None:
+                giorno[1].append(app)
+        return {
+            d: cls(d, operatori, turni_giorno, appuntamenti, servizi_operatori, vincoli_risorse)
+            for d, (turni_giorno, appuntamenti) in giorni.items()
+        }
+
+    def turni_per_operatore(self, apertura, chiusura, operatori=None):
+        """
+        operator_id -> [(inizio, fine)] con più turni per operatore, limitati
+        all'orario di apertura attivo. Senza turni registrati vale l'intera apertura.
+        """
+        turni_per_operatore = {}
+        for op in (self.operatori if operatori is None else operatori):
+            op_turni = [
+                (
+                    s if isinstance(s, time) else apertura,
+                    e if isinstance(e, time) else chiusura
+                )
+                for op_id, s, e in self.turni if op_id == op.id
+            ]
+            if not op_turni:
+                op_turni = [(apertura, chiusura)]
+            op_turni = [
+                (max(start, apertura), min(end, chiusura))
+                for (start, end) in op_turni
+                if max(start, apertura) < min(end, chiusura)
+            ]
+            if op_turni:
+                turni_per_operatore[op.id] = op_turni
+        return turni_per_operatore
+
+    @property
+    def indice(self):
+        """OccupancyIndex del giorno, costruito alla prima richiesta."""
+        if self._indice is None:
+            self._indice = OccupancyIndex.from_records(self.appuntamenti)
+        return self._indice
+
+    @property
+    def minuti_prenotati(self):
+        """operator_id -> minuti di appuntamenti veri del giorno (senza OFF e pseudo-blocchi 9999)."""
+        if self._minuti_prenotati is None:
+            carico = {}
+            for app in self.appuntamenti:
+                if app.operator_id is None or app.is_off or app.service_id == 9999:
+                    continue
+                carico[app.operator_id] = carico.get(app.operator_id, 0) + int(app.duration or 0)
+            self._minuti_prenotati = carico
+        return self._minuti_prenotati
+
+    @property
+    def capacita(self):
+        """ResourceCapacity del giorno (max_concurrent / resource_name), costruita alla prima richiesta."""
+        if self._capacita is None:
+            self._capacita = ResourceCapacity(self.vincoli_risorse, self.appuntamenti)
+        return self._capacita
+
+
+def _carica_appuntamenti(session, inizio, fine):
+    # Attivi (non annullati dal cliente) + blocchi OFF/9999 anche se annullati,
+    # come le due query storiche, ma in un solo passaggio e senza duplicati.
+    righe = session.query(
+        Appointment.id,
+        Appointment.operator_id,
+        Appointment.start_time,
+        Appointment._duration,
+        Appointment.note.like('%OFF%'),
+        Appointment.service_id,
+    ).filter(
+        Appointment.start_time >= inizio,
+        Appointment.start_time < fine,
+        or_(
+            Appointment.is_cancelled_by_client == False,
+            Appointment.note.ilike('%OFF%'),
+            Appointment.service_id == 9999
+        )
+    ).all()
+    return [AppuntamentoSnapshot(*r) for r in righe]
+
+
+def _carica_hold(session, giorni, escludi_token=None):
+    # Hold non scaduti dei giorni richiesti (indice su data, expires_at): per il
+    # calcolo valgono come appuntamenti del servizio scelto sull'operatore scelto.
+    query = session.query(
+        SlotHold.id,
+        SlotHold.operator_id,
+        SlotHold.start_time,
+        SlotHold.duration,
+        SlotHold.service_id,
+    ).filter(
+        SlotHold.data.in_(list(giorni)),
+        SlotHold.expires_at > datetime.now(timezone.utc)
+    )
+    if escludi_token:
+        query = query.filter(SlotHold.token != escludi_token)
+    return [
+        AppuntamentoSnapshot(hold_id, op_id, start_time, durata, False, servizio_id)
+        for hold_id, op_id, start_time, durata, servizio_id in query.all()
+    ]
+
+
+def _carica_servizi_operatori(session, servizi_ids):
+    servizi_operatori = {sid: [] for sid in servizi_ids}
+    if servizi_ids:
+        righe = session.query(service_operator.c.service_id, service_operator.c.operator_id).filter(
+            service_operator.c.service_id.in_(list(servizi_ids))
+        ).all()
+        for sid, op_id in righe:
+            servizi_operatori.setdefault(sid, []).append(op_id)
+    return servizi_operatori
+
+
+def _carica_vincoli_risorse(session, servizi_ids):
+    """
+    Servizi con max_concurrent impostato che riguardano la richiesta: quelli
+    richiesti più tutti quelli che condividono con loro la stessa risorsa
+    (i loro appuntamenti occupano la stessa capacità).
+    """
+    if not servizi_ids:
+        return {}
+    righe = session.query(
+        Service.id, Service.resource_name, Service.max_concurrent, Service.servizio_nome
+    ).filter(Service.max_concurrent > 0).all()
+    richiesti = set(servizi_ids)
+    nomi = {(r.resource_name or '').strip().lower() for r in righe if r.id in richiesti}
+    nomi.discard('')
+    return {
+        r.id: (r.resource_name, r.max_concurrent, r.servizio_nome)
+        for r in righe
+        if r.id in richiesti or (r.resource_name or '').strip().lower() in nomi
+    }
+
+
+def versione_giorno(session, data):
+    """
+    "Versione" economica dei dati di un giorno, in una sola query: numero di
+    appuntamenti (e di annullati), ultimo last_edit/created_at, id massimo, più
+    numero e id massimo dei turni e degli hold attivi. Cambia a ogni scrittura sul
+    giorno, anche se fatta dal gestionale, e quando un hold scade: serve a capire
+    se un risultato in cache è ancora valido.
+    """
+    inizio = datetime.combine(data, time.min)
+    fine = datetime.combine(data + timedelta(days=1), time.min)
+    appuntamenti = select(
+        func.count(Appointment.id),
+        func.sum(case((Appointment.is_cancelled_by_client == True, 1), else_=0)),
+        func.max(func.coalesce(Appointment.last_edit, Appointment.created_at)),
+        func.max(Appointment.id),
+    ).where(
+        Appointment.start_time >= inizio,
+        Appointment.start_time < fine
+    ).subquery()
+    turni = select(
+        func.count(OperatorShift.id),
+        func.max(OperatorShift.id),
+    ).where(OperatorShift.shift_date == data).subquery()
+    hold = select(
+        func.count(SlotHold.id),
+        func.max(SlotHold.id),
+    ).where(
+        SlotHold.data == data,
+        SlotHold.expires_at > datetime.now(timezone.utc)
+    ).subquery()
+    return tuple(session.execute(
+        select(appuntamenti, turni, hold).select_from(
+            appuntamenti.join(turni, true()).join(hold, true())
+        )
+    ).one())
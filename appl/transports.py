@@ -0,0 +1,290 @@
+#appl/transports.py
+"""
+Trasporti di invio delle notifiche (email e WhatsApp), scelti da configurazione.
+
+    NOTIFY_TRANSPORT   = azure (default) | memory | stub   (tutti i canali)
+    EMAIL_TRANSPORT    = ... (sovrascrive solo le email)
+    WHATSAPP_TRANSPORT = ... (sovrascrive solo WhatsApp)
+
+- azure:  produzione, Azure Communication Email e API REST Unipile;
+- memory: registra i messaggi in memoria (TrasportoMemoria.email / .whatsapp),
+          per test e benchmark nello stesso processo;
+- stub:   simula la rete con latenza (STUB_LATENCY_MS) e tasso di errore
+          (STUB_ERROR_RATE, 0..1) configurabili; ogni messaggio "consegnato"
+          viene scritto in JSON lines su STUB_SINK_PATH oppure inviato in POST a
+          STUB_SINK_URL (se impostati), altrimenti solo contato.
+
+Contratto: invia_email(...) ritorna l'id del messaggio o solleva eccezione
+(l'outbox gestisce retry e backoff); invia_whatsapp(...) ritorna True/False
+come il vecchio _send_unipile_message.
+
+Unipile: una requests.Session per DSN, condivisa tra i thread, con pool di
+connessioni keep-alive limitato (UNIPILE_POOL_MAXSIZE): niente handshake TCP+TLS
+a ogni messaggio. Timeout di connessione e di lettura separati
+(UNIPILE_CONNECT_TIMEOUT, UNIPILE_READ_TIMEOUT) e retry con backoff solo dove la
+richiesta sicuramente non è stata elaborata: errori di connessione, 429 e 503
+(Retry-After rispettato ma limitato a UNIPILE_RETRY_AFTER_MAX secondi, così un
+thread del pool di invio non resta fermo a lungo). Non si ritenta su 500/502/504
+né su timeout di lettura: il messaggio potrebbe essere già partito e partirebbe
+due volte (quei casi li gestisce wa_outbox con i suoi tentativi).
+"""
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+from azure.communication.email import EmailClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+UNIPILE_CONNECT_TIMEOUT = float(os.environ.get('UNIPILE_CONNECT_TIMEOUT', '5'))
+UNIPILE_READ_TIMEOUT = float(os.environ.get('UNIPILE_READ_TIMEOUT', '20'))
+UNIPILE_POOL_MAXSIZE = int(os.environ.get('UNIPILE_POOL_MAXSIZE', '10'))
+UNIPILE_RETRY_AFTER_MAX = float(os.environ.get('UNIPILE_RETRY_AFTER_MAX', '10'))
+
+
+class _RetryLimitato(Retry):
+    """Retry con attesa da Retry-After limitata a UNIPILE_RETRY_AFTER_MAX secondi."""
+
+    def get_retry_after(self, response):
+        attesa = super().get_retry_after(response)
+        return None if attesa is None else min(attesa, UNIPILE_RETRY_AFTER_MAX)
+
+
+UNIPILE_RETRY = _RetryLimitato(
+    total=3,
+    connect=3,
+    read=0,                                   # timeout in lettura: forse già inviato, non ritentare
+    other=0,
+    status=3,
+    status_forcelist=(429, 503),              # rifiutata senza elaborarla: si può ritentare
+    allowed_methods=None,                     # anche POST: per questi status il messaggio non è partito
+    backoff_factor=1.0,                       # 1s, 2s, 4s
+    respect_retry_after_header=True,
+    raise_on_status=False,                    # all'ultimo tentativo ritorna la risposta d'errore
+)
+
+
+class TrasportoAzure:
+    """Azure Communication Email + Unipile: quello che gira in produzione."""
+    nome = 'azure'
+
+    def __init__(self):
+        self._clients = {}
+        self._sessioni_http = {}
+        self._lock = threading.Lock()
+
+    def client_email(self, connection_string):
+        """EmailClient condiviso per connection string (thread-safe, riusa le connessioni HTTP)."""
+        with self._lock:
+            client = self._clients.get(connection_string)
+            if client is None:
+                client = self._clients[connection_string] = EmailClient.from_connection_string(connection_string)
+            return client
+
+    def sessione_http(self, dsn):
+        """requests.Session condivisa per DSN Unipile (keep-alive, pool limitato, retry)."""
+        with self._lock:
+            sessione = self._sessioni_http.get(dsn)
+            if sessione is None:
+                sessione = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UNIPILE_POOL_MAXSIZE,
+                                      pool_block=True, max_retries=UNIPILE_RETRY)
+                sessione.mount("https://", adapter)
+                sessione.mount("http://", adapter)
+                self._sessioni_http[dsn] = sessione
+            return sessione
+
+    def invia_email(self, to_email, subject, html_content, plain_text=None, from_email=None):
+        connection_string = os.environ.get('AZURE_EMAIL_CONNECTION_STRING')
+        if not connection_string:
+            raise RuntimeError("AZURE_EMAIL_CONNECTION_STRING not set")
+        sender = (from_email or os.environ.get('AZURE_EMAIL_SENDER') or "").strip()
+        if not sender:
+            raise RuntimeError("AZURE_EMAIL_SENDER not set and from_email not provided")
+
+        content = {"subject": subject, "html": html_content}
+        if plain_text:
+            content["plainText"] = plain_text
+
+        # List-Unsubscribe header per ridurre spam complaints
+        sender_domain = sender.split('@')[1] if '@' in sender else 'example.com'
+        unsubscribe_url = f"https://{sender_domain}/unsubscribe"
+        unsubscribe_mailto = f"mailto:{sender}?subject=Unsubscribe"
+
+        message = {
+            "senderAddress": sender,
+            "recipients": {"to": [{"address": to_email}]},
+            "content": content,
+            "headers": {
+                "List-Unsubscribe": f"<{unsubscribe_url}>, <{unsubscribe_mailto}>",
+                "List-Unsubscribe-Post": "List-Unsubscribe=One-Click"
+            }
+        }
+        result = self.client_email(connection_string).begin_send(message).result()
+        status = getattr(result, "status", "Succeeded")
+        if status != "Succeeded":
+            raise RuntimeError(f"Azure status={status}")
+        return getattr(result, "message_id", None)
+
+    def invia_whatsapp(self, creds, numero_whatsapp, text):
+        """Invia messaggio WhatsApp con API REST Unipile (numero già normalizzato)."""
+        try:
+            # API Unipile - endpoint /api/v1/chats
+            url = f"https://{creds['dsn']}/api/v1/chats"
+            headers = {
+                "X-API-KEY": creds["access_token"],
+                "accept": "application/json"
+            }
+            data = {
+                "account_id": creds["account_id"],
+                "text": text or "",
+                "attendees_ids": numero_whatsapp  # formato: numero@s.whatsapp.net
+            }
+
+            response = self.sessione_http(creds['dsn']).post(
+                url, headers=headers, data=data, timeout=(UNIPILE_CONNECT_TIMEOUT, UNIPILE_READ_TIMEOUT))
+
+            if response.status_code in [200, 201]:
+                result = response.json()
+                print(f"[UNIPILE] Messaggio inviato con successo a {numero_whatsapp}: {result}")
+                return True
+            print(f"[UNIPILE] Errore HTTP {response.status_code}: {response.text}")
+            return False
+
+        except requests.exceptions.Timeout:
+            print(f"[UNIPILE] Timeout invio a {numero_whatsapp}")
+            return False
+        except requests.exceptions.RequestException as e:
+            print(f"[UNIPILE] Errore connessione: {repr(e)}")
+            return False
+
+
+class TrasportoMemoria:
+    """Registra i messaggi in memoria invece di inviarli."""
+    nome = 'memory'
+
+    def __init__(self):
+        self.email = []
+        self.whatsapp = []
+        self._lock = threading.Lock()
+
+    def invia_email(self, to_email, subject, html_content, plain_text=None, from_email=None):
+        with self._lock:
+            self.email.append({
+                "to_email": to_email, "subject": subject, "html_content": html_content,
+                "plain_text": plain_text, "from_email": from_email, "ts": time.time(),
+            })
+            return f"memory-{len(self.email)}"
+
+    def invia_whatsapp(self, creds, numero_whatsapp, text):
+        with self._lock:
+            self.whatsapp.append({
+                "account_id": (creds or {}).get("account_id"), "to": numero_whatsapp,
+                "text": text, "ts": time.time(),
+            })
+        return True
+
+    def svuota(self):
+        with self._lock:
+            self.email.clear()
+            self.whatsapp.clear()
+
+
+class TrasportoStub:
+    """Finto provider con latenza ed errori configurabili, per prove di carico offline."""
+    nome = 'stub'
+
+    def __init__(self, latenza_ms=0, tasso_errore=0.0, percorso=None, url=None):
+        self.latenza_ms = float(latenza_ms)
+        self.tasso_errore = float(tasso_errore)
+        self.percorso = percorso
+        self.url = url
+        self.inviati = 0
+        self.falliti = 0
+        self._lock = threading.Lock()
+
+    def _simula(self, canale, record):
+        """Ritorna il numero progressivo del messaggio consegnato, None se errore simulato."""
+        if self.latenza_ms > 0:
+            # latenza con un po' di variabilità (±50%), come una rete vera
+            time.sleep(self.latenza_ms * random.uniform(0.5, 1.5) / 1000.0)
+        if random.random() < self.tasso_errore:
+            with self._lock:
+                self.falliti += 1
+            return None
+        record = dict(record, canale=canale, ts=datetime.now(timezone.utc).isoformat())
+        if self.url:
+            try:
+                requests.post(self.url, json=record, timeout=10)
+            except requests.exceptions.RequestException as e:
+                # il sink è solo un raccoglitore: se non risponde il messaggio conta come consegnato
+                print(f"[STUB] sink {self.url} non raggiungibile: {repr(e)}")
+        with self._lock:
+            self.inviati += 1
+            numero = self.inviati
+            if self.percorso:
+                with open(self.percorso, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return numero
+
+    def invia_email(self, to_email, subject, html_content, plain_text=None, from_email=None):
+        numero = self._simula('email', {"to": to_email, "subject": subject, "from": from_email,
+                                        "html_bytes": len(html_content or ''), "plain_text": plain_text})
+        if not numero:
+            raise RuntimeError("stub: errore di invio simulato")
+        return f"stub-{numero}"
+
+    def invia_whatsapp(self, creds, numero_whatsapp, text):
+        ok = bool(self._simula('whatsapp', {"account_id": (creds or {}).get("account_id"),
+                                            "to": numero_whatsapp, "text": text}))
+        if not ok:
+            print(f"[STUB] Errore simulato invio WhatsApp a {numero_whatsapp}")
+        return ok
+
+
+def _crea(nome):
+    nome = (nome or 'azure').strip().lower()
+    if nome == 'memory':
+        return TrasportoMemoria()
+    if nome == 'stub':
+        return TrasportoStub(
+            latenza_ms=os.environ.get('STUB_LATENCY_MS', '0'),
+            tasso_errore=os.environ.get('STUB_ERROR_RATE', '0'),
+            percorso=os.environ.get('STUB_SINK_PATH') or None,
+            url=os.environ.get('STUB_SINK_URL') or None,
+        )
+    if nome != 'azure':
+        print(f"[TRANSPORT] trasporto '{nome}' sconosciuto, uso azure")
+    return TrasportoAzure()
+
+
+_TRASPORTI = {}
+_TRASPORTI_LOCK = threading.Lock()
+
+
+def _trasporto(canale, variabile):
+    with _TRASPORTI_LOCK:
+        trasporto = _TRASPORTI.get(canale)
+        if trasporto is None:
+            generale = os.environ.get('NOTIFY_TRANSPORT', 'azure')
+            trasporto = _TRASPORTI[canale] = _crea(os.environ.get(variabile) or generale)
+            print(f"[TRANSPORT] {canale}: {trasporto.nome}")
+        return trasporto
+
+
+def trasporto_email():
+    return _trasporto('email', 'EMAIL_TRANSPORT')
+
+
+def trasporto_whatsapp():
+    return _trasporto('whatsapp', 'WHATSAPP_TRANSPORT')
+
+
+def imposta_trasporto(canale, trasporto):
+    """Sostituisce il trasporto di un canale ('email' / 'whatsapp'), es. nei benchmark."""
+    with _TRASPORTI_LOCK:
+        _TRASPORTI[canale] = trasporto
@@ -0,0 +1,241 @@
+#appl/wa_outbox.py
+"""
+Outbox persistente dei messaggi WhatsApp automatici (tabella wa_outbox).
+
+Prima le code del memo mattutino e dei turni operatori erano dict di modulo
+(_MORNING_STATE, _OP_STATE_MAP) dentro ogni worker gunicorn: ogni worker che
+avviava lo scheduler ricostruiva la sua coda, e per gli operatori un riavvio o
+un secondo worker rimandava tutto. Ora:
+- il tick costruisce la coda e la inserisce con accoda_whatsapp, testi già
+  renderizzati; dedupe_key è unica, quindi ricostruire la coda (altro worker,
+  riavvio) non crea doppioni;
+- chi invia si prende una riga pronta con FOR UPDATE SKIP LOCKED (due worker o
+  istanze non prendono mai la stessa), la segna 'sending' e spedisce fuori dalla
+  transazione;
+- errore -> di nuovo 'pending' con backoff, oltre MAX_TENTATIVI 'failed'; righe
+  rimaste 'sending' (worker morto a metà) tornano disponibili dopo
+  BLOCCO_SCADUTO_SECONDI; righe oltre expires_at diventano 'expired'.
+Su database senza SKIP LOCKED (SQLite in locale) la presa in carico è serializzata
+da un lock di processo.
+
+Ritmo di invio per account Unipile (BusinessInfo.whatsapp_rate_per_minute e
+whatsapp_daily_cap): un token bucket per account (burst WA_BURST) più una pausa
+casuale dopo ogni invio, così i messaggi non partono a intervalli regolari. Il
+bucket è per processo; il tetto al minuto e quello giornaliero sono contati anche
+sulle righe di wa_outbox, quindi valgono per tutti i worker e le istanze insieme.
+"""
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.exc import IntegrityError
+
+from appl.models import WaOutbox
+from appl.rate_limit import TokenBucket
+
+MAX_TENTATIVI = 3
+BACKOFF_BASE_SECONDI = 120    # 2 min, 4 min, ...
+BLOCCO_SCADUTO_SECONDI = 600
+CONSERVA_GIORNI = 7           # righe chiuse (sent/failed/expired) più vecchie vengono eliminate
+
+WA_BURST = 3                  # invii ravvicinati concessi prima di scendere al ritmo medio
+JITTER_FRAZIONE = 0.5         # pausa casuale dopo un invio: fino a metà dell'intervallo medio
+
+_PRESA_LOCK = threading.Lock()
+_BUCKETS = {}                 # account_id -> (rate_per_minuto, TokenBucket)
+_PAUSA_FINO = {}              # account_id -> time.monotonic() fino a cui non inviare (jitter)
+_BUCKETS_LOCK = threading.Lock()
+
+
+def accoda_whatsapp(session, kind, messaggi, expires_at=None):
+    """
+    Inserisce i messaggi (dict con dedupe_key, ref_id, to_phone, text) saltando quelli
+    la cui dedupe_key esiste già. Commit incluso. Ritorna quanti ne ha inseriti.
+    I messaggi senza numero vengono registrati subito come 'failed' (restano visibili
+    e non vengono più ricostruiti).
+    """
+    if not messaggi:
+        return 0
+    adesso = datetime.now(timezone.utc)
+    chiavi = [m["dedupe_key"] for m in messaggi]
+    esistenti = set()
+    for i in range(0, len(chiavi), 500):
+        esistenti.update(k for (k,) in session.query(WaOutbox.dedupe_key).filter(
+            WaOutbox.dedupe_key.in_(chiavi[i:i + 500])).all())
+
+    nuovi = 0
+    for m in messaggi:
+        if m["dedupe_key"] in esistenti:
+            continue
+        esistenti.add(m["dedupe_key"])
+        senza_numero = not (m.get("to_phone") or "").strip()
+        session.add(WaOutbox(
+            kind=kind,
+            dedupe_key=m["dedupe_key"],
+            ref_id=m.get("ref_id"),
+            to_phone=(m.get("to_phone") or "").strip(),
+            text=m.get("text") or "",
+            status='failed' if senza_numero else 'pending',
+            last_error="numero mancante" if senza_numero else None,
+            attempts=0,
+            not_before=adesso,
+            expires_at=expires_at,
+        ))
+        nuovi += 1
+    try:
+        session.commit()
+    except IntegrityError:
+        # un altro worker ha accodato gli stessi messaggi nello stesso istante: va bene così
+        session.rollback()
+        return 0
+    return nuovi
+
+
+def invii_dal(session, dal):
+    """Messaggi inviati o in invio (tutti i tipi) dall'istante `dal` (UTC)."""
+    return session.query(func.count(WaOutbox.id)).filter(
+        WaOutbox.status.in_(('sending', 'sent')),
+        func.coalesce(WaOutbox.sent_at, WaOutbox.locked_at) >= dal,
+    ).scalar() or 0
+
+
+def _bucket(account_id, rate_per_minuto):
+    with _BUCKETS_LOCK:
+        voce = _BUCKETS.get(account_id)
+        if voce is None or voce[0] != rate_per_minuto:
+            # nuovo account o ritmo cambiato da BusinessInfo: bucket nuovo
+            voce = _BUCKETS[account_id] = (rate_per_minuto, TokenBucket(rate_per_minuto / 60.0, WA_BURST))
+        return voce[1]
+
+
+def riserva_invio(session, account_id, rate_per_minuto, cap_giornaliero, inizio_giornata):
+    """
+    Chiede il permesso per UN invio sull'account. Ritorna 0 (gettone preso) oppure i
+    secondi da attendere; None se il tetto giornaliero è raggiunto. Se poi non c'è
+    nulla da inviare il gettone va reso con rendi_invio.
+    """
+    rate_per_minuto = max(1, int(rate_per_minuto or 1))
+    adesso = time.monotonic()
+    with _BUCKETS_LOCK:
+        pausa = _PAUSA_FINO.get(account_id, 0.0) - adesso
+    if pausa > 0:
+        return pausa
+    adesso_utc = datetime.now(timezone.utc)
+    if cap_giornaliero and invii_dal(session, inizio_giornata) >= cap_giornaliero:
+        return None
+    if invii_dal(session, adesso_utc - timedelta(seconds=60)) >= rate_per_minuto:
+        # altri worker/istanze hanno già usato il ritmo di questo minuto
+        return 60.0 / rate_per_minuto
+    attesa = _bucket(account_id, rate_per_minuto).prova()
+    if attesa == 0:
+        with _BUCKETS_LOCK:
+            _PAUSA_FINO[account_id] = adesso + random.uniform(0, JITTER_FRAZIONE * 60.0 / rate_per_minuto)
+    return attesa
+
+
+def rendi_invio(account_id):
+    """Restituisce il gettone preso da riserva_invio quando non c'era nulla da inviare."""
+    with _BUCKETS_LOCK:
+        voce = _BUCKETS.get(account_id)
+        _PAUSA_FINO.pop(account_id, None)
+    if voce is not None:
+        voce[1].restituisci()
+
+
+def _scadi(session, kind, adesso):
+    query = session.query(WaOutbox).filter(
+        WaOutbox.status.in_(('pending', 'sending')),
+        WaOutbox.expires_at.isnot(None),
+        WaOutbox.expires_at <= adesso,
+    )
+    if kind is not None:
+        query = query.filter(WaOutbox.kind == kind)
+    query.update({"status": 'expired', "locked_at": None}, synchronize_session=False)
+
+
+def _pronte(adesso):
+    # righe da prendere: 'pending' già in orario oppure 'sending' di un worker morto
+    return or_(
+        and_(WaOutbox.status == 'pending', WaOutbox.not_before <= adesso),
+        and_(WaOutbox.status == 'sending',
+             WaOutbox.locked_at <= adesso - timedelta(seconds=BLOCCO_SCADUTO_SECONDI)),
+    )
+
+
+def ci_sono_pronti(session, kind=None):
+    """Controllo in sola lettura (una SELECT ... LIMIT 1, nessun lock né commit):
+    c'è almeno una riga pronta? Il sender lo fa prima di credenziali, rate e presa
+    in carico, così a coda vuota un giro costa una query. Le righe oltre expires_at
+    contano ancora come pronte: le marca 'expired' il prendi_prossimo successivo."""
+    query = session.query(WaOutbox.id).filter(_pronte(datetime.now(timezone.utc)))
+    if kind is not None:
+        query = query.filter(WaOutbox.kind == kind)
+    return query.limit(1).first() is not None
+
+
+def prendi_prossimo(session, kind=None):
+    """Prende in carico (status 'sending', commit incluso) la prossima riga pronta
+    (del tipo indicato, o di qualsiasi tipo). Ritorna un dict con id, kind, attempts,
+    ref_id, to_phone, text oppure None."""
+    adesso = datetime.now(timezone.utc)
+    _scadi(session, kind, adesso)
+    query = session.query(WaOutbox).filter(_pronte(adesso))
+    if kind is not None:
+        query = query.filter(WaOutbox.kind == kind)
+    query = query.order_by(WaOutbox.not_before, WaOutbox.id).limit(1)
+
+    if session.get_bind().dialect.name == 'postgresql':
+        return _segna_in_invio(session, query.with_for_update(skip_locked=True).first(), adesso)
+    with _PRESA_LOCK:
+        return _segna_in_invio(session, query.first(), adesso)
+
+
+def _segna_in_invio(session, riga, adesso):
+    if riga is None:
+        session.commit()
+        return None
+    riga.status = 'sending'
+    riga.locked_at = adesso
+    riga.attempts = (riga.attempts or 0) + 1
+    messaggio = {
+        "id": riga.id, "kind": riga.kind, "attempts": riga.attempts, "ref_id": riga.ref_id,
+        "to_phone": riga.to_phone, "text": riga.text,
+    }
+    session.commit()
+    return messaggio
+
+
+def registra_esito(session, messaggio, ok, errore=None):
+    """Chiude la riga presa con prendi_prossimo: 'sent', retry con backoff o 'failed'.
+    Commit a carico del chiamante (il tick marca nella stessa transazione l'appuntamento)."""
+    adesso = datetime.now(timezone.utc)
+    if ok:
+        esito = {"status": 'sent', "sent_at": adesso, "last_error": None}
+    elif messaggio["attempts"] >= MAX_TENTATIVI:
+        esito = {"status": 'failed', "last_error": (errore or "invio fallito")[:2000]}
+    else:
+        attesa = BACKOFF_BASE_SECONDI * (2 ** (messaggio["attempts"] - 1))
+        esito = {
+            "status": 'pending',
+            "not_before": adesso + timedelta(seconds=attesa),
+            "last_error": (errore or "invio fallito")[:2000],
+        }
+    esito["locked_at"] = None
+    session.query(WaOutbox).filter(WaOutbox.id == messaggio["id"]).update(esito, synchronize_session=False)
+    return esito["status"]
+
+
+def stato_coda(session, kind):
+    """Conteggio delle righe del tipo per status."""
+    return dict(session.query(WaOutbox.status, func.count(WaOutbox.id)).filter(
+        WaOutbox.kind == kind).group_by(WaOutbox.status).all())
+
+
+def pulisci_wa_outbox(session):
+    """Elimina in blocco le righe chiuse più vecchie di CONSERVA_GIORNI (commit a carico del chiamante)."""
+    session.query(WaOutbox).filter(
+        WaOutbox.status.in_(('sent', 'failed', 'expired')),
+        WaOutbox.created_at < datetime.now(timezone.utc) - timedelta(days=CONSERVA_GIORNI),
+    ).delete(synchronize_session=False)
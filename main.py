@@ -3,9 +3,11 @@ import threading
 import time as time_mod
 from flask import Flask, g, request, abort
 from appl import db
+from appl.models import BookingIdempotencyKey, SlotHold, EmailOutbox, AdminNotificationBuffer, WaOutbox
+from appl.email_outbox import avvia_worker_outbox
 from routes.booking import booking_bp
 from flask_wtf import CSRFProtect
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.automap import automap_base
 from dotenv import load_dotenv
@@ -44,6 +46,47 @@ db_sessions = {
     tenant: scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
     for tenant, engine in db_engines.items()
 }
+# Tabelle di servizio del solo booking (il gestionale non le conosce):
+# create al primo avvio se mancano, mai modificate se esistono già
+BOOKING_TABLES = [
+    BookingIdempotencyKey.__table__, SlotHold.__table__, EmailOutbox.__table__,
+    AdminNotificationBuffer.__table__, WaOutbox.__table__,
+]
+# Colonne che il booking aggiunge a tabelle esistenti del gestionale:
+# (tabella, colonna, definizione SQL con default). Aggiunte al primo avvio se
+# mancano, così i modelli (es. BusinessInfo) non puntano a colonne inesistenti.
+BOOKING_COLUMNS = [
+    ('business_info', 'admin_digest_enabled', 'BOOLEAN NOT NULL DEFAULT FALSE'),
+    ('business_info', 'admin_digest_minutes', 'INTEGER NOT NULL DEFAULT 5'),
+    ('business_info', 'whatsapp_rate_per_minute', 'INTEGER NOT NULL DEFAULT 10'),
+    ('business_info', 'whatsapp_daily_cap', 'INTEGER NOT NULL DEFAULT 500'),
+]
+
+def _aggiungi_colonne_booking(tenant, engine):
+    esistenti = {}
+    ispettore = inspect(engine)
+    for tabella, colonna, definizione in BOOKING_COLUMNS:
+        if tabella not in esistenti:
+            esistenti[tabella] = {c['name'] for c in ispettore.get_columns(tabella)}
+        if colonna in esistenti[tabella]:
+            continue
+        # IF NOT EXISTS (PostgreSQL): più worker che partono insieme non si ostacolano
+        se_manca = 'IF NOT EXISTS ' if engine.dialect.name == 'postgresql' else ''
+        with engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE {tabella} ADD COLUMN {se_manca}{colonna} {definizione}'))
+        esistenti[tabella].add(colonna)
+        print(f"[BOOKING-TABLES][{tenant}] aggiunta colonna {tabella}.{colonna}")
+
+for tenant, engine in db_engines.items():
+    try:
+        db.metadata.create_all(engine, tables=BOOKING_TABLES, checkfirst=True)
+    except Exception as e:
+        print(f"[BOOKING-TABLES][{tenant}] impossibile creare le tabelle di servizio: {repr(e)}")
+    try:
+        _aggiungi_colonne_booking(tenant, engine)
+    except Exception as e:
+        print(f"[BOOKING-TABLES][{tenant}] impossibile aggiungere le colonne di servizio: {repr(e)}")
+
 # Riflette la struttura del database per ogni tenant
 db_bases = {
     tenant: automap_base()
@@ -118,6 +161,35 @@ def _start_operator_scheduler_once(app):
     t = threading.Thread(target=worker, name="wa_operator_scheduler", daemon=True)
     t.start()
 
+def _start_wa_sender_once(app):
+    # loop breve che svuota wa_outbox al ritmo dell'account Unipile di ogni tenant
+    if app.config.get('WA_SENDER_STARTED'):
+        return
+    app.config['WA_SENDER_STARTED'] = True
+
+    def worker():
+        import importlib
+        booking_mod = importlib.import_module('routes.booking')
+        poll_seconds = getattr(booking_mod, 'WA_SEND_POLL_SECONDS', 2)
+        process_wa_send_tick = getattr(booking_mod, 'process_wa_send_tick')
+        log_ticker_error = getattr(booking_mod, 'log_ticker_error')
+        while True:
+            try:
+                with app.app_context():
+                    sessions = app.config.get('DB_SESSIONS', {})
+                    for tenant_id in sessions.keys():
+                        try:
+                            process_wa_send_tick(app, tenant_id)
+                        except Exception as e:
+                            print(f"[WA-SEND][{tenant_id}] tick error: {repr(e)}")
+                            log_ticker_error(app, tenant_id, "WA-SEND", e)
+            except Exception as e:
+                print(f"[WA-SEND] loop error: {repr(e)}")
+            time_mod.sleep(poll_seconds)
+
+    t = threading.Thread(target=worker, name="wa_sender", daemon=True)
+    t.start()
+
 def _start_error_summary_scheduler_once(app):
     # evita multi-avvio in ambienti con più worker
     if app.config.get('ERR_SUMMARY_SCHEDULER_STARTED'):
@@ -185,6 +257,41 @@ def _start_error_summary_scheduler_once(app):
     t = threading.Thread(target=worker, name="err_summary_scheduler", daemon=True)
     t.start()
 
+def _start_admin_digest_scheduler_once(app):
+    if app.config.get('ADMIN_DIGEST_SCHEDULER_STARTED'):
+        return
+    app.config['ADMIN_DIGEST_SCHEDULER_STARTED'] = True
+
+    def worker():
+        import importlib
+        booking_mod = importlib.import_module('routes.booking')
+        poll_seconds = getattr(booking_mod, 'ADMIN_DIGEST_POLL_SECONDS', 60)
+        process_admin_digest_tick = getattr(booking_mod, 'process_admin_digest_tick')
+        log_ticker_error = getattr(booking_mod, 'log_ticker_error')
+        while True:
+            time_mod.sleep(poll_seconds)
+            try:
+                with app.app_context():
+                    sessions = app.config.get('DB_SESSIONS', {})
+                    for tenant_id in sessions.keys():
+                        try:
+                            process_admin_digest_tick(app, tenant_id)
+                        except Exception as e:
+                            print(f"[ADMIN-DIGEST][{tenant_id}] tick error: {repr(e)}")
+                            log_ticker_error(app, tenant_id, "ADMIN-DIGEST", e)
+            except Exception as e:
+                print(f"[ADMIN-DIGEST] loop error: {repr(e)}")
+
+    t = threading.Thread(target=worker, name="admin_digest_scheduler", daemon=True)
+    t.start()
+
+def _start_email_outbox_once(app):
+    # pool fisso di worker che svuota l'outbox email di tutti i tenant
+    if app.config.get('EMAIL_OUTBOX_STARTED'):
+        return
+    app.config['EMAIL_OUTBOX_STARTED'] = True
+    avvia_worker_outbox(app, int(os.environ.get('EMAIL_OUTBOX_WORKERS', '2')))
+
 # 4. Registra il blueprint con un prefisso dinamico
 #    Questo renderà le tue routes accessibili tramite /negozio1/booking, /negozio2/booking, etc.
 app.register_blueprint(booking_bp, url_prefix='/<tenant_id>')
@@ -272,7 +379,10 @@ def shutdown_session(exception=None):
 
 _start_morning_scheduler_once(app)
 _start_operator_scheduler_once(app)
+_start_wa_sender_once(app)
 _start_error_summary_scheduler_once(app)
+_start_admin_digest_scheduler_once(app)
+_start_email_outbox_once(app)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
@@ -5,19 +5,30 @@ import traceback
 from flask import Blueprint, g, request, jsonify, render_template, render_template_string, session, url_for, current_app, Response
 from flask_wtf import CSRFProtect
 from flask_wtf.csrf import generate_csrf
-from appl.models import Appointment, AppointmentSource, Service, Operator, OperatorShift, Client, BusinessInfo, BookingErrorLog, CrmErrorLog
+from appl.models import Appointment, AppointmentSource, Service, Operator, OperatorShift, Client, BusinessInfo, BookingErrorLog, CrmErrorLog, BookingIdempotencyKey, SlotHold, AdminNotificationBuffer, WaOutbox
+from appl.availability import calcola_slot_disponibili
+from appl.snapshot import DaySnapshot, versione_giorno
+from appl.occupancy import in_turno, minuti
+from appl.locks import lock_operatori_giorno
+from appl.availability_cache import AvailabilityCache, SingleFlight, chiave_orari
+from appl.email_templates import render_email
+from appl.email_outbox import (
+    PRIORITA_CONFERMA, PRIORITA_NOTIFICA, PRIORITA_OTP, accoda_email, statistiche_outbox
+)
+from appl.transports import trasporto_email, trasporto_whatsapp
+from appl.wa_outbox import accoda_whatsapp, ci_sono_pronti, prendi_prossimo, registra_esito, riserva_invio, rendi_invio, pulisci_wa_outbox
 from datetime import date, datetime, timezone, timedelta, time
-from sqlalchemy import func, or_
+from sqlalchemy import func, insert, or_
+from sqlalchemy.exc import IntegrityError
 from pytz import timezone as pytz_timezone
 import re
 import os
 import random
 import uuid
+import hashlib
 from markupsafe import escape
 import threading
-import requests
-from azure.communication.email import EmailClient
-import html as html_lib
+from concurrent.futures import ThreadPoolExecutor
 
 # --- UTIL: formato data per email (solo output email, non DB) ---
 MONTH_ABBR_IT = {
@@ -43,37 +54,29 @@ def _fmt_date_it_short(date_str: str) -> str:
     except Exception:
         return date_str
     
-def _html_to_text(html_content: str) -> str:
-    """Converte un frammento HTML in testo semplice leggibile."""
-    try:
-        if not html_content:
-            return ""
-        txt = re.sub(r'(?i)<br\s*/?>', '\n', html_content)
-        txt = re.sub(r'(?i)</p>', '\n', txt)
-        txt = re.sub(r'<[^>]+>', '', txt)
-        txt = html_lib.unescape(txt)
-        lines = [l.strip() for l in txt.splitlines()]
-        txt = "\n".join([l for l in lines if l])
-        return txt.strip()
-    except Exception:
-        return (html_content or "").strip()
-
 def _now_rome():
     return datetime.now(pytz_timezone('Europe/Rome'))
 
-# Stato semplice per il job mattutino (per-tenant, in memoria)
-_MORNING_STATE = {}        # tenant_id -> {"date": date, "queue": [dict], "idx": int, "last_sent_minute": datetime}
+# Job mattutino: la coda sta su DB (wa_outbox, kind 'morning'), qui solo ottimizzazioni per processo
 _MORNING_DONE = {}         # tenant_id -> date: giorno in cui il batch è già stato AVVIATO (ottimizzazione in memoria; la correttezza è sul DB)
 _MORNING_LOCKS = {}        # tenant_id -> threading.Lock()
 MORNING_POLL_SECONDS = 60   # ogni quanto il tick gira
 MORNING_CATCHUP_MINUTES = 180  # entro quanti minuti DOPO l'ora del reminder è ancora lecito costruire/recuperare la coda
-MORNING_RATE_SECONDS = 60  # ogni quanto inviare un messaggio
+WA_SEND_POLL_SECONDS = 2    # ogni quanto il sender svuota wa_outbox (il ritmo vero lo decide il rate per account)
+WA_SEND_MAX_PER_TICK = 20   # invii massimi per tenant per giro, così un tenant non monopolizza il sender
+WA_SEND_WORKERS = int(os.environ.get('WA_SEND_WORKERS', '4'))  # invii Unipile in parallelo (pool limitato)
+_WA_SEND_LOCKS = {}         # tenant_id -> threading.Lock()
+_WA_SEND_POOL = ThreadPoolExecutor(max_workers=WA_SEND_WORKERS, thread_name_prefix='wa_send')
+_WA_IN_VOLO = {}            # tenant_id -> invii consegnati al pool e non ancora conclusi
+_WA_IN_VOLO_LOCK = threading.Lock()
+WA_CREDS_TTL_SECONDS = 300  # il sender ricarica le credenziali Unipile del tenant al più ogni 5 minuti
+_WA_CREDS = {}              # tenant_id -> (timestamp di caricamento, creds oppure None se non configurate)
+_WA_CAP_LOGGATO = {}        # tenant_id -> date: tetto giornaliero già segnalato nel log oggi
 WA_MORNING_DEBUG = True  # metti a False quando hai finito i test
 PROCESS_START_AT = _now_rome() # Registra l'orario di avvio del processo (serve per capire se il riavvio è avvenuto dopo il cutoff)
 
 WA_OPERATOR_DEBUG = True  # metti a False quando hai finito i test per operatori
-_OP_STATE_MAP = {}        # tenant_id -> {"date": date, "queue": [dict], "idx": int, "last_sent_minute": datetime}
-_OP_DONE = {}             # tenant_id -> date: giorno in cui il batch operatori è già stato AVVIATO (solo in memoria)
+_OP_DONE = {}             # tenant_id -> date: giorno in cui il batch operatori è già stato AVVIATO (ottimizzazione; la coda sta su wa_outbox)
 _OP_LOCKS = {}            # tenant_id -> threading.Lock()
 
 # Stato per il riepilogo orario degli errori di prenotazione (per-tenant, in memoria)
@@ -90,6 +93,27 @@ _BOOKING_LOCK = threading.Lock()
 BOOKING_RATE_LIMIT_MAX = 3      # Massimo 3 prenotazioni
 BOOKING_RATE_LIMIT_WINDOW = 240  # in 4 minuti (240 secondi)
 
+# --- DISPONIBILITA' MULTI-GIORNO ---
+ORARI_RANGE_MAX_GIORNI = 31  # finestra massima accettata da /orari-range
+IDEMPOTENCY_TTL_HOURS = 24  # validità delle Idempotency-Key di /prenota
+SLOT_HOLD_TTL_SECONDS = int(os.environ.get('SLOT_HOLD_TTL_SECONDS', '600'))  # durata di un hold sullo slot scelto
+SLOT_HOLD_MAX_PER_IP = int(os.environ.get('SLOT_HOLD_MAX_PER_IP', '5'))  # hold creati per IP in SLOT_HOLD_TTL_SECONDS
+SLOT_HOLD_MAX_PER_SESSIONE = 10  # hold creati per sessione in SLOT_HOLD_TTL_SECONDS
+_HOLD_TIMESTAMPS = {}  # "ip:<tenant>:<ip>" / "tok:<tenant>:<token>" -> timestamp degli ultimi hold creati
+_HOLD_LOCK = threading.Lock()
+ADMIN_DIGEST_POLL_SECONDS = 60  # ogni quanto il flusher controlla il buffer delle notifiche admin
+PROSSIMO_DISPONIBILE_GIORNI = int(os.environ.get('PROSSIMO_DISPONIBILE_GIORNI', '60'))  # orizzonte di default
+PROSSIMO_DISPONIBILE_MAX_GIORNI = 180  # orizzonte massimo richiedibile
+PROSSIMO_DISPONIBILE_BATCH = 7  # giorni caricati per ogni giro di query
+
+# --- CACHE DISPONIBILITA' (/orari) ---
+_AVAIL_CACHE = AvailabilityCache(
+    max_voci=int(os.environ.get('ORARI_CACHE_MAX_VOCI', '512')),
+    ttl=int(os.environ.get('ORARI_CACHE_TTL_SECONDS', '30')),           # voce fresca
+    max_stale=int(os.environ.get('ORARI_CACHE_MAX_STALE_SECONDS', '300'))  # servita stale + refresh in background
+)
+_ORARI_FLIGHT = SingleFlight(timeout=int(os.environ.get('ORARI_SINGLEFLIGHT_TIMEOUT_SECONDS', '20')))
+
 def _op_dbg(tenant_id, msg):
     if WA_OPERATOR_DEBUG:
         print(f"[WA-OP][{tenant_id}] {msg}")
@@ -129,7 +153,7 @@ _TICKER_ERR_LOCK = threading.Lock()
 
 def log_ticker_error(app, tenant_id: str, source: str, exc: Exception):
     """Registra su booking_error_logs un errore sollevato da un ticker in background
-    (WA-MORNING, WA-OP, ERR-SUMMARY, CRM-ERR-SUMMARY): cosi' entra nel riepilogo
+    (WA-MORNING, WA-OP, WA-SEND, ERR-SUMMARY, CRM-ERR-SUMMARY): cosi' entra nel riepilogo
     orario via email come ogni altro errore, invece di restare solo su stdout
     (i log Azure hanno retention ~90 minuti e nessuno li guarda in tempo reale).
 
@@ -238,27 +262,21 @@ def process_error_summary_tick(app, tenant_id: str, force_previous_hour: bool =
 
             nome_negozio = getattr(biz, 'business_name', None) or tenant_id
 
-            righe_html = "".join(
-                f"<tr>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{e.created_at.strftime('%H:%M:%S')}</td>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{escape(e.reason)}</td>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{escape(e.nome or '')} {escape(e.cognome or '')}</td>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{escape(e.telefono or '')}<br>{escape(e.email or '')}</td>"
-                f"</tr>"
-                for e in errori
+            html_content, plain_text = render_email(
+                'riepilogo_errori',
+                nome_negozio=nome_negozio,
+                window_start=window_start,
+                window_end=window_end,
+                errori=errori
             )
-            html_content = f"""
-            <h3>Riepilogo errori prenotazione online - {escape(nome_negozio)}</h3>
-            <p>Finestra: {window_start.strftime('%d/%m/%Y %H:%M')} - {window_end.strftime('%H:%M')} ({len(errori)} errori)</p>
-            <table style="border-collapse:collapse;width:100%;font-size:13px;">
-                <tr style="background:#f5f5f5;"><th>Ora</th><th>Motivo</th><th>Cliente</th><th>Contatti</th></tr>
-                {righe_html}
-            </table>
-            """
             invia_email_async(
                 to_email=ERROR_SUMMARY_EMAIL_TO,
                 subject=f"[{nome_negozio}] {len(errori)} errori prenotazione nell'ultima ora",
-                html_content=html_content
+                html_content=html_content,
+                plain_text=plain_text,
+                tenant_id=tenant_id,
+                session=session,
+                priorita=PRIORITA_NOTIFICA
             )
             print(f"[ERR-SUMMARY][{tenant_id}] riepilogo inviato: {len(errori)} errori tra {window_start} e {window_end}")
         except Exception as e:
@@ -343,34 +361,30 @@ def process_crm_error_summary_tick(app, tenant_id: str):
                     c.id: c for c in session.query(Client).filter(Client.id.in_(client_ids)).all()
                 }
 
-            def _client_cell(err):
-                c = clienti_by_id.get(err.client_id)
-                if not c:
-                    return ''
-                nome = f"{c.cliente_nome or ''} {c.cliente_cognome or ''}".strip()
-                contatti = " / ".join(x for x in [c.cliente_cellulare, c.cliente_email] if x)
-                return f"{escape(nome)}<br>{escape(contatti)}" if contatti else escape(nome)
-
-            righe_html = "".join(
-                f"<tr>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{e.created_at.strftime('%d/%m %H:%M:%S')}</td>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{escape(e.reason)}</td>"
-                f"<td style='padding:6px 10px;border-bottom:1px solid #eee;'>{_client_cell(e)}</td>"
-                f"</tr>"
-                for e in errori
+            righe = []
+            for e in errori:
+                c = clienti_by_id.get(e.client_id)
+                righe.append({
+                    "quando": e.created_at.strftime('%d/%m %H:%M:%S'),
+                    "motivo": e.reason,
+                    "cliente": f"{c.cliente_nome or ''} {c.cliente_cognome or ''}".strip() if c else '',
+                    "contatti": " / ".join(x for x in [c.cliente_cellulare, c.cliente_email] if x) if c else '',
+                })
+            html_content, plain_text = render_email(
+                'riepilogo_errori_crm',
+                nome_negozio=nome_negozio,
+                window_start=window_start,
+                window_end=window_end,
+                errori=righe
             )
-            html_content = f"""
-            <h3>Riepilogo errori CRM/gestionale - {escape(nome_negozio)}</h3>
-            <p>Finestra: {window_start.strftime('%d/%m/%Y %H:%M')} - {window_end.strftime('%d/%m/%Y %H:%M')} ({len(errori)} errori)</p>
-            <table style="border-collapse:collapse;width:100%;font-size:13px;">
-                <tr style="background:#f5f5f5;"><th>Data/Ora</th><th>Motivo</th><th>Cliente</th></tr>
-                {righe_html}
-            </table>
-            """
             invia_email_async(
                 to_email=ERROR_SUMMARY_EMAIL_TO,
                 subject=f"[{nome_negozio}] {len(errori)} errori CRM/gestionale",
-                html_content=html_content
+                html_content=html_content,
+                plain_text=plain_text,
+                tenant_id=tenant_id,
+                session=session,
+                priorita=PRIORITA_NOTIFICA
             )
             print(f"[CRM-ERR-SUMMARY][{tenant_id}] riepilogo inviato: {len(errori)} errori tra {window_start} e {window_end}")
         except Exception as e:
@@ -385,6 +399,83 @@ def process_crm_error_summary_tick(app, tenant_id: str):
                 except Exception:
                     pass
 
+def process_admin_digest_tick(app, tenant_id: str):
+    """Svuota il buffer delle notifiche admin (BusinessInfo.admin_digest_enabled):
+    quando la notifica più vecchia in attesa ha almeno admin_digest_minutes minuti,
+    tutte quelle in attesa partono in UNA sola email. Le righe vengono eliminate
+    nella stessa transazione in cui l'email entra nell'outbox; su PostgreSQL sono
+    prese con SKIP LOCKED, quindi più processi non mandano lo stesso digest.
+    Se nel frattempo il digest è stato disattivato, il buffer si svuota subito."""
+    SessionFactory = app.config['DB_SESSIONS'][tenant_id]
+    session = SessionFactory()
+    try:
+        query = session.query(AdminNotificationBuffer).order_by(
+            AdminNotificationBuffer.created_at, AdminNotificationBuffer.id
+        )
+        if session.get_bind().dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        notifiche = query.all()
+        if not notifiche:
+            session.rollback()
+            return
+
+        biz = session.query(BusinessInfo).first()
+        now = _now_rome()
+        prima = to_rome(notifiche[0].created_at)
+        if biz is not None and biz.admin_digest_enabled:
+            finestra = timedelta(minutes=max(1, biz.admin_digest_minutes or 5))
+            if now - prima < finestra:
+                session.rollback()
+                return  # finestra ancora aperta
+
+        admin_email = getattr(biz, 'email', None)
+        for n in notifiche:
+            session.delete(n)
+        if not admin_email:
+            session.commit()
+            print(f"[ADMIN-DIGEST][{tenant_id}] nessuna email admin: scartate {len(notifiche)} notifiche")
+            return
+
+        company_name = getattr(biz, 'business_name', None) or "Tosca Gestionale"
+        voci = [
+            dict(n.payload or {}, kind=n.kind, ricevuta=to_rome(n.created_at).strftime('%H:%M'))
+            for n in notifiche
+        ]
+        n_annullamenti = sum(1 for v in voci if v["kind"] == 'annullamento')
+        n_prenotazioni = len(voci) - n_annullamenti
+        html_content, plain_text = render_email(
+            'admin_digest',
+            company_name=company_name,
+            notifiche=voci,
+            n_prenotazioni=n_prenotazioni,
+            n_annullamenti=n_annullamenti,
+            dalle=prima.strftime('%H:%M'),
+            alle=now.strftime('%H:%M')
+        )
+        # accoda_email fa il commit: eliminazione dal buffer + email in outbox insieme
+        invia_email_async(
+            to_email=admin_email,
+            subject=f"{company_name} - Booking online: {n_prenotazioni} nuove prenotazioni, {n_annullamenti} annullamenti",
+            html_content=html_content,
+            plain_text=plain_text,
+            tenant_id=tenant_id,
+            session=session,
+            priorita=PRIORITA_NOTIFICA
+        )
+        print(f"[ADMIN-DIGEST][{tenant_id}] digest accodato con {len(voci)} notifiche")
+    except Exception as e:
+        session.rollback()
+        print(f"[ADMIN-DIGEST][{tenant_id}] error: {repr(e)}")
+        raise
+    finally:
+        try:
+            session.close()
+        finally:
+            try:
+                SessionFactory.remove()
+            except Exception:
+                pass
+
 def _wa_dbg(tenant_id, msg):
     if WA_MORNING_DEBUG:
         print(f"[WA-MORNING][{tenant_id}] {msg}")
@@ -401,117 +492,83 @@ def _tenant_env_prefix(tenant_id: str) -> str:
     digits = ''.join(ch for ch in raw if ch.isdigit())
     return f'T{digits}' if digits else raw
 
-def invia_email_azure(to_email, subject, html_content, from_email=None, plain_text=None):
-    connection_string = os.environ.get('AZURE_EMAIL_CONNECTION_STRING')
-    if not connection_string:
-        print("ERROR: AZURE_EMAIL_CONNECTION_STRING not set")
-        return False
-    sender = (from_email or os.environ.get('AZURE_EMAIL_SENDER') or "").strip()
-    if not sender:
-        print("ERROR: AZURE_EMAIL_SENDER not set and from_email not provided")
-        return False
-    client = EmailClient.from_connection_string(connection_string)
-    content = {"subject": subject, "html": html_content}
-    content["plainText"] = plain_text or _html_to_text(html_content)
-    
-    # Aggiungi List-Unsubscribe header per ridurre spam complaints
-    sender_domain = sender.split('@')[1] if '@' in sender else 'example.com'
-    unsubscribe_url = f"https://{sender_domain}/unsubscribe"
-    unsubscribe_mailto = f"mailto:{sender}?subject=Unsubscribe"
-    
-    message = {
-        "senderAddress": sender,
-        "recipients": {"to": [{"address": to_email}]},
-        "content": content,
-        "headers": {
-            "List-Unsubscribe": f"<{unsubscribe_url}>, <{unsubscribe_mailto}>",
-            "List-Unsubscribe-Post": "List-Unsubscribe=One-Click"
-        }
-    }
-    poller = client.begin_send(message)
+def invia_email_azure(to_email, subject, html_content, plain_text, from_email=None):
+    """Invio immediato e sincrono (senza outbox); ritorna True/False.
+    plain_text è obbligatorio: viene dal .txt del template (render_email)."""
     try:
-        result = poller.result()
-        print(f"[EMAIL] sent id={getattr(result,'message_id',None)} sender={sender}")
-        return getattr(result, "status", "Succeeded") == "Succeeded"
+        message_id = trasporto_email().invia_email(
+            to_email, subject, html_content,
+            plain_text=plain_text, from_email=from_email
+        )
+        print(f"[EMAIL] sent id={message_id}")
+        return True
     except Exception as e:
         print(f"[EMAIL] ERROR result: {repr(e)}")
         return False
 
-def invia_email_async(to_email, subject, html_content, from_email=None, plain_text=None, delay_seconds=0):
+def invia_email_async(to_email, subject, html_content, plain_text, from_email=None, delay_seconds=0,
+                      tenant_id=None, session=None, priorita=PRIORITA_CONFERMA):
     """
-    Invio email in background thread separato (parallelo).
-    Versione originale che funzionava perfettamente.
-    
+    Accoda l'email nell'outbox persistente del tenant (tabella email_outbox): la
+    spedisce il pool di worker di appl/email_outbox.py, con retry e backoff.
+
     Args:
-        delay_seconds: ritardo in secondi prima dell'invio (default: 0, invio immediato)
+        plain_text: parte di solo testo, obbligatoria (il .txt del template di render_email)
+        delay_seconds: non inviare prima di N secondi (not_before, nessun thread in attesa)
+        tenant_id, session: di default quelli della richiesta corrente; i job in
+            background passano i propri.
+        priorita: PRIORITA_OTP (codici), PRIORITA_CONFERMA (cliente), PRIORITA_NOTIFICA
+            (admin e riepiloghi): ordine di invio quando il rate limit di Azure stringe.
     """
-    def send_email():
-        try:
-            # Applica delay se richiesto (per rate limiting Azure)
-            if delay_seconds > 0:
-                print(f"[EMAIL-ASYNC] Waiting {delay_seconds}s before sending to={to_email}")
-                import time
-                time.sleep(delay_seconds)
-            
-            connection_string = os.environ.get('AZURE_EMAIL_CONNECTION_STRING')
-            if not connection_string:
-                print("ERROR: AZURE_EMAIL_CONNECTION_STRING not set")
-                return
-            sender = (from_email or os.environ.get('AZURE_EMAIL_SENDER') or "").strip()
-            if not sender:
-                print("ERROR: AZURE_EMAIL_SENDER not set and from_email not provided")
-                return
-            
-            print(f"[EMAIL-ASYNC] Starting send to={to_email} subject='{subject[:50]}...'")
-            
-            client = EmailClient.from_connection_string(connection_string)
-            content = {"subject": subject, "html": html_content}
-            content["plainText"] = plain_text or _html_to_text(html_content)
-            
-            # List-Unsubscribe headers (mantieni questa parte nuova)
-            sender_domain = sender.split('@')[1] if '@' in sender else 'example.com'
-            unsubscribe_url = f"https://{sender_domain}/unsubscribe"
-            unsubscribe_mailto = f"mailto:{sender}?subject=Unsubscribe"
-            
-            message = {
-                "senderAddress": sender,
-                "recipients": {"to": [{"address": to_email}]},
-                "content": content,
-                "headers": {
-                    "List-Unsubscribe": f"<{unsubscribe_url}>, <{unsubscribe_mailto}>",
-                    "List-Unsubscribe-Post": "List-Unsubscribe=One-Click"
-                }
-            }
-            
-            poller = client.begin_send(message)
-            result = poller.result()
-            
-            status = getattr(result, 'status', 'Unknown')
-            message_id = getattr(result, 'message_id', None)
-            print(f"[EMAIL-ASYNC] SUCCESS to={to_email} status={status} id={message_id}")
-            
-        except Exception as e:
-            # Log dettagliato degli errori Azure (429, 409, ecc.)
-            error_type = type(e).__name__
-            error_msg = str(e)
-            
-            # Estrai codice di stato HTTP se presente
-            status_code = getattr(e, 'status_code', None)
-            error_code = getattr(e, 'error_code', None)
-            
-            if status_code:
-                print(f"[EMAIL-ASYNC] FAILED to={to_email} HTTP_{status_code} error_code={error_code} type={error_type} msg={error_msg}")
-            else:
-                print(f"[EMAIL-ASYNC] FAILED to={to_email} type={error_type} msg={error_msg}")
-            
-            # Log completo per debug (se necessario)
-            import traceback
-            print(f"[EMAIL-ASYNC] Traceback: {traceback.format_exc()}")
-    
-    thread = threading.Thread(target=send_email, daemon=True)
-    thread.start()
+    tenant_id = tenant_id or g.tenant_id
+    session = session or g.db_session
+    email_id = accoda_email(
+        session, to_email, subject, html_content,
+        plain_text=plain_text,
+        from_email=from_email,
+        delay_seconds=delay_seconds,
+        priorita=priorita
+    )
+    print(f"[EMAIL-OUTBOX][{tenant_id}] accodata id={email_id} to={to_email} "
+          f"subject='{subject[:50]}...' ritardo={delay_seconds}s priorita={priorita}")
     return True
 
+def _notifica_admin(tenant_id, business_info, kind, subject, template, contesto, contatti):
+    """
+    Notifica all'admin di una prenotazione o di un annullamento: subito nell'outbox
+    (priorità bassa) oppure, se il tenant ha il digest attivo, nel buffer che
+    process_admin_digest_tick svuota con UNA email ogni admin_digest_minutes.
+    """
+    admin_email = getattr(business_info, 'email', None)
+    if not admin_email:
+        return
+    if getattr(business_info, 'admin_digest_enabled', False):
+        g.db_session.add(AdminNotificationBuffer(
+            created_at=datetime.now(timezone.utc),
+            kind=kind,
+            payload={
+                "nome": contesto.get("nome"),
+                "cognome": contesto.get("cognome"),
+                "email": contatti.get("email"),
+                "telefono": contatti.get("telefono"),
+                "appuntamenti": contesto.get("appuntamenti", []),
+                "totale_durata": contesto.get("totale_durata"),
+                "totale_prezzo": contesto.get("totale_prezzo"),
+            }
+        ))
+        g.db_session.commit()
+        print(f"[ADMIN-DIGEST][{tenant_id}] notifica '{kind}' messa nel buffer")
+        return
+    html_content, plain_text = render_email(template, **contesto)
+    invia_email_async(
+        to_email=admin_email,
+        subject=subject,
+        html_content=html_content,
+        plain_text=plain_text,
+        from_email=None,
+        priorita=PRIORITA_NOTIFICA
+    )
+
 def to_rome(dt):
     if dt is None:
         return None
@@ -519,124 +576,6 @@ def to_rome(dt):
         dt = dt.replace(tzinfo=timezone.utc)
     return dt.astimezone(pytz_timezone('Europe/Rome'))
 
-def is_calendar_closed(op_id, inizio, fine, turni_per_operatore, all_apps):
-    """
-    Restituisce True se la cella (intervallo orario per operatore) NON è selezionabile per prenotazioni.
-    Controlla:
-    - fuori turno
-    - blocchi OFF globali o per operatore
-    - sovrapposizione appuntamenti
-    """
-    def to_naive(dt):
-        if dt is not None and getattr(dt, "tzinfo", None) is not None:
-            return dt.replace(tzinfo=None)
-        return dt
-
-    inizio = to_naive(inizio)
-    fine = to_naive(fine)
-    shifts = turni_per_operatore.get(op_id, [])
-    # Fuori turno
-    if not any(s <= inizio.time() and fine.time() <= e for s, e in shifts):
-        return True
-    for a in all_apps:
-        if a.is_cancelled_by_client:  # Salta quelli soft-deleted
-            continue
-        a_start = to_naive(a.start_time)
-        a_end = to_naive(a.start_time + timedelta(minutes=a._duration))
-        # Blocco OFF globale
-        if a.operator_id is None and a.note and "OFF" in a.note:
-            if a_start < fine and a_end > inizio:
-                return True
-        # Blocco OFF per operatore
-        if a.operator_id == op_id and a.note and "OFF" in a.note:
-            if a_start < fine and a_end > inizio:
-                return True
-        # Sovrapposizione appuntamenti
-        if a.operator_id == op_id and not (a.note and "OFF" in a.note):
-            if a_start < fine and a_end > inizio:
-                return True
-    return False
-
-def scegli_operatori_automatici(servizi_ids, data_str, ora_str, operatori_possibili, turni_per_operatore, all_apps, operatori_preferiti_ids=[]):
-    """
-    Restituisce una lista di operatori assegnati (uno per ogni servizio), seguendo le priorità:
-    1. Tutti i servizi con lo stesso operatore (priorità alta).
-    2. Se non possibile, assegnazione a cascata cercando di raggruppare il maggior numero di servizi
-       sullo stesso operatore, preferendo gli operatori_preferiti_ids.
-    3. Se neanche a cascata è possibile assegnare tutti i servizi, restituisce [None] * len(servizi_ids).
-    """
-
-    servizi_objs = g.db_session.query(Service).filter(Service.id.in_(servizi_ids)).all()
-    servizi_map = {s.id: s for s in servizi_objs}
-    servizi_operatori_abilitati = {s.id: [op.id for op in s.operators] for s in servizi_objs}
-    servizi_durate = [servizi_map[sid].servizio_durata or 30 for sid in servizi_ids]
-
-    # Filtra gli operatori che sono almeno abilitati per uno dei servizi richiesti
-    # e ordina gli operatori preferiti per primi
-    operatori_rilevanti = sorted(
-        [op for op in operatori_possibili if any(op.id in servizi_operatori_abilitati[sid] for sid in servizi_ids)],
-        key=lambda op: (op.id not in operatori_preferiti_ids, op.user_nome) # Metti i preferiti per primi
-    )
-
-    start_time = datetime.strptime(f"{data_str} {ora_str}", "%Y-%m-%d %H:%M")
-
-    # --- 1. Prova tutti con lo stesso operatore (PRIORITÀ ALTA) ---
-    # Inizia dagli operatori preferiti per questa ricerca
-    for op in operatori_rilevanti:
-        # Se l'operatore non è abilitato per *tutti* i servizi, salta
-        if not all(op.id in servizi_operatori_abilitati.get(sid, []) for sid in servizi_ids):
-            continue
-
-        slot_corrente_temp = start_time
-        ok = True
-        for durata_servizio in servizi_durate:
-            inizio_temp = slot_corrente_temp
-            fine_temp = slot_corrente_temp + timedelta(minutes=durata_servizio)
-            
-            if is_calendar_closed(op.id, inizio_temp, fine_temp, turni_per_operatore, all_apps):
-                ok = False
-                break
-            slot_corrente_temp = fine_temp # Aggiorna lo slot per il servizio successivo
-        
-        if ok:
-            # Trovato un singolo operatore per tutti i servizi! 🎉
-            return [op.id] * len(servizi_ids)
-
-    # --- 2. Assegnazione a cascata con raggruppamento e preferenza operatori (PRIORITÀ SECONDARIA) ---
-    operatori_assegnati = []
-    slot_corrente = start_time
-    
-    for i, servizio_id in enumerate(servizi_ids):
-        durata_servizio = servizi_durate[i]
-        inizio_servizio = slot_corrente
-        fine_servizio = slot_corrente + timedelta(minutes=durata_servizio)
-        
-        found_operator_for_current_service = False
-        
-        # Prova prima con gli operatori preferiti che sono anche abilitati per questo servizio
-        for op in [o for o in operatori_rilevanti if o.id in servizi_operatori_abilitati.get(servizio_id, [])]:
-            if not is_calendar_closed(op.id, inizio_servizio, fine_servizio, turni_per_operatore, all_apps):
-                operatori_assegnati.append(op.id)
-                slot_corrente = fine_servizio
-                found_operator_for_current_service = True
-                break # Operatore trovato per questo servizio, passa al prossimo
-        
-        if not found_operator_for_current_service:
-            # Se nessuno degli operatori preferiti va bene, prova tutti gli altri operatori rilevanti
-            # (non preferiti, ma comunque abilitati e disponibili)
-            for op in [o for o in operatori_possibili if o.id in servizi_operatori_abilitati.get(servizio_id, []) and o.id not in operatori_preferiti_ids]:
-                if not is_calendar_closed(op.id, inizio_servizio, fine_servizio, turni_per_operatore, all_apps):
-                    operatori_assegnati.append(op.id)
-                    slot_corrente = fine_servizio
-                    found_operator_for_current_service = True
-                    break
-        
-        if not found_operator_for_current_service:
-            # Se non si trova nessun operatore per il servizio corrente, la catena fallisce
-            return [None] * len(servizi_ids) 
-            
-    return operatori_assegnati # Ritorna la lista completa di operatori assegnati
-
 booking_bp = Blueprint('booking', __name__)
 
 @booking_bp.route('/logo')
@@ -727,15 +666,12 @@ def search_servizi(tenant_id):
         for s in risultati
     ])
 
-@booking_bp.route('/orari', methods=['GET'])
-def orari_disponibili(tenant_id):
-    data_str = request.args.get('data')  # formato: YYYY-MM-DD
-    if not data_str:
-        return jsonify({"error": "Data non specificata"}), 400
-    servizi_raw = request.args.getlist('servizi[]')
+def _servizi_da_richiesta():
+    """Legge i servizi[] (JSON {servizio_id, operatore_id}) dalla query string.
+    Ritorna (servizi_items, servizi) con i soli Service visibili online."""
     servizi_items = []
     servizi_ids = []
-    for s in servizi_raw:
+    for s in request.args.getlist('servizi[]'):
         try:
             item = json.loads(s)
             sid = int(item["servizio_id"])
@@ -745,37 +681,33 @@ def orari_disponibili(tenant_id):
             continue
 
     if not servizi_ids:
-        return jsonify({"error": "Servizi non trovati"}), 404
+        return servizi_items, []
 
     servizi = g.db_session.query(Service).filter(
         Service.id.in_(servizi_ids),
         Service.is_deleted == False,
         Service.is_visible_online == True
     ).all()
-    if not servizi:
-        return jsonify({"error": "Servizi non trovati"}), 404
-    
-    servizi_operatori = {s.id: [op.id for op in s.operators] for s in servizi}
+    return servizi_items, servizi
 
-    data = datetime.strptime(data_str, "%Y-%m-%d").date()
-    business_info = g.db_session.query(BusinessInfo).first()
+
+def _orari_del_giorno(data, servizi_items, servizi, snapshot, business_info, operatore_id):
+    """
+    Orari prenotabili di UN giorno a partire dal suo DaySnapshot.
+    Ritorna (orari, operatori_assegnati, debug): stessa logica di /orari,
+    riusata da /orari-range per ogni giorno della finestra. Non dipende
+    dall'ora corrente (vedi _escludi_orari_passati), quindi si può mettere in cache.
+    """
     apertura = business_info.active_opening_time
     chiusura = business_info.active_closing_time
     closing_days = getattr(business_info, "closing_days_list", [])
 
-    orari = []
-    debug_info = []
-    now = datetime.now()  # naive Europe/Rome
-    slot_operatori = {}  # AGGIUNTA: dict ora -> lista operatori
-
     # Escludi giorni di chiusura
     if data.strftime('%A') in closing_days:
-        debug_info.append(f"Giorno {data.strftime('%A')} in closing_days: nessuno slot disponibile")
-        return jsonify({"orari_disponibili": [], "operatori_assegnati": {}, "debug": debug_info})
+        return [], {}, [f"Giorno {data.strftime('%A')} in closing_days: nessuno slot disponibile"]
 
-    # Carica tutti gli operatori disponibili e relativi turni
-    operatori_disponibili = g.db_session.query(Operator).filter_by(is_deleted=False, is_visible=True).all()
-    operatore_id = request.args.get('operatore_id')
+    servizi_operatori = snapshot.servizi_operatori
+    operatori_disponibili = snapshot.operatori
 
     # Preferenze per-servizio: raccogli gli ID scelti
     preferred_ids = set()
@@ -794,261 +726,489 @@ def orari_disponibili(tenant_id):
     if not has_per_service_prefs and operatore_id:
         operatori_disponibili = [op for op in operatori_disponibili if str(op.id) == str(operatore_id)]
 
-    turni_disponibili = g.db_session.query(OperatorShift).filter(
-        OperatorShift.operator_id.in_([o.id for o in operatori_disponibili]),
-        OperatorShift.shift_date == data
-    ).all()
-
     # Costruisce una mappa operator_id -> lista di (inizio, fine) turno per più turni
-    turni_per_operatore = {}
-    for op in operatori_disponibili:
-        op_turni = [
-            (
-                t.shift_start_time if isinstance(t.shift_start_time, time) else apertura,
-                t.shift_end_time if isinstance(t.shift_end_time, time) else chiusura
-            )
-            for t in turni_disponibili if t.operator_id == op.id
-        ]
-        if not op_turni:
-            op_turni = [(apertura, chiusura)]
-        op_turni = [
-            (max(start, apertura), min(end, chiusura))
-            for (start, end) in op_turni
-            if max(start, apertura) < min(end, chiusura)
-        ]
-        if op_turni:
-            turni_per_operatore[op.id] = op_turni
+    turni_per_operatore = snapshot.turni_per_operatore(apertura, chiusura, operatori_disponibili)
 
     # NUOVO: se ci sono preferenze per-servizio e dopo il filtro non ci sono turni
     # per le operatrici scelte, restituisci subito nessuna disponibilità.
     if has_per_service_prefs and not turni_per_operatore:
-        return jsonify({"orari_disponibili": [], "operatori_assegnati": {}, "debug": ["Nessun turno per le operatrici selezionate"]})
+        return [], {}, ["Nessun turno per le operatrici selezionate"]
 
-    appuntamenti = g.db_session.query(Appointment).filter(
-        Appointment.start_time >= datetime.combine(data, time.min),
-        Appointment.start_time < datetime.combine(data + timedelta(days=1), time.min),
-        Appointment.is_cancelled_by_client == False
-    ).all()
-    blocchi_off = g.db_session.query(Appointment).filter(
-        Appointment.start_time >= datetime.combine(data, time.min),
-        Appointment.start_time < datetime.combine(data + timedelta(days=1), time.min),
-        or_(
-            Appointment.note.ilike('%OFF%'),
-            Appointment.service_id == 9999
-        )
-    ).all()
-    for b in blocchi_off:
-        if b not in appuntamenti:
-            appuntamenti.append(b)
-
-    def to_naive(dt):
-        if dt is not None and getattr(dt, "tzinfo", None) is not None:
-            return dt.replace(tzinfo=None)
-        return dt
-
-    def operatore_disponibile(operator_id, inizio, fine):
-        turni = turni_per_operatore.get(operator_id, [])
-        if not any(start <= inizio.time() and fine.time() <= end for start, end in turni):
-            return False, "fuori turno"
-        for app in appuntamenti:
-            if app.operator_id is None and app.note and "OFF" in app.note:
-                app_start = to_naive(app.start_time)
-                app_end = to_naive(app_start + timedelta(minutes=app._duration))
-                if app_start < to_naive(fine) and app_end > to_naive(inizio):
-                    return False, "blocco OFF globale"
-            if str(app.operator_id) == str(operator_id):
-                app_start = to_naive(app.start_time)
-                app_end = to_naive(app_start + timedelta(minutes=app._duration))
-                if app_start < to_naive(fine) and app_end > to_naive(inizio):
-                    if app.note and "OFF" in app.note:
-                        return False, "blocco OFF"
-                    return False, "occupato"
-        return True, None
-
-    intervalli_tmp = []
-    for op_id, turni in turni_per_operatore.items():
-        for t in turni:
-            intervalli_tmp.append(t)
-    if not intervalli_tmp:
-        return jsonify({"orari_disponibili": [], "operatori_assegnati": {}, "debug": ["Nessun turno disponibile"]})
-    intervalli_tmp.sort()
-    intervalli = []
-    for intervallo in intervalli_tmp:
-        if not intervalli:
-            intervalli.append(intervallo)
-        else:
-            last_start, last_end = intervalli[-1]
-            curr_start, curr_end = intervallo
-            if curr_start <= last_end:
-                intervalli[-1] = (last_start, max(last_end, curr_end))
-            else:
-                intervalli.append((curr_start, curr_end))
-
-    durata_totale = sum([s.servizio_durata or 30 for s in servizi])
-    durata = timedelta(minutes=durata_totale)
-    slot_step = timedelta(minutes=15)
-
-    # Controlla se ci sono preferenze per operatrici DIVERSE
-    preferenze_operatori = [item.get("operatore_id") for item in servizi_items]
-    preferenze_univoche = set(p for p in preferenze_operatori if p is not None)
-    has_diverse_preferenze = len(preferenze_univoche) > 1
-
-    # NUOVO: disabilita il primo pass se esistono preferenze per-servizio
-    if not has_diverse_preferenze and not has_per_service_prefs:
-        for start, end in intervalli:
-            slot = datetime.combine(data, start)
-            fine = datetime.combine(data, end)
-            while slot + durata <= fine:
-                operatori_idonei = []
-                for op in operatori_disponibili:
-                    slot_corrente_temp = slot
-                    ok = True
-                    for servizio_item in servizi_items:
-                        servizio_id = int(servizio_item.get("servizio_id"))
-                        durata_servizio = next((s.servizio_durata or 30 for s in servizi if s.id == servizio_id), 30)
-                        durata_td = timedelta(minutes=durata_servizio)
-                        inizio = slot_corrente_temp
-                        fine_servizio = slot_corrente_temp + durata_td
-
-                        if op.id not in servizi_operatori[servizio_id]:
-                            ok = False
-                            break
-                        disponibile, _ = operatore_disponibile(op.id, inizio, fine_servizio)
-                        if not disponibile:
-                            ok = False
-                            break
-                        slot_corrente_temp = fine_servizio
-                    if ok:
-                        operatori_idonei.append(op)
-
-                if operatori_idonei:
-                    preferenze = [servizio_item.get("operatore_id") for servizio_item in servizi_items]
-                    preferenze = [int(x) for x in preferenze if x]
-                    op_scelto = None
-                    if preferenze:
-                        if all(x == preferenze[0] for x in preferenze) and any(op.id == preferenze[0] for op in operatori_idonei):
-                            op_scelto = next(op for op in operatori_idonei if op.id == preferenze[0])
-                    if not op_scelto:
-                        op_scelto = random.choice(operatori_idonei)
-
-                    operatori_catena = [op_scelto.id] * len(servizi_items)
-                    orari.append(slot.strftime("%H:%M"))
-                    slot_operatori[slot.strftime("%H:%M")] = operatori_catena
-                slot += slot_step
-
-    # Secondo pass (a cascata): eseguito SEMPRE
-    if servizi_items:
-        for start, end in intervalli:
-            slot = datetime.combine(data, start)
-            fine = datetime.combine(data, end)
-            while slot + durata <= fine:
-                slot_str = slot.strftime("%H:%M")
-                if slot_str in slot_operatori:
-                    slot += slot_step
-                    continue
-                assegnati = []
-                slot_corrente_temp = slot
-                fallito = False
-                for servizio_item in servizi_items:
-                    servizio_id = int(servizio_item.get("servizio_id"))
-                    durata_servizio = next(
-                        (s.servizio_durata or 30 for s in servizi if s.id == servizio_id),
-                        30
-                    )
-                    durata_td = timedelta(minutes=durata_servizio)
-                    inizio = slot_corrente_temp
-                    fine_servizio = slot_corrente_temp + durata_td
-
-                    prefer_op = servizio_item.get("operatore_id")
-
-                    # Costruzione candidati
-                    if prefer_op:
-                        try:
-                            prefer_op_int = int(prefer_op)
-                        except Exception:
-                            prefer_op_int = None
-
-                        if (
-                            prefer_op_int is not None
-                            and prefer_op_int in servizi_operatori.get(servizio_id, [])
-                        ):
-                            candidate_ops = [op for op in operatori_disponibili if op.id == prefer_op_int]
-                        else:
-                            fallito = True
-                            break
-                    else:
-                        # Nessuna operatrice scelta:
-                        # 1) prova PRIMA sulla stessa colonna dell'operatrice assegnata al servizio precedente (se esiste),
-                        # 2) se non disponibile, prova su tutte le altre colonne abilitate.
-                        candidate_ops = [op for op in operatori_disponibili if op.id in servizi_operatori.get(servizio_id, [])]
-
-                        # Priorità stessa colonna: se esiste assegnazione precedente
-                        if assegnati:
-                            prev_op_id = assegnati[-1]
-                            # se la precedente colonna è abilitata per questo servizio, mettila davanti
-                            if prev_op_id in servizi_operatori.get(servizio_id, []):
-                                candidate_ops.sort(key=lambda op: (op.id != prev_op_id, op.user_nome))
-
-                    if not candidate_ops:
-                        fallito = True
-                        break
-
-                    scelto = None
-                    for op in candidate_ops:
-                        disponibile, _ = operatore_disponibile(op.id, inizio, fine_servizio)
-                        if disponibile:
-                            scelto = op
-                            break
-
-                    if not scelto:
-                        fallito = True
-                        break
-
-                    assegnati.append(scelto.id)
-                    slot_corrente_temp = fine_servizio
-
-                if not fallito and len(assegnati) == len(servizi_items):
-                    # Verifica coerenza: dove c'è preferenza, l'ID deve combaciare
-                    for idx, servizio_item in enumerate(servizi_items):
-                        prefer_op = servizio_item.get("operatore_id")
-                        if prefer_op:
-                            try:
-                                prefer_op_int = int(prefer_op)
-                            except Exception:
-                                prefer_op_int = None
-                            if prefer_op_int is None or assegnati[idx] != prefer_op_int:
-                                fallito = True
-                                break
-
-                if not fallito and len(assegnati) == len(servizi_items):
-                    orari.append(slot_str)
-                    slot_operatori[slot_str] = assegnati
-
-                slot += slot_step
-                
-    orari = sorted(list(set(orari)))
+    if not turni_per_operatore:
+        return [], {}, ["Nessun turno disponibile"]
 
-    now = datetime.now(pytz_timezone('Europe/Rome')).replace(second=0, microsecond=0)
+    # Tutti gli slot del giorno valutati in blocco sulla matrice di occupazione
+    orari, slot_operatori = calcola_slot_disponibili(
+        servizi_items, servizi, servizi_operatori, operatori_disponibili,
+        turni_per_operatore, snapshot.indice, capacita=snapshot.capacita,
+        minuti_prenotati=snapshot.minuti_prenotati
+    )
+
+    debug_info = []
+    for s in servizi:
+        fasce = snapshot.capacita.fasce_sature(s.id)
+        if fasce:
+            debug_info.append(
+                f"Risorsa '{snapshot.capacita.nome_risorsa(s.id)}' al completo: {', '.join(fasce)}"
+            )
+    return orari, slot_operatori, debug_info
+
+
+def _escludi_orari_passati(data, orari, slot_operatori, now):
+    """Giorni passati: nessuno slot. Oggi: solo gli orari non ancora trascorsi."""
+    if data < now.date():
+        return [], {}
     if data == now.date():
         orari = [
             o for o in orari
             if datetime.combine(data, datetime.strptime(o, "%H:%M").time()) >= now.replace(tzinfo=None)
         ]
         slot_operatori = {o: slot_operatori[o] for o in orari}
+    return orari, slot_operatori
+
 
+def _calcola_orari(session, data, servizi_items, operatore_id, escludi_hold=None):
+    """
+    Calcolo completo di un giorno con la sessione data (richiesta o thread di refresh).
+    escludi_hold: token degli hold da non contare come occupati (quelli del chiamante).
+    Ritorna (orari, operatori_assegnati, debug) oppure None se i servizi non esistono.
+    """
+    servizi_ids = [int(item["servizio_id"]) for item in servizi_items]
+    servizi = session.query(Service).filter(
+        Service.id.in_(servizi_ids),
+        Service.is_deleted == False,
+        Service.is_visible_online == True
+    ).all()
+    if not servizi:
+        return None
+
+    business_info = session.query(BusinessInfo).first()
+    closing_days = getattr(business_info, "closing_days_list", [])
+    if data.strftime('%A') in closing_days:
+        snapshot = None
+    else:
+        # Carica in un colpo solo operatori, turni, abilitazioni e appuntamenti del giorno
+        snapshot = DaySnapshot.load(session, data, [s.id for s in servizi], escludi_hold=escludi_hold)
+    return _orari_del_giorno(data, servizi_items, servizi, snapshot, business_info, operatore_id)
+
+
+def _hold_sessione_attivo(data):
+    """Token dell'hold della sessione se ha righe attive nel giorno, altrimenti None."""
+    token = session.get('slot_hold_token')
+    if not token:
+        return None
+    attivo = g.db_session.query(SlotHold.id).filter(
+        SlotHold.token == token,
+        SlotHold.data == data,
+        SlotHold.expires_at > datetime.now(timezone.utc)
+    ).first()
+    return token if attivo else None
+
+
+def _orari_con_cache(tenant_id, data, servizi_items, operatore_id):
+    """
+    /orari passando dalla cache: la versione del giorno viene sempre verificata
+    (una query leggera); voce fresca -> servita, voce "stale" -> servita e
+    ricalcolata in background, altrimenti ricalcolo in linea.
+    Se la sessione ha un hold attivo nel giorno il risultato dipende da chi
+    chiede (il proprio hold non occupa lo slot): calcolo diretto, fuori cache.
+    """
+    hold_token = _hold_sessione_attivo(data)
+    if hold_token:
+        return _calcola_orari(g.db_session, data, servizi_items, operatore_id, escludi_hold=hold_token)
+    chiave = chiave_orari(tenant_id, data, servizi_items, operatore_id)
+    versione = versione_giorno(g.db_session, data)
+    voce = _AVAIL_CACHE.get(chiave)
+    if voce is not None and voce.versione == versione:
+        eta = voce.eta()
+        if eta < _AVAIL_CACHE.ttl:
+            return voce.valore
+        if eta < _AVAIL_CACHE.max_stale:
+            if _AVAIL_CACHE.inizia_refresh(chiave):
+                threading.Thread(
+                    target=_refresh_orari_cache,
+                    args=(current_app._get_current_object(), tenant_id, chiave, data, servizi_items, operatore_id),
+                    daemon=True
+                ).start()
+            return voce.valore
+
+    # Richieste identiche contemporanee (stessa chiave E stessa versione): calcola
+    # solo la prima, le altre ne attendono il risultato.
+    def calcola():
+        valore = _calcola_orari(g.db_session, data, servizi_items, operatore_id)
+        if valore is not None:
+            _AVAIL_CACHE.put(chiave, versione, valore)
+        return valore
+    return _ORARI_FLIGHT.esegui((chiave, versione), calcola)
+
+
+def _refresh_orari_cache(app, tenant_id, chiave, data, servizi_items, operatore_id):
+    """Ricalcolo in background di una voce stale, con una sessione propria."""
+    try:
+        with app.app_context():
+            SessionFactory = app.config['DB_SESSIONS'][tenant_id]
+            session = SessionFactory()
+            try:
+                versione = versione_giorno(session, data)
+                valore = _calcola_orari(session, data, servizi_items, operatore_id)
+                if valore is not None:
+                    _AVAIL_CACHE.put(chiave, versione, valore)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                print(f"[ORARI-CACHE][{tenant_id}] refresh fallito per {data}: {repr(e)}")
+            finally:
+                try:
+                    session.close()
+                finally:
+                    try:
+                        SessionFactory.remove()
+                    except Exception:
+                        pass
+    finally:
+        _AVAIL_CACHE.fine_refresh(chiave)
+
+
+@booking_bp.route('/orari', methods=['GET'])
+def orari_disponibili(tenant_id):
+    data_str = request.args.get('data')  # formato: YYYY-MM-DD
+    if not data_str:
+        return jsonify({"error": "Data non specificata"}), 400
+
+    servizi_items = []
+    for s in request.args.getlist('servizi[]'):
+        try:
+            item = json.loads(s)
+            int(item["servizio_id"])
+            servizi_items.append(item)
+        except Exception:
+            continue
+    if not servizi_items:
+        return jsonify({"error": "Servizi non trovati"}), 404
+
+    data = datetime.strptime(data_str, "%Y-%m-%d").date()
+    now = datetime.now(pytz_timezone('Europe/Rome')).replace(second=0, microsecond=0)
     if data < now.date():
         return jsonify({
             "orari_disponibili": [],
             "operatori_assegnati": {},
-            "debug": debug_info + ["Data selezionata già passata"]
+            "debug": ["Data selezionata già passata"]
         })
 
+    risultato = _orari_con_cache(tenant_id, data, servizi_items, request.args.get('operatore_id'))
+    if risultato is None:
+        return jsonify({"error": "Servizi non trovati"}), 404
+    orari, slot_operatori, debug_info = risultato
+    orari, slot_operatori = _escludi_orari_passati(data, orari, slot_operatori, now)
     return jsonify({
         "orari_disponibili": orari,
         "operatori_assegnati": slot_operatori,
         "debug": debug_info
     })
 
+
+@booking_bp.route('/orari-stats', methods=['GET'])
+def orari_stats(tenant_id):
+    """Contatori (per processo) di cache e coalescenza di /orari."""
+    return jsonify({
+        "cache": _AVAIL_CACHE.statistiche(),
+        "coalescenza": _ORARI_FLIGHT.statistiche()
+    })
+
+
+@booking_bp.route('/email-stats', methods=['GET'])
+def email_stats(tenant_id):
+    """Profondità della coda email per priorità, attese di invio e gettoni del rate limit."""
+    return jsonify(statistiche_outbox(g.db_session))
+
+
+@booking_bp.route('/orari-range', methods=['GET'])
+def orari_range(tenant_id):
+    """
+    Disponibilità di più giorni in una sola chiamata (?from=YYYY-MM-DD&to=YYYY-MM-DD
+    più gli stessi servizi[]/operatore_id di /orari). Turni e appuntamenti della
+    finestra sono caricati con una query ciascuno; per ogni giorno restituisce il
+    numero di orari liberi e, con dettaglio=1, anche orari e operatori assegnati.
+    """
+    try:
+        data_da = datetime.strptime(request.args.get('from', ''), "%Y-%m-%d").date()
+        data_a = datetime.strptime(request.args.get('to', ''), "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "Intervallo di date non valido"}), 400
+    if data_a < data_da:
+        return jsonify({"error": "Intervallo di date non valido"}), 400
+    if (data_a - data_da).days + 1 > ORARI_RANGE_MAX_GIORNI:
+        return jsonify({"error": f"Intervallo massimo {ORARI_RANGE_MAX_GIORNI} giorni"}), 400
+
+    servizi_items, servizi = _servizi_da_richiesta()
+    if not servizi:
+        return jsonify({"error": "Servizi non trovati"}), 404
+
+    dettaglio = request.args.get('dettaglio') in ('1', 'true')
+    operatore_id = request.args.get('operatore_id')
+    business_info = g.db_session.query(BusinessInfo).first()
+    now = datetime.now(pytz_timezone('Europe/Rome')).replace(second=0, microsecond=0)
+
+    snapshots = DaySnapshot.load_range(g.db_session, data_da, data_a, [s.id for s in servizi],
+                                       escludi_hold=session.get('slot_hold_token'))
+    giorni = {}
+    for data, snapshot in snapshots.items():
+        orari, slot_operatori, _ = _orari_del_giorno(
+            data, servizi_items, servizi, snapshot, business_info, operatore_id
+        )
+        orari, slot_operatori = _escludi_orari_passati(data, orari, slot_operatori, now)
+        giorno = {"liberi": len(orari)}
+        if dettaglio:
+            giorno["orari_disponibili"] = orari
+            giorno["operatori_assegnati"] = slot_operatori
+        giorni[data.isoformat()] = giorno
+
+    return jsonify({"giorni": giorni})
+
+@booking_bp.route('/prossimo-disponibile', methods=['GET'])
+def prossimo_disponibile(tenant_id):
+    """
+    Primo orario prenotabile per la catena di servizi (stessi servizi[]/operatore_id
+    di /orari), cercando in avanti da ?da= (default oggi) per ?giorni= giorni.
+    I dati vengono caricati a blocchi di una settimana, saltando i giorni di
+    chiusura, e la ricerca si ferma al primo giorno utile. I giorni senza turni
+    registrati NON vengono saltati: come in /orari, un operatore senza turni
+    lavora per tutto l'orario di apertura (DaySnapshot.turni_per_operatore).
+    """
+    servizi_items, servizi = _servizi_da_richiesta()
+    if not servizi:
+        return jsonify({"error": "Servizi non trovati"}), 404
+
+    now = datetime.now(pytz_timezone('Europe/Rome')).replace(second=0, microsecond=0)
+    try:
+        data_da = datetime.strptime(request.args['da'], "%Y-%m-%d").date() if request.args.get('da') else now.date()
+        orizzonte = int(request.args.get('giorni', PROSSIMO_DISPONIBILE_GIORNI))
+    except ValueError:
+        return jsonify({"error": "Parametri non validi"}), 400
+    data_da = max(data_da, now.date())
+    orizzonte = max(1, min(orizzonte, PROSSIMO_DISPONIBILE_MAX_GIORNI))
+    data_limite = data_da + timedelta(days=orizzonte - 1)
+
+    operatore_id = request.args.get('operatore_id')
+    business_info = g.db_session.query(BusinessInfo).first()
+    closing_days = getattr(business_info, "closing_days_list", [])
+    servizi_ids = [s.id for s in servizi]
+
+    inizio_blocco = data_da
+    while inizio_blocco <= data_limite:
+        fine_blocco = min(inizio_blocco + timedelta(days=PROSSIMO_DISPONIBILE_BATCH - 1), data_limite)
+        giorni_aperti = [
+            inizio_blocco + timedelta(days=i)
+            for i in range((fine_blocco - inizio_blocco).days + 1)
+            if (inizio_blocco + timedelta(days=i)).strftime('%A') not in closing_days
+        ]
+        if giorni_aperti:
+            snapshots = DaySnapshot.load_range(
+                g.db_session, inizio_blocco, fine_blocco, servizi_ids,
+                giorni=giorni_aperti, escludi_hold=session.get('slot_hold_token')
+            )
+            for data, snapshot in snapshots.items():
+                orari, slot_operatori, _ = _orari_del_giorno(
+                    data, servizi_items, servizi, snapshot, business_info, operatore_id
+                )
+                orari, slot_operatori = _escludi_orari_passati(data, orari, slot_operatori, now)
+                if orari:
+                    return jsonify({
+                        "trovato": True,
+                        "data": data.isoformat(),
+                        "ora": orari[0],
+                        "operatori": slot_operatori[orari[0]],
+                        "orari_disponibili": orari,
+                        "operatori_assegnati": slot_operatori
+                    })
+        inizio_blocco = fine_blocco + timedelta(days=1)
+
+    return jsonify({"trovato": False, "giorni_cercati": orizzonte})
+
+def _verifica_catena(snapshot, business_info, servizi, servizi_map, operatori_catena, slot_inizio):
+    """
+    Ricontrolla lato server la catena scelta su uno snapshot fresco del giorno:
+    operatore abilitato, servizio dentro UN turno, nessuna sovrapposizione
+    (appuntamenti e blocchi OFF) e posto nella risorsa condivisa.
+    Ritorna None se è tutto ok, altrimenti (idx, motivo per il log, messaggio, status).
+    """
+    turni_per_operatore = snapshot.turni_per_operatore(
+        business_info.active_opening_time, business_info.active_closing_time
+    )
+    inizio = minuti(slot_inizio)
+    for idx, servizio_item in enumerate(servizi):
+        servizio_id = int(servizio_item.get("servizio_id"))
+        operatore_id = operatori_catena[idx]
+        fine = inizio + (servizi_map[servizio_id].servizio_durata or 30)
+
+        if operatore_id not in snapshot.servizi_operatori.get(servizio_id, []):
+            return (idx, "Operatore non abilitato per il servizio (slot non piu' disponibile)",
+                    "La sequenza di operatori richiesta non è più disponibile per questo slot. Ricarica la pagina e riprova.", 400)
+        if not in_turno(turni_per_operatore.get(operatore_id, []), inizio, fine):
+            return (idx, "Servizio fuori turno per l'operatore assegnato",
+                    "La sequenza di operatori richiesta non è più disponibile per questo slot. Ricarica la pagina e riprova.", 409)
+        if not snapshot.indice.libero(operatore_id, inizio, fine):
+            return (idx, "Slot gia' occupato (prenotazione concorrente o modifica dal gestionale)",
+                    "L'orario scelto è appena stato occupato. Ricarica la pagina e scegli un altro orario.", 409)
+        # capacità della risorsa condivisa (Service.max_concurrent), controllo O(1)
+        risorsa_satura = snapshot.capacita.risorsa_satura(servizio_id, inizio, fine)
+        if risorsa_satura:
+            return (idx, f"Risorsa condivisa al completo: {risorsa_satura}",
+                    f"La risorsa \"{risorsa_satura}\" è già occupata nell'orario scelto. Ricarica la pagina e scegli un altro orario.", 400)
+        inizio = fine
+    return None
+
+def _elimina_hold(session, token):
+    """Elimina (in blocco) gli hold del token; ritorna i giorni toccati, da invalidare in cache."""
+    giorni = {d for (d,) in session.query(SlotHold.data).filter(SlotHold.token == token).distinct().all()}
+    if giorni:
+        session.query(SlotHold).filter(SlotHold.token == token).delete(synchronize_session=False)
+    return giorni
+
+
+def _pulisci_hold_scaduti(session):
+    """Sweep in blocco degli hold scaduti (una DELETE sull'indice di expires_at)."""
+    return session.query(SlotHold).filter(
+        SlotHold.expires_at <= datetime.now(timezone.utc)
+    ).delete(synchronize_session=False)
+
+
+def _ip_cliente():
+    """IP del client: primo X-Forwarded-For (dietro proxy), altrimenti remote_addr."""
+    inoltrato = (request.headers.get('X-Forwarded-For') or '').split(',')[0].strip()
+    return inoltrato or request.remote_addr or 'sconosciuto'
+
+
+def _hold_consentito(chiavi_limiti):
+    """
+    Rate limit in memoria (per processo) sulla creazione degli hold, con finestra
+    SLOT_HOLD_TTL_SECONDS: il numero di hold ancora attivi per IP/sessione resta
+    quindi limitato anche se il client butta via il cookie di sessione.
+    Ritorna None (hold registrato) oppure i secondi da attendere.
+    """
+    with _HOLD_LOCK:
+        now = datetime.now().timestamp()
+        for chiave in list(_HOLD_TIMESTAMPS):
+            recenti = [ts for ts in _HOLD_TIMESTAMPS[chiave] if now - ts < SLOT_HOLD_TTL_SECONDS]
+            if recenti:
+                _HOLD_TIMESTAMPS[chiave] = recenti
+            else:
+                del _HOLD_TIMESTAMPS[chiave]
+        for chiave, massimo in chiavi_limiti:
+            recenti = _HOLD_TIMESTAMPS.get(chiave, [])
+            if len(recenti) >= massimo:
+                return int(SLOT_HOLD_TTL_SECONDS - (now - min(recenti)))
+        for chiave, _ in chiavi_limiti:
+            _HOLD_TIMESTAMPS.setdefault(chiave, []).append(now)
+    return None
+
+
+@booking_bp.route('/hold', methods=['POST'])
+def crea_hold(tenant_id):
+    """
+    Blocca per SLOT_HOLD_TTL_SECONDS lo slot appena scelto (data, ora, servizi[],
+    operatori_assegnati come per /prenota): nel frattempo gli altri clienti lo
+    vedono occupato. Un solo hold per sessione browser: uno nuovo sostituisce il
+    precedente. /prenota poi trasforma l'hold in appuntamenti.
+    Rifiuta slot passati e giorni di chiusura; la creazione è limitata per IP e
+    per sessione (SLOT_HOLD_MAX_PER_IP, SLOT_HOLD_MAX_PER_SESSIONE).
+    """
+    payload = request.get_json(silent=True) or {}
+    data_str = payload.get('data')
+    ora = payload.get('ora')
+    servizi = payload.get('servizi') or []
+    operatori_assegnati = payload.get('operatori_assegnati')
+    if not data_str or not ora or not isinstance(servizi, list) or not servizi:
+        return jsonify({"success": False, "errori": ["Dati dello slot mancanti"]}), 400
+    try:
+        data = datetime.strptime(data_str, "%Y-%m-%d").date()
+        slot_inizio = datetime.strptime(f"{data_str} {ora}", "%Y-%m-%d %H:%M")
+        servizi_ids = [int(s.get("servizio_id")) for s in servizi]
+        operatori_catena = [int(op_id) for op_id in operatori_assegnati]
+    except Exception:
+        return jsonify({"success": False, "errori": ["Dati dello slot non validi"]}), 400
+    if len(operatori_catena) != len(servizi):
+        return jsonify({"success": False, "errori": ["Operatori assegnati mancanti o non coerenti"]}), 400
+
+    now = _now_rome().replace(tzinfo=None)
+    if slot_inizio < now:
+        return jsonify({"success": False, "errori": ["L'orario scelto è già passato"]}), 400
+    business_info = g.db_session.query(BusinessInfo).first()
+    if data.strftime('%A') in getattr(business_info, "closing_days_list", []):
+        return jsonify({"success": False, "errori": ["Il giorno scelto è di chiusura"]}), 400
+
+    servizi_map = {s.id: s for s in g.db_session.query(Service).filter(
+        Service.id.in_(servizi_ids),
+        Service.is_deleted == False,
+        Service.is_visible_online == True
+    ).all()}
+    if any(sid not in servizi_map for sid in servizi_ids):
+        return jsonify({"success": False, "errori": ["Servizi non trovati"]}), 404
+
+    token = session.get('slot_hold_token') or uuid.uuid4().hex
+    # il token resta in sessione anche se l'hold viene rifiutato: serve al limite per sessione
+    session['slot_hold_token'] = token
+    ip = _ip_cliente()
+    attesa = _hold_consentito([
+        (f"ip:{tenant_id}:{ip}", SLOT_HOLD_MAX_PER_IP),
+        (f"tok:{tenant_id}:{token}", SLOT_HOLD_MAX_PER_SESSIONE),
+    ])
+    if attesa is not None:
+        wait_minutes = max(1, (attesa + 59) // 60)
+        print(f"[HOLD-RATE-LIMIT][{tenant_id}] BLOCKED ip={ip} token={token[:8]}")
+        return jsonify({
+            "success": False,
+            "errori": [f"Troppe richieste di blocco dell'orario. Riprova tra {wait_minutes} minuti."]
+        }), 429
+    scadenza = datetime.now(timezone.utc) + timedelta(seconds=SLOT_HOLD_TTL_SECONDS)
+    with lock_operatori_giorno(g.db_session, tenant_id, operatori_catena, data):
+        giorni_toccati = _elimina_hold(g.db_session, token)
+        _pulisci_hold_scaduti(g.db_session)
+        snapshot = DaySnapshot.load(g.db_session, data, list(servizi_map), escludi_hold=token)
+        rifiuto = _verifica_catena(snapshot, business_info, servizi, servizi_map, operatori_catena, slot_inizio)
+        if rifiuto:
+            # il vecchio hold della sessione resta com'era
+            g.db_session.rollback()
+            return jsonify({"success": False, "errori": [rifiuto[2]]}), rifiuto[3]
+
+        slot_corrente = slot_inizio
+        righe = []
+        for servizio_id, operatore_id in zip(servizi_ids, operatori_catena):
+            durata = servizi_map[servizio_id].servizio_durata or 30
+            righe.append({
+                "token": token,
+                "data": data,
+                "operator_id": operatore_id,
+                "service_id": servizio_id,
+                "start_time": slot_corrente,
+                "duration": durata,
+                "expires_at": scadenza,
+            })
+            slot_corrente += timedelta(minutes=durata)
+        g.db_session.execute(insert(SlotHold), righe)
+        g.db_session.commit()
+
+    for giorno in giorni_toccati | {data}:
+        _AVAIL_CACHE.invalida(tenant_id, giorno)
+    return jsonify({
+        "success": True,
+        "scade_alle": scadenza.isoformat(),
+        "ttl_secondi": SLOT_HOLD_TTL_SECONDS
+    })
+
+
+@booking_bp.route('/hold/rilascia', methods=['POST'])
+def rilascia_hold(tenant_id):
+    """Libera subito l'hold della sessione (cambio di data/servizi/orario)."""
+    token = session.pop('slot_hold_token', None)
+    if not token:
+        return jsonify({"success": True, "rilasciati": 0})
+    giorni = _elimina_hold(g.db_session, token)
+    g.db_session.commit()
+    for giorno in giorni:
+        _AVAIL_CACHE.invalida(tenant_id, giorno)
+    return jsonify({"success": True, "rilasciati": len(giorni)})
+
 @booking_bp.route('/prenota', methods=['POST'])
 def prenota(tenant_id):
     """Wrapper che garantisce che QUALSIASI eccezione non prevista venga sempre
@@ -1067,8 +1227,40 @@ def prenota(tenant_id):
             "errori": ["Errore interno del server. Riprova più tardi."]
         }), 500
 
+def _hash_richiesta_prenota(payload):
+    """Impronta del payload di /prenota (senza la chiave stessa) per riconoscere i veri retry."""
+    corpo = {k: v for k, v in (payload or {}).items() if k != 'idempotency_key'}
+    return hashlib.sha256(json.dumps(corpo, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _risposta_idempotente(tenant_id, chiave, request_hash):
+    """Risposta già salvata per questa Idempotency-Key (non scaduta), altrimenti None."""
+    salvata = g.db_session.query(BookingIdempotencyKey).filter(
+        BookingIdempotencyKey.key == chiave,
+        BookingIdempotencyKey.expires_at > datetime.now(timezone.utc)
+    ).first()
+    if salvata is None:
+        return None
+    if salvata.request_hash != request_hash:
+        _log_prenota_error(tenant_id, "Idempotency-Key riusata con una richiesta diversa", chiave=chiave)
+        return jsonify({
+            "success": False,
+            "errori": ["Richiesta non valida: ricarica la pagina e riprova."]
+        }), 422
+    print(f"[PRENOTA-IDEMPOTENZA][{tenant_id}] retry con chiave {chiave}: restituita la risposta salvata")
+    return jsonify(salvata.response), salvata.status_code
+
+
 def _prenota_impl(tenant_id):
     data = request.get_json()
+    # Idempotency-Key (header o campo): i retry della stessa richiesta ricevono
+    # la risposta già salvata senza toccare le tabelle degli appuntamenti.
+    idempotency_key = (request.headers.get('Idempotency-Key') or data.get('idempotency_key') or '').strip()[:128] or None
+    request_hash = _hash_richiesta_prenota(data) if idempotency_key else None
+    if idempotency_key:
+        salvata = _risposta_idempotente(tenant_id, idempotency_key, request_hash)
+        if salvata is not None:
+            return salvata
     nome = data.get('nome')
     cognome = data.get('cognome')
     telefono = data.get('telefono')
@@ -1146,12 +1338,9 @@ def _prenota_impl(tenant_id):
         Service.is_visible_online == True
     ).all()
     servizi_map = {s.id: s for s in servizi_objs}
-    servizi_operatori = {s.id: [op.id for op in s.operators] for s in servizi_objs}
 
     data = datetime.strptime(data_str, "%Y-%m-%d").date()
     business_info = g.db_session.query(BusinessInfo).first()
-    apertura = business_info.active_opening_time
-    chiusura = business_info.active_closing_time
 
     # --- CONTROLLA LIMITE DURATA/PREZZO SU BLOCCO ---
     durata_totale = sum([s.servizio_durata or 30 for s in servizi_objs])
@@ -1193,68 +1382,6 @@ def _prenota_impl(tenant_id):
             elif rule_type_prezzo == "warning":
                 popup_warning = rule_msg_prezzo or "Limite prezzo superato, attenzione."
 
-    operatori_disponibili = g.db_session.query(Operator).filter_by(is_deleted=False, is_visible=True).all()
-    turni_disponibili = g.db_session.query(OperatorShift).filter(
-        OperatorShift.operator_id.in_([o.id for o in operatori_disponibili]),
-        OperatorShift.shift_date == data
-    ).all()
-    turni_per_operatore = {}
-    for op in operatori_disponibili:
-        op_turni = [
-            (
-                t.shift_start_time if isinstance(t.shift_start_time, time) else apertura,
-                t.shift_end_time if isinstance(t.shift_end_time, time) else chiusura
-            )
-            for t in turni_disponibili if t.operator_id == op.id
-        ]
-        if not op_turni:
-            op_turni = [(apertura, chiusura)]
-        op_turni = [
-            (max(start, apertura), min(end, chiusura))
-            for (start, end) in op_turni
-            if max(start, apertura) < min(end, chiusura)
-        ]
-        if op_turni:
-            turni_per_operatore[op.id] = op_turni
-
-    appuntamenti = g.db_session.query(Appointment).filter(
-        Appointment.start_time >= datetime.combine(data, time.min),
-        Appointment.start_time < datetime.combine(data + timedelta(days=1), time.min),
-        Appointment.is_cancelled_by_client == False
-    ).all()
-    blocchi_off = g.db_session.query(Appointment).filter(
-        Appointment.start_time >= datetime.combine(data, time.min),
-        Appointment.start_time < datetime.combine(data + timedelta(days=1), time.min),
-        or_(
-            Appointment.note.ilike('%OFF%'),
-            Appointment.service_id == 9999
-        )
-    ).all()
-    for b in blocchi_off:
-        if b not in appuntamenti:
-            appuntamenti.append(b)
-
-    # --- LOGICA IDENTICA A orari_disponibili (solo per coerenza calcolo intervalli, ma senza ricontrollare tutto) ---
-    durata_totale = sum([s.servizio_durata or 30 for s in servizi_objs])
-    durata = timedelta(minutes=durata_totale)
-    slot_step = timedelta(minutes=15)
-    intervalli_tmp = []
-    for op_id, turni in turni_per_operatore.items():
-        for t in turni:
-            intervalli_tmp.append(t)
-    intervalli_tmp.sort()
-    intervalli = []
-    for intervallo in intervalli_tmp:
-        if not intervalli:
-            intervalli.append(intervallo)
-        else:
-            last_start, last_end = intervalli[-1]
-            curr_start, curr_end = intervallo
-            if curr_start <= last_end:
-                intervalli[-1] = (last_start, max(last_end, curr_end))
-            else:
-                intervalli.append(intervallo)
-
     # Verifica di coerenza minima su operatori_assegnati rispetto alla richiesta
     if not isinstance(operatori_assegnati, list) or len(operatori_assegnati) != len(servizi):
         _log_prenota_error(tenant_id, "Operatori assegnati mancanti o non coerenti", email=email,
@@ -1286,84 +1413,136 @@ def _prenota_impl(tenant_id):
                     "errori": ["Operatori assegnati non validi. Ricarica la pagina e riprova."]
                 }), 400
 
-    # A questo punto ci fidiamo della catena calcolata da /orari:
-    # creiamo gli appuntamenti usando operatori_assegnati in sequenza,
-    # rispettando l'ordine dei servizi e l'orario di partenza scelto (data_str + ora).
-    risultati = []
-    slot_corrente = datetime.strptime(f"{data_str} {ora}", "%Y-%m-%d %H:%M")
-
-    for idx, servizio_item in enumerate(servizi):
-        servizio_id = int(servizio_item.get("servizio_id"))
-        durata_servizio = servizi_map[servizio_id].servizio_durata or 30
-        durata_td = timedelta(minutes=durata_servizio)
-        inizio = slot_corrente
-        fine = slot_corrente + durata_td
-        try:
-            operatore_id = int(operatori_assegnati[idx])
-        except Exception as e:
-            _log_prenota_error(tenant_id, "Operatori assegnati non validi nel loop di creazione (eccezione)",
-                                email=email, idx=idx, operatori_assegnati=operatori_assegnati, errore=repr(e))
-            return jsonify({
-                "success": False,
-                "errori": ["Operatori assegnati non validi. Ricarica la pagina e riprova."]
-            }), 400
+    try:
+        operatori_catena = [int(op_id) for op_id in operatori_assegnati]
+    except Exception as e:
+        _log_prenota_error(tenant_id, "Operatori assegnati non validi (eccezione)", email=email,
+                            operatori_assegnati=operatori_assegnati, errore=repr(e))
+        return jsonify({
+            "success": False,
+            "errori": ["Operatori assegnati non validi. Ricarica la pagina e riprova."]
+        }), 400
 
-        # ulteriore controllo leggero: l'operatore deve essere abilitato al servizio
-        if operatore_id not in servizi_operatori.get(servizio_id, []):
-            _log_prenota_error(tenant_id, "Operatore non abilitato per il servizio (slot non piu' disponibile)",
-                                email=email, idx=idx, servizio_id=servizio_id, operatore_id=operatore_id)
-            return jsonify({
-                "success": False,
-                "errori": ["La sequenza di operatori richiesta non è più disponibile per questo slot. Ricarica la pagina e riprova."]
-            }), 400
+    risultati = []
+    slot_inizio = datetime.strptime(f"{data_str} {ora}", "%Y-%m-%d %H:%M")
+    hold_token = session.get('slot_hold_token')
+
+    # Lock per (operatore, giorno) sugli operatori della catena: due richieste sullo
+    # stesso slot si mettono in fila e la seconda vede gli appuntamenti della prima.
+    # Il commit avviene DENTRO il lock (su PostgreSQL si rilascia proprio al commit).
+    with lock_operatori_giorno(g.db_session, tenant_id, operatori_catena, data):
+        # Un retry concorrente con la stessa chiave può aver appena concluso
+        if idempotency_key:
+            salvata = _risposta_idempotente(tenant_id, idempotency_key, request_hash)
+            if salvata is not None:
+                g.db_session.rollback()
+                return salvata
+
+        # Snapshot fresco, letto DOPO aver preso il lock; l'hold di questa sessione
+        # (se c'è) non conta come occupato: è proprio lo slot che si sta prenotando
+        snapshot = DaySnapshot.load(g.db_session, data, list(servizi_map), escludi_hold=hold_token)
+        rifiuto = _verifica_catena(snapshot, business_info, servizi, servizi_map, operatori_catena, slot_inizio)
+        if rifiuto:
+            idx, motivo, messaggio, status = rifiuto
+            g.db_session.rollback()
+            _log_prenota_error(tenant_id, motivo, email=email, idx=idx, data_str=data_str, ora=ora,
+                                servizi=servizi, operatori_assegnati=operatori_assegnati)
+            return jsonify({"success": False, "errori": [messaggio]}), status
+
+        # Catena verificata: crea gli appuntamenti in sequenza, rispettando l'ordine
+        # dei servizi e l'orario di partenza scelto, con UN solo INSERT multi-riga
+        # (RETURNING degli id nell'ordine dei parametri) e un solo commit.
+        # Nomi e prezzi per risposta ed email vengono dalle mappe già caricate.
+        nomi_operatori = {op.id: op.user_nome for op in snapshot.operatori}
+        righe = []
+        slot_corrente = slot_inizio
+        for idx, servizio_item in enumerate(servizi):
+            servizio_id = int(servizio_item.get("servizio_id"))
+            servizio = servizi_map[servizio_id]
+            operatore_id = operatori_catena[idx]
+            durata_servizio = servizio.servizio_durata or 30
+            # per questo singolo servizio: l'utente ha selezionato un operatore?
+            operatore_id_richiesto = servizio_item.get("operatore_id")
+            desiderata_str = "Sì" if operatore_id_richiesto else "NO"
+            note = (
+                f"PRENOTATO DA BOOKING ONLINE - Nome: {escape(nome)}, Cognome: {escape(cognome)}, "
+                f"Telefono: {escape(telefono)}, Email: {escape(email)} - ha selezionato l'operatrice? {desiderata_str}"
+            )
+            righe.append({
+                "client_id": dummy_client.id,
+                "operator_id": operatore_id,
+                "service_id": servizio_id,
+                "start_time": slot_corrente,
+                "_duration": servizio.servizio_durata,
+                "note": note,
+                "source": AppointmentSource.web,
+                "booking_session_id": booking_session_id,
+            })
+            operatore_nome = nomi_operatori.get(operatore_id)
+            risultati.append({
+                "success": True,
+                "servizio_id": servizio_id,
+                "servizio_nome": servizio.servizio_nome,
+                "servizio_durata": durata_servizio,
+                "servizio_prezzo": float(getattr(servizio, 'servizio_prezzo', 0) or 0),
+                "data": data_str,
+                "ora": slot_corrente.strftime("%H:%M"),
+                "operatore_nome": operatore_nome or ""  # grezzo: l'escape lo fa il template .html
+            })
+            slot_corrente += timedelta(minutes=durata_servizio)
 
-        servizio = servizi_map.get(servizio_id)
-        # per questo singolo servizio: l'utente ha selezionato un operatore?
-        operatore_id_richiesto = servizio_item.get("operatore_id")
-        desiderata_str = "Sì" if operatore_id_richiesto else "NO"
-        note = (
-            f"PRENOTATO DA BOOKING ONLINE - Nome: {escape(nome)}, Cognome: {escape(cognome)}, "
-            f"Telefono: {escape(telefono)}, Email: {escape(email)} - ha selezionato l'operatrice? {desiderata_str}"
-        )
-        operatore = g.db_session.get(Operator, operatore_id)
-        operatore_nome = f"{escape(operatore.user_nome)}" if operatore else ""
-        nuovo = Appointment(
-            client_id=dummy_client.id,
-            operator_id=operatore_id,
-            service_id=servizio_id,
-            start_time=inizio,
-            _duration=servizio.servizio_durata,
-            note=note,
-            source=AppointmentSource.web,
-            booking_session_id=booking_session_id
-        )
-        g.db_session.add(nuovo)
         try:
+            ids = g.db_session.scalars(
+                insert(Appointment).returning(Appointment.id, sort_by_parameter_order=True),
+                righe
+            ).all()
+            for r, nuovo_id in zip(risultati, ids):
+                r["id"] = nuovo_id
+            # L'hold diventa appuntamenti: via nella stessa transazione
+            giorni_hold = _elimina_hold(g.db_session, hold_token) if hold_token else set()
+            if idempotency_key:
+                # Chiave e risposta nella stessa transazione degli appuntamenti
+                adesso = datetime.now(timezone.utc)
+                g.db_session.query(BookingIdempotencyKey).filter(
+                    BookingIdempotencyKey.expires_at <= adesso
+                ).delete(synchronize_session=False)
+                g.db_session.add(BookingIdempotencyKey(
+                    key=idempotency_key,
+                    request_hash=request_hash,
+                    booking_session_id=booking_session_id,
+                    status_code=200,
+                    expires_at=adesso + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+                    response={
+                        "success": len(risultati) > 0,
+                        "prenotazioni": risultati,
+                        "errori": [],
+                        "popup_warning": popup_warning
+                    }
+                ))
             g.db_session.commit()
+        except IntegrityError:
+            # Stessa chiave registrata in parallelo da un'altra richiesta: vale quella
+            g.db_session.rollback()
+            salvata = _risposta_idempotente(tenant_id, idempotency_key, request_hash) if idempotency_key else None
+            if salvata is None:
+                raise
+            return salvata
         except Exception as e:
             g.db_session.rollback()
-            _log_prenota_error(tenant_id, "Errore DB durante il commit dell'appuntamento", email=email,
-                                idx=idx, servizio_id=servizio_id, operatore_id=operatore_id, errore=repr(e))
+            _log_prenota_error(tenant_id, "Errore DB durante il commit degli appuntamenti", email=email,
+                                servizi=servizi, operatori_assegnati=operatori_assegnati, errore=repr(e))
             print(f"[PRENOTA-ERROR][{tenant_id}] Traceback: {traceback.format_exc()}")
             return jsonify({
                 "success": False,
                 "errori": ["Errore database: " + str(e)]
             }), 500
 
-        risultati.append({
-            "success": True,
-            "id": nuovo.id,
-            "servizio_id": servizio_id,
-            "servizio_nome": servizio.servizio_nome,
-            "servizio_durata": servizio.servizio_durata or 30,
-            "servizio_prezzo": float(getattr(servizio, 'servizio_prezzo', 0) or 0),
-            "data": data_str,
-            "ora": inizio.strftime("%H:%M"),
-            "operatore_nome": operatore_nome
-        })
-        slot_corrente = fine
+    # A questo punto gli appuntamenti sono stati creati con successo:
+    # gli orari in cache di quel giorno non sono più validi
+    session.pop('slot_hold_token', None)
+    for giorno in giorni_hold | {data}:
+        _AVAIL_CACHE.invalida(tenant_id, giorno)
 
-    # A questo punto gli appuntamenti sono stati creati con successo
     # Registra timestamp per rate limiting
     with _BOOKING_LOCK:
         _BOOKING_TIMESTAMPS.append(datetime.now().timestamp())
@@ -1378,9 +1557,8 @@ def _prenota_impl(tenant_id):
         totale_durata = 0
         totale_prezzo = 0
         for r in risultati:
-            servizio_obj = g.db_session.get(Service, r['servizio_id'])
-            durata_i = int(servizio_obj.servizio_durata or 30)
-            prezzo_i = float(getattr(servizio_obj, 'servizio_prezzo', 0) or 0)
+            durata_i = int(r['servizio_durata'])
+            prezzo_i = r['servizio_prezzo']
             totale_durata += durata_i
             totale_prezzo += prezzo_i
             appuntamenti_data.append({
@@ -1395,84 +1573,9 @@ def _prenota_impl(tenant_id):
         business_info = g.db_session.query(BusinessInfo).first()
         company_name = business_info.business_name if business_info and business_info.business_name else "Tosca Gestionale"
 
-        # Template sicuro: Jinja escaperà le variabili automaticamente
-        # Stile formale professionale (come email codice)
-        template = """<!DOCTYPE html>
-<html lang="it">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Conferma Prenotazione</title>
-</head>
-<body style="margin:0; padding:0; font-family: Arial, Helvetica, sans-serif; background-color: #f4f4f4;">
-    <!--[if mso]>
-    <table role="presentation" width="600" align="center" cellpadding="0" cellspacing="0" border="0">
-    <tr><td>
-    <![endif]-->
-    
-    <table role="presentation" style="max-width:600px; margin:20px auto; background:#ffffff; border-radius:8px; border:1px solid #e0e0e0;" cellpadding="0" cellspacing="0" width="100%">
-        <tr>
-            <td style="padding:30px 40px;">
-                <h2 style="color:#333333; margin:0 0 20px 0; font-size:22px;">Richiesta di prenotazione ricevuta</h2>
-                
-                <p style="color:#555555; font-size:15px; line-height:1.6; margin:0 0 20px 0;">
-                    <strong>{{ nome }}</strong>, la tua richiesta di prenotazione è stata ricevuta correttamente.
-                </p>
-                
-                <p style="color:#555555; font-size:14px; line-height:1.6; margin:0 0 25px 0;">
-                    Riceverai la conferma via WhatsApp in orario lavorativo, o comunque al più presto possibile.
-                </p>
-                
-                <div style="background:#f8f9fa; border-radius:8px; padding:20px; margin:20px 0;">
-                    <h3 style="color:#333333; margin:0 0 15px 0; font-size:16px;">Dettagli prenotazione:</h3>
-                    {% for a in appuntamenti %}
-                    <div style="padding:15px; background:#ffffff; margin:10px 0; border-left:3px solid #007bff; border-radius:4px;">
-                        <div style="margin-bottom:8px; font-size:15px;"><strong>Data:</strong> {{ a.data }}</div>
-                        <div style="margin-bottom:8px; font-size:15px;"><strong>Ora:</strong> {{ a.ora }}</div>
-                        {% if a.operatore_nome %}<div style="margin-bottom:8px; font-size:15px;"><strong>Operatore:</strong> {{ a.operatore_nome }}</div>{% endif %}
-                        <div style="margin-bottom:8px; font-size:15px;"><strong>Servizio:</strong> {{ a.servizio_nome }}</div>
-                        <div style="font-size:13px; color:#666666; margin-top:10px;">
-                            Durata: {{ a.durata }} min &nbsp;|&nbsp; Prezzo: {{ a.prezzo }} €
-                        </div>
-                    </div>
-                    {% endfor %}
-                </div>
-                
-                <div style="background:#e8f5e9; border:2px solid #28a745; border-radius:8px; padding:20px; text-align:center; margin:25px 0;">
-                    <div style="font-size:16px; color:#333333; margin-bottom:5px;">
-                        <strong>Totale durata:</strong> {{ totale_durata }} min
-                    </div>
-                    <div style="font-size:18px; color:#28a745; font-weight:bold;">
-                        <strong>Totale costo:</strong> €{{ totale_prezzo }}
-                    </div>
-                </div>
-                
-                <p style="color:#555555; font-size:14px; line-height:1.6; margin:25px 0 0 0;">
-                    Non puoi più venire? Clicca qui: <a href="{{ cancel_url }}" style="color:#dc3545; text-decoration:none; font-weight:bold;">Annulla la prenotazione</a>
-                </p>
-            </td>
-        </tr>
-        <tr>
-            <td style="padding:20px 40px; background:#f8f9fa; border-top:1px solid #e0e0e0;">
-                <p style="color:#888888; font-size:12px; margin:0; line-height:1.5;">
-                    <strong>{{ company_name }}</strong><br>
-                    Grazie per aver scelto i nostri servizi.<br>
-                    Non rispondere a questa e-mail. Per assistenza contattaci telefonicamente.
-                </p>
-            </td>
-        </tr>
-    </table>
-    
-    <!--[if mso]>
-    </td></tr>
-    </table>
-    <![endif]-->
-</body>
-</html>
-        """
-
-        riepilogo = render_template_string(
-            template,
+        # Template precompilati (appl/email_templates.py): HTML con autoescape e testo
+        riepilogo, riepilogo_testo = render_email(
+            'conferma_prenotazione',
             nome=nome,
             appuntamenti=appuntamenti_data,
             totale_durata=totale_durata,
@@ -1481,54 +1584,35 @@ def _prenota_impl(tenant_id):
             cancel_url=cancel_url
         )
 
-        # Prepara email admin PRIMA di qualsiasi invio
-        admin_riepilogo = render_template_string(
-            """
-    <div style="font-size:1.5em;">Nuova prenotazione:</div><div style="font-size:2.8em; color:red;"> {{ nome }} {{ cognome }}</div>
-            <div style="font-size:1.3em;">
-            <ul>
-            {% for a in appuntamenti %}
-              <li>
-                <b>Data:</b> {{ a.data }} - <b>Ora:</b> {{ a.ora }} - <b>Servizio:</b> {{ a.servizio_nome }}
-              </li>
-            {% endfor %}
-            </ul>
-            </div>
-            <div style="padding:12px; background:#f2f2f2; margin:20px 0; border-radius:8px; font-size:1.3em;">
-            <b>Totale durata:</b> {{ totale_durata }} min &nbsp; | &nbsp; <b>Totale costo:</b> €{{ totale_prezzo }}
-            </div>
-            """,
-            nome=nome,
-            cognome=cognome,
-            appuntamenti=appuntamenti_data,
-            totale_durata=totale_durata,
-            totale_prezzo=f"{totale_prezzo:.2f}"
-        )
-
         # Invio email al cliente (immediato)
         try:
             invia_email_async(
                 to_email=email,
                 subject=f'{company_name} - Nuova prenotazione - {escape(nome)}',
                 html_content=riepilogo,
+                plain_text=riepilogo_testo,
                 from_email=None
             )
         except Exception as e:
             print(f"ERROR queueing confirmation email: {repr(e)}")
         
-        # Invio email all'admin (con delay di 65s per rate limit Azure)
-        admin_email = business_info.email if business_info and business_info.email else None
-        if admin_email:
-            try:
-                invia_email_async(
-                    to_email=admin_email,
-                    subject=f'{company_name} - Nuova prenotazione - {escape(nome)}',
-                    html_content=admin_riepilogo,
-                    from_email=None,
-                    delay_seconds=65
-                )
-            except Exception as e:
-                print(f"ERROR queueing admin email: {repr(e)}")
+        # Notifica all'admin: subito a priorità bassa oppure nel digest del tenant
+        try:
+            _notifica_admin(
+                tenant_id, business_info, 'prenotazione',
+                subject=f'{company_name} - Nuova prenotazione - {escape(nome)}',
+                template='admin_prenotazione',
+                contesto=dict(
+                    nome=nome,
+                    cognome=cognome,
+                    appuntamenti=appuntamenti_data,
+                    totale_durata=totale_durata,
+                    totale_prezzo=f"{totale_prezzo:.2f}"
+                ),
+                contatti=dict(email=email, telefono=telefono)
+            )
+        except Exception as e:
+            print(f"ERROR queueing admin email: {repr(e)}")
 
     return jsonify({
         "success": len(risultati) > 0,
@@ -1623,6 +1707,8 @@ def cancel_booking(tenant_id, token):
         for a in appts_future:
             a.is_cancelled_by_client = True  # Imposta soft-delete
         g.db_session.commit()  # Commit delle modifiche
+        for giorno in {a.start_time.date() for a in appts_future}:
+            _AVAIL_CACHE.invalida(tenant_id, giorno)
 
         # --- INVIO EMAIL NOTIFICA ALL'ADMIN ---
         admin_email = getattr(biz, 'email', None)
@@ -1670,49 +1756,22 @@ def cancel_booking(tenant_id, token):
                 })
 
             # Template email distintivo per annullamento (rosso, titolo "Annullamento Prenotazione")
-            cancel_template = """
-            <div style="font-size:1.5em; color:red;">Annullamento Prenotazione</div>
-            <div style="font-size:2.8em; color:red;">{{ nome }} {{ cognome }}</div>
-            <div style="font-size:1.1em; margin-bottom:16px;">
-                <b>Email:</b> {{ email_cliente }}<br>
-                <b>Telefono:</b> {{ telefono }}
-            </div>
-            <div style="font-size:1.3em;">
-            <ul>
-            {% for a in appuntamenti %}
-              <li>
-                <b>Data:</b> {{ a.data }} - <b>Ora:</b> {{ a.ora }} - <b>Servizio:</b> {{ a.servizio_nome }}
-                {% if a.operatore_nome %}<br><b>Operatore:</b> {{ a.operatore_nome }}{% endif %}
-                <br><small>Durata: {{ a.durata }} min - Prezzo: {{ a.prezzo }} €</small>
-                {% if a.note %}<br><small>Note: {{ a.note }}</small>{% endif %}
-              </li>
-            {% endfor %}
-            </ul>
-            </div>
-            <div style="padding:12px; background:#ffe6e6; margin:20px 0; border-radius:8px; font-size:1.3em; border:1px solid #ffcccc;">
-            <b>Totale durata:</b> {{ totale_durata }} min &nbsp; | &nbsp; <b>Totale costo:</b> €{{ totale_prezzo }}
-            </div>
-            <p style="color:#666;">{{ company_name }} - Annullamento effettuato dal cliente via email.</p>
-            """
-
-            riepilogo_admin = render_template_string(
-                cancel_template,
-                nome=nome,
-                cognome=cognome,
-                email_cliente=email_cliente,
-                telefono=telefono,
-                appuntamenti=appuntamenti_annullati,
-                totale_durata=totale_durata,
-                totale_prezzo=f"{totale_prezzo:.2f}",
-                company_name=company_name
-            )
-
             try:
-                invia_email_async(
-                    to_email=admin_email,
+                _notifica_admin(
+                    tenant_id, biz, 'annullamento',
                     subject=f'{company_name} - Annullamento Prenotazione - {nome} {cognome}',
-                    html_content=riepilogo_admin,
-                    from_email=None
+                    template='admin_annullamento',
+                    contesto=dict(
+                        nome=nome,
+                        cognome=cognome,
+                        email_cliente=email_cliente,
+                        telefono=telefono,
+                        appuntamenti=appuntamenti_annullati,
+                        totale_durata=totale_durata,
+                        totale_prezzo=f"{totale_prezzo:.2f}",
+                        company_name=company_name
+                    ),
+                    contatti=dict(email=email_cliente, telefono=telefono)
                 )
             except Exception as e:
                 print(f"[CANCEL] ERROR sending admin email: {repr(e)}")
@@ -1792,73 +1851,10 @@ def invia_codice(tenant_id):
     
     print(f"[INVIA-CODICE] Session updated: code stored, attempts={attempts + 1}")
 
-    # Costruisci email anti-spam con struttura professionale
-    html_content = f"""<!DOCTYPE html>
-<html lang="it">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Codice di conferma</title>
-</head>
-<body style="margin:0; padding:0; font-family: Arial, Helvetica, sans-serif; background-color: #f4f4f4;">
-    <!--[if mso]>
-    <table role="presentation" width="600" align="center" cellpadding="0" cellspacing="0" border="0">
-    <tr><td>
-    <![endif]-->
-    
-    <!-- Preheader nascosto per anteprima email -->
-    <div style="display:none; max-height:0; overflow:hidden;">
-        Il tuo codice: {escape(codice)} - Valido per 10 minuti
-    </div>
-    
-    <table role="presentation" style="max-width:600px; margin:20px auto; background:#ffffff; border-radius:8px; border:1px solid #e0e0e0;" cellpadding="0" cellspacing="0" width="100%">
-        <tr>
-            <td style="padding:30px 40px;">
-                <h2 style="color:#333333; margin:0 0 20px 0; font-size:22px;">Conferma prenotazione</h2>
-                
-                <p style="color:#555555; font-size:15px; line-height:1.6; margin:0 0 20px 0;">
-                    {escape(nome)} {escape(cognome)}, ecco il codice per completare la prenotazione:
-                </p>
-                
-                <div style="background:#f8f9fa; border:2px dashed #007bff; border-radius:8px; padding:20px; text-align:center; margin:25px 0;">
-                    <span style="font-size:32px; font-weight:bold; letter-spacing:8px; color:#007bff;">{escape(codice)}</span>
-                </div>
-                
-                <p style="color:#555555; font-size:14px; line-height:1.6; margin:20px 0 0 0;">
-                    Inserisci questo codice nella pagina di prenotazione.<br>
-                    Il codice scade tra 10 minuti.
-                </p>
-            </td>
-        </tr>
-        <tr>
-            <td style="padding:20px 40px; background:#f8f9fa; border-top:1px solid #e0e0e0;">
-                <p style="color:#888888; font-size:12px; margin:0; line-height:1.5;">
-                    <strong>{escape(company_name)}</strong><br>
-                    Se non hai richiesto questo codice, ignora questa email.<br>
-                    Per assistenza contattaci telefonicamente.
-                </p>
-            </td>
-        </tr>
-    </table>
-    
-    <!--[if mso]>
-    </td></tr>
-    </table>
-    <![endif]-->
-</body>
-</html>"""
-
-    # Plain text version (IMPORTANTE per evitare spam!)
-    plain_text = f"""{nome} {cognome}, ecco il codice per completare la prenotazione su {company_name}:
-
-CODICE: {codice}
-
-Inserisci questo codice nella pagina di prenotazione.
-Il codice scade tra 10 minuti.
-
-Se non hai richiesto questo codice, ignora questa email.
-
-{company_name}"""
+    # Email anti-spam con struttura professionale: HTML + testo dallo stesso template precompilato
+    html_content, plain_text = render_email(
+        'codice_conferma', nome=nome, cognome=cognome, codice=codice, company_name=company_name
+    )
 
     # Invia email con ENTRAMBE le versioni (HTML + plain text)
     try:
@@ -1868,7 +1864,8 @@ Se non hai richiesto questo codice, ignora questa email.
             subject=f'Codice {codice} - {company_name}',
             html_content=html_content,
             plain_text=plain_text,
-            from_email=None
+            from_email=None,
+            priorita=PRIORITA_OTP
         )
         print(f"[INVIA-CODICE] invia_email_async returned: {result}")
         return jsonify({"success": True})
@@ -1938,85 +1935,20 @@ def _prepare_unipile_phone(phone: str):
     # Formato Unipile: numero@s.whatsapp.net
     return f"{numero_pulito}@s.whatsapp.net"
 
-def _services_bullet_for_contiguous_block(session, appt) -> str:
-    """
-    Restituisce una lista puntata dei servizi per il blocco contiguo dell'appuntamento:
-    include appuntamenti dello stesso cliente nello stesso giorno che si toccano o si sovrappongono,
-    escludendo OFF e servizio 9999.
-    """
+def _render_morning_text(template: str, item: dict, business_info=None) -> str:
+    """Sostituisce {{nome}}, {{cognome}}, {{data}}, {{ora}}, {{azienda}}, {{servizi}}...
+    con i dati già caricati da _build_today_targets (nessuna query)."""
     try:
-        if not appt or not appt.client_id or not appt.start_time:
-            return ""
-        day = appt.start_time.date()
-        # carica tutti gli appt del cliente nel giorno (escludi OFF e 9999)
-        appts = (
-            session.query(Appointment)
-            .filter(
-                Appointment.client_id == appt.client_id,
-                Appointment.start_time >= datetime.combine(day, time.min),
-                Appointment.start_time < datetime.combine(day + timedelta(days=1), time.min),
-                or_(Appointment.note.is_(None), ~Appointment.note.ilike('%OFF%')),
-                Appointment.service_id != 9999,
-                Appointment.is_cancelled_by_client == False
-            )
-            .order_by(Appointment.start_time.asc())
-            .all()
-        )
-        if not appts:
-            return ""
-
-        # prepara start/end per catena contigua
-        starts, ends = [], []
-        for a in appts:
-            start = a.start_time
-            dur_min = int(getattr(a, "_duration", 0) or 0)
-            if dur_min <= 0:
-                svc = session.get(Service, a.service_id) if a.service_id else None
-                dur_min = int(getattr(svc, "servizio_durata", 0) or 30)
-            ends.append(start + timedelta(minutes=dur_min))
-            starts.append(start)
-
-        # trova indice dell'appuntamento corrente
-        try:
-            idx = next(i for i, a in enumerate(appts) if a.id == appt.id)
-        except StopIteration:
-            return ""
-
-        # espandi a sinistra/destra finché contigui (overlap o adiacenti)
-        lower = idx
-        while lower - 1 >= 0 and ends[lower - 1] >= starts[lower]:
-            lower -= 1
-        upper = idx
-        while upper + 1 < len(appts) and starts[upper + 1] <= ends[upper]:
-            upper += 1
-
-        # costruisci elenco servizi (in ordine)
-        lines = []
-        for i in range(lower, upper + 1):
-            svc = session.get(Service, appts[i].service_id) if appts[i].service_id else None
-            label = ((getattr(svc, "servizio_nome", "") or "").strip() if svc else "")
-            if label:
-                lines.append(f"• {label}")
-        return "\n".join(lines)
-    except Exception:
-        return ""
-
-def _render_morning_text(session, template: str, item: dict) -> str:
-    """Sostituisce {{nome}}, {{cognome}}, {{data}}, {{ora}}, {{azienda}}"""
-    try:
-        appt = session.get(Appointment, item["appointment_id"])
-        cli = session.get(Client, item["client_id"]) if item.get("client_id") else None
-        biz = session.query(BusinessInfo).first()
-        dt = getattr(appt, 'start_time', None)
+        dt = item.get("start_time")
         data_str = dt.strftime('%d/%m/%Y') if dt else ''
         ora_str = dt.strftime('%H:%M') if dt else ''
-        nome = (getattr(cli, 'cliente_nome', '') or '').strip()
-        cognome = (getattr(cli, 'cliente_cognome', '') or '').strip()
-        azienda = (getattr(biz, 'business_name', '') or '').strip()
+        nome = (item.get("nome") or '').strip()
+        cognome = (item.get("cognome") or '').strip()
+        azienda = (getattr(business_info, 'business_name', '') or '').strip()
         nome_fmt = " ".join([w.capitalize() for w in nome.split()])
-        servizi_str = _services_bullet_for_contiguous_block(session, appt)
+        servizi_str = "\n".join(f"• {label}" for label in item.get("servizi", []) if label)
 
-        sito = (getattr(biz, 'website', '') or '').strip()
+        sito = (getattr(business_info, 'website', '') or '').strip()
         txt = (template or "")
         return (txt.replace('{{nome}}', nome_fmt)
                    .replace('{{cognome}}', cognome)
@@ -2030,57 +1962,29 @@ def _render_morning_text(session, template: str, item: dict) -> str:
         return template or ''
 
 def _send_unipile_message(creds: dict, to_phone: str, text: str) -> bool:
-    """Invia messaggio WhatsApp con API REST Unipile"""
+    """Invia messaggio WhatsApp con il trasporto configurato (Unipile in produzione)"""
     try:
         numero_whatsapp = _prepare_unipile_phone(to_phone)
         if not numero_whatsapp:
             print("[UNIPILE] Numero vuoto dopo normalizzazione")
             return False
-
-        # API Unipile - endpoint /api/v1/chats
-        url = f"https://{creds['dsn']}/api/v1/chats"
-        
-        headers = {
-            "X-API-KEY": creds["access_token"],
-            "accept": "application/json"
-        }
-        
-        data = {
-            "account_id": creds["account_id"],
-            "text": text or "",
-            "attendees_ids": numero_whatsapp  # formato: numero@s.whatsapp.net
-        }
-        
-        response = requests.post(url, headers=headers, data=data, timeout=30)
-        
-        if response.status_code in [200, 201]:
-            result = response.json()
-            print(f"[UNIPILE] Messaggio inviato con successo a {numero_whatsapp}: {result}")
-            return True
-        else:
-            print(f"[UNIPILE] Errore HTTP {response.status_code}: {response.text}")
-            return False
-            
-    except requests.exceptions.Timeout:
-        print(f"[UNIPILE] Timeout invio a {to_phone}")
-        return False
-    except requests.exceptions.RequestException as e:
-        print(f"[UNIPILE] Errore connessione: {repr(e)}")
-        return False
+        return trasporto_whatsapp().invia_whatsapp(creds, numero_whatsapp, text)
     except Exception as e:
         print(f"[UNIPILE] ERROR invio a {to_phone}: {repr(e)}")
         import traceback
         print(f"[UNIPILE] Traceback: {traceback.format_exc()}")
         return False
-    
+
 def _build_today_targets(session, start_from=None) -> list:
     """
     Seleziona gli appuntamenti odierni ordinati, esclusi OFF e servizio 9999,
     esclude i client finti BOOKING/ONLINE e dummy/dummy, e i servizi dummy (blocchi OFF/PAUSA).
-    Deduplica blocchi contigui per cliente.
-    Ritorna una lista di dict: {"appointment_id", "client_id", "phone"}.
-    Regola: il cellulare viene SEMPRE letto dal record Client usando client_id.
-    Non si estrae nulla dalla nota.
+    Raggruppa in blocchi contigui per cliente (appuntamenti che si toccano o si
+    sovrappongono): un target per blocco, con l'elenco dei servizi del blocco.
+    Ritorna una lista di dict: {"appointment_id", "client_id", "phone", "nome",
+    "cognome", "start_time", "servizi"}: tutto quello che serve a _render_morning_text.
+    Una sola query (appuntamenti + clienti + servizi del giorno); il cellulare viene
+    SEMPRE dal record Client, non si estrae nulla dalla nota.
     """
     today = _now_rome().date()
     start = datetime.combine(today, time.min)
@@ -2090,64 +1994,68 @@ def _build_today_targets(session, start_from=None) -> list:
     if isinstance(start_from, datetime) and start_from.date() == today and start_from > start:
         start = start_from
 
-    # Client finti da escludere SEMPRE dai memo automatici:
-    #  - "BOOKING / ONLINE": placeholder delle prenotazioni web
-    #  - "dummy / dummy":    cliente usato per i blocchi OFF / PAUSA del gestionale
-    booking_dummy = session.query(Client).filter_by(cliente_nome="BOOKING", cliente_cognome="ONLINE").first()
-    real_dummy = session.query(Client).filter(
-        func.lower(Client.cliente_nome) == "dummy",
-        func.lower(Client.cliente_cognome) == "dummy"
-    ).first()
-    excluded_client_ids = [c.id for c in (booking_dummy, real_dummy) if c]
-
-    # Servizio "dummy": usato dai blocchi OFF/PAUSA. Gli appuntamenti che lo usano
-    # NON devono mai generare un memo, anche se la nota non contiene "OFF"
-    # (es. i blocchi "PAUSA" hanno nota 'PAUSA' e sfuggivano al filtro note).
-    dummy_service_ids = [
-        row[0] for row in session.query(Service.id).filter(
-            func.lower(Service.servizio_nome) == "dummy"
-        ).all()
-    ]
-
-    # Query semplice sugli appuntamenti del giorno, senza join sui client né filtri su cliente_cellulare
-    q = session.query(Appointment).filter(
-        Appointment.start_time >= start,
-        Appointment.start_time < end,
-        or_(Appointment.note.is_(None), ~Appointment.note.ilike('%OFF%')),
-        Appointment.service_id != 9999,
-        Appointment.is_cancelled_by_client == False,
-        # Idempotenza: escludi gli appuntamenti il cui memo è GIÀ stato inviato oggi.
-        # Così, dopo un riavvio del processo, la coda ricostruita contiene solo i memo
-        # ancora da spedire (nessun doppione, ripresa da dove era rimasta).
-        or_(Appointment.morning_memo_sent_date.is_(None), Appointment.morning_memo_sent_date != today)
+    rows = (
+        session.query(
+            Appointment.id, Appointment.client_id, Appointment.start_time, Appointment._duration,
+            Appointment.morning_memo_sent_date,
+            Client.cliente_nome, Client.cliente_cognome, Client.cliente_cellulare,
+            Service.servizio_nome, Service.servizio_durata,
+        )
+        .outerjoin(Client, Client.id == Appointment.client_id)
+        .outerjoin(Service, Service.id == Appointment.service_id)
+        .filter(
+            Appointment.start_time >= start,
+            Appointment.start_time < end,
+            or_(Appointment.note.is_(None), ~Appointment.note.ilike('%OFF%')),
+            Appointment.service_id != 9999,
+            Appointment.is_cancelled_by_client == False,
+        )
+        .order_by(Appointment.start_time.asc(), Appointment.id.asc())
+        .all()
     )
-    if excluded_client_ids:
-        q = q.filter(Appointment.client_id.notin_(excluded_client_ids))
-    if dummy_service_ids:
-        q = q.filter(Appointment.service_id.notin_(dummy_service_ids))
 
-    q = q.order_by(Appointment.start_time.asc())
-    apps = q.all()
+    # Un solo passaggio su tutti i clienti: blocchi contigui per client_id
+    blocks_by_client = {}   # client_id -> blocco aperto
+    blocks = []
+    for r in rows:
+        nome = (r.cliente_nome or '').strip()
+        cognome = (r.cliente_cognome or '').strip()
+        # Client finti da escludere SEMPRE dai memo automatici:
+        #  - "BOOKING / ONLINE": placeholder delle prenotazioni web
+        #  - "dummy / dummy":    cliente usato per i blocchi OFF / PAUSA del gestionale
+        if (r.cliente_nome == "BOOKING" and r.cliente_cognome == "ONLINE") or \
+                (nome.lower() == "dummy" and cognome.lower() == "dummy"):
+            continue
+        # Servizio "dummy": usato dai blocchi OFF/PAUSA. Gli appuntamenti che lo usano
+        # NON devono mai generare un memo, anche se la nota non contiene "OFF"
+        # (es. i blocchi "PAUSA" hanno nota 'PAUSA' e sfuggivano al filtro note).
+        if (r.servizio_nome or '').strip().lower() == "dummy":
+            continue
+
+        dur_min = int(r._duration or 0) or int(r.servizio_durata or 0) or 30
+        a_end = r.start_time + timedelta(minutes=dur_min)
+        block = blocks_by_client.get(r.client_id)
+        if block is None or r.start_time > block["end"]:
+            block = {"first": r, "end": a_end, "servizi": [], "sent": False}
+            blocks_by_client[r.client_id] = block
+            blocks.append(block)
+        else:
+            block["end"] = max(block["end"], a_end)
+        label = (r.servizio_nome or '').strip()
+        if label:
+            block["servizi"].append(label)
+        # Idempotenza: se il memo di oggi è GIÀ partito per un appuntamento del blocco,
+        # tutto il blocco è coperto (dopo un riavvio la coda riparte senza doppioni).
+        if r.morning_memo_sent_date == today:
+            block["sent"] = True
 
     targets = []
-    last_end_by_client = {}
-
-    for a in apps:
-        c_id = a.client_id
-        # durata in minuti; fallback 0
-        dur_min = int(getattr(a, "_duration", 0) or 0)
-        a_start = a.start_time
-        a_end = a_start + timedelta(minutes=dur_min)
-
-        last_end = last_end_by_client.get(c_id)
-        if last_end and a_start <= last_end:
-            # blocco contiguo per lo stesso cliente: salta (già coperto)
-            last_end_by_client[c_id] = max(last_end, a_end)
+    for block in blocks:
+        if block["sent"]:
             continue
-
-        # Preleva SEMPRE il cellulare dal record Client (client_id)
-        client = session.get(Client, c_id) if c_id else None
-        phone_raw = getattr(client, 'cliente_cellulare', '') if client else ''
+        first = block["first"]
+        c_id = first.client_id
+        phone_raw = first.cliente_cellulare or ''
         phone = _normalize_msisdn(phone_raw)
 
         # Log per debug se il DB contiene valore vuoto/placeholder
@@ -2157,18 +2065,143 @@ def _build_today_targets(session, start_from=None) -> list:
             _wa_dbg(c_id or "?", f"cliente {c_id} ha cliente_cellulare placeholder '000000000' in DB")
 
         targets.append({
-            "appointment_id": a.id,
+            "appointment_id": first.id,
             "client_id": c_id,
-            "phone": phone  # valore normalizzato preso dal DB (può essere '' o '000000000' normalizzato)
+            "phone": phone,  # valore normalizzato preso dal DB (può essere '' o '000000000' normalizzato)
+            "nome": first.cliente_nome,
+            "cognome": first.cliente_cognome,
+            "start_time": first.start_time,
+            "servizi": block["servizi"],
         })
-        last_end_by_client[c_id] = a_end
 
     return targets
 
+def _fine_giornata(now):
+    """Mezzanotte (Europe/Rome) successiva a `now`: oltre, i messaggi del giorno scadono."""
+    return now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+def _invia_wa_riga(app, tenant_id: str, creds: dict, msg: dict, oggi):
+    """Nel pool _WA_SEND_POOL: invia una riga già presa in carico e ne registra l'esito."""
+    SessionFactory = app.config['DB_SESSIONS'][tenant_id]
+    session = SessionFactory()
+    try:
+        ok = False
+        errore = None
+        try:
+            ok = _send_unipile_message(creds, msg["to_phone"], msg["text"])
+        except Exception as e:
+            errore = repr(e)
+        esito = registra_esito(session, msg, ok, errore)
+        if ok and msg["kind"] == 'morning':
+            # Idempotenza anche sull'appuntamento: _build_today_targets lo escluderà.
+            appt = session.get(Appointment, msg["ref_id"])
+            if appt is not None:
+                appt.morning_memo_sent_date = oggi
+        session.commit()
+        _wa_dbg(tenant_id, f"[{msg['kind']}] inviato={ok} esito={esito} id={msg['id']} ref_id={msg['ref_id']} "
+                           f"-> {msg['to_phone']} (tentativo {msg['attempts']})")
+    except Exception as e:
+        session.rollback()
+        print(f"[WA-SEND][{tenant_id}] errore esito id={msg.get('id')}: {repr(e)}")
+    finally:
+        try:
+            session.close()
+        finally:
+            try:
+                SessionFactory.remove()
+            except Exception:
+                pass
+            with _WA_IN_VOLO_LOCK:
+                _WA_IN_VOLO[tenant_id] = _WA_IN_VOLO.get(tenant_id, 1) - 1
+
+def _wa_creds_sender(tenant_id, session):
+    """Credenziali Unipile per il sender, tenute in memoria WA_CREDS_TTL_SECONDS
+    (anche l'assenza): niente query e log a ogni giro per i tenant senza WhatsApp."""
+    now = datetime.now().timestamp()
+    voce = _WA_CREDS.get(tenant_id)
+    if voce is None or now - voce[0] >= WA_CREDS_TTL_SECONDS:
+        voce = _WA_CREDS[tenant_id] = (now, _get_unipile_creds(tenant_id, session=session))
+    return voce[1]
+
+
+def process_wa_send_tick(app, tenant_id: str):
+    """
+    Ogni WA_SEND_POLL_SECONDS: invia i messaggi pronti di wa_outbox (memo mattutino,
+    turni operatori, job di /operator-notifications/trigger) al ritmo dell'account
+    Unipile del tenant (BusinessInfo.whatsapp_rate_per_minute, whatsapp_daily_cap),
+    con jitter tra gli invii. Gli invii veri girano nel pool _WA_SEND_POOL, al più
+    WA_SEND_WORKERS per tenant alla volta: una risposta lenta di Unipile non ferma
+    gli altri. Si ferma appena il rate chiede di aspettare: riprende al giro successivo.
+    A coda vuota il giro è una sola SELECT (ci_sono_pronti): credenziali, rate e
+    presa in carico arrivano solo se c'è qualcosa da inviare.
+    """
+    lock = _WA_SEND_LOCKS.get(tenant_id)
+    if lock is None:
+        lock = _WA_SEND_LOCKS.setdefault(tenant_id, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return  # giro precedente ancora in corso per questo tenant
+
+    SessionFactory = app.config['DB_SESSIONS'][tenant_id]
+    session = SessionFactory()
+    try:
+        if not ci_sono_pronti(session):
+            return
+        creds = _wa_creds_sender(tenant_id, session)
+        if not creds:
+            return  # le righe restano 'pending' (e scadono a fine giornata)
+        biz = session.query(BusinessInfo).first()
+        if not biz:
+            return
+        account_id = creds["account_id"]
+        inizio_giornata = _now_rome().replace(hour=0, minute=0, second=0, microsecond=0)
+        for _ in range(WA_SEND_MAX_PER_TICK):
+            with _WA_IN_VOLO_LOCK:
+                if _WA_IN_VOLO.get(tenant_id, 0) >= WA_SEND_WORKERS:
+                    return
+            attesa = riserva_invio(session, account_id,
+                                   getattr(biz, 'whatsapp_rate_per_minute', None) or 10,
+                                   getattr(biz, 'whatsapp_daily_cap', None),
+                                   inizio_giornata)
+            if attesa is None:
+                if _WA_CAP_LOGGATO.get(tenant_id) != inizio_giornata.date():
+                    _WA_CAP_LOGGATO[tenant_id] = inizio_giornata.date()
+                    _wa_dbg(tenant_id, f"tetto giornaliero raggiunto ({biz.whatsapp_daily_cap}): invii rimandati")
+                return
+            if attesa > 0:
+                return
+
+            msg = prendi_prossimo(session)
+            if msg is None:
+                rendi_invio(account_id)
+                return
+
+            with _WA_IN_VOLO_LOCK:
+                _WA_IN_VOLO[tenant_id] = _WA_IN_VOLO.get(tenant_id, 0) + 1
+            try:
+                _WA_SEND_POOL.submit(_invia_wa_riga, app, tenant_id, creds, msg, inizio_giornata.date())
+            except Exception:
+                with _WA_IN_VOLO_LOCK:
+                    _WA_IN_VOLO[tenant_id] -= 1
+                raise  # la riga resta 'sending' e torna disponibile dopo BLOCCO_SCADUTO_SECONDI
+    except Exception as e:
+        session.rollback()
+        print(f"[WA-SEND][{tenant_id}] error: {repr(e)}")
+        raise
+    finally:
+        try:
+            session.close()
+        finally:
+            try:
+                SessionFactory.remove()
+            except Exception:
+                pass
+            lock.release()
+
 def process_morning_tick(app, tenant_id: str):
     """
-    Ogni 60s: al minuto del reminder costruisce la coda del giorno.
-    Poi invia 1 messaggio al minuto finché la coda non è vuota.
+    Ogni 60s: dall'ora del reminder costruisce la coda del giorno in wa_outbox
+    (testi già renderizzati, una riga per blocco di appuntamenti del cliente, idempotente).
+    L'invio lo fa process_wa_send_tick, al ritmo dell'account.
     """
     lock = _MORNING_LOCKS.get(tenant_id)
     if lock is None:
@@ -2182,7 +2215,6 @@ def process_morning_tick(app, tenant_id: str):
             biz = session.query(BusinessInfo).first()
             if not biz or not getattr(biz, 'whatsapp_morning_reminder_enabled', False):
                 _wa_dbg(tenant_id, "disabilitato o BusinessInfo assente")
-                _MORNING_STATE.pop(tenant_id, None)
                 return
 
             reminder_time = getattr(biz, 'whatsapp_morning_reminder_time', time(8, 0))
@@ -2192,13 +2224,7 @@ def process_morning_tick(app, tenant_id: str):
                 return
 
             now = _now_rome()
-            now_time = now.time()
-            if getattr(now_time, 'tzinfo', None) is not None:
-                now_time = now_time.replace(tzinfo=None)
-
             today = now.date()
-            st = _MORNING_STATE.get(tenant_id)
-            has_active_queue = bool(st and st.get("date") == today and st.get("idx", 0) < len(st.get("queue", [])))
 
             # --- Catch-up window: NON dipende dal minuto esatto ----------------------
             # Costruisce la coda se è ORA o è GIÀ PASSATA l'ora del reminder (entro una
@@ -2213,88 +2239,32 @@ def process_morning_tick(app, tenant_id: str):
             # appena lo scheduler lo raggiunge, qualunque sia il NUMERO di tenant (scala).
             reminder_dt = now.replace(hour=reminder_time.hour, minute=reminder_time.minute, second=0, microsecond=0)
             within_window = reminder_dt <= now <= reminder_dt + timedelta(minutes=MORNING_CATCHUP_MINUTES)
-            already_done_today = (_MORNING_DONE.get(tenant_id) == today)
 
-            if within_window and not already_done_today and not has_active_queue:
+            if within_window and _MORNING_DONE.get(tenant_id) != today:
                 queue = _build_today_targets(session, start_from=None)
-                # Marca SUBITO il giorno come avviato: evita di ricostruire la coda a ogni
-                # tick (ottimizzazione in memoria; la correttezza è garantita dal marcatore
-                # su DB morning_memo_sent_date, che sopravvive ai riavvii).
-                _MORNING_DONE[tenant_id] = today
-                if not queue:
-                    _wa_dbg(tenant_id, "coda vuota per oggi (nessun appuntamento da avvisare o già inviati)")
-                    return
-                _MORNING_STATE[tenant_id] = {
-                    "date": today,
-                    "queue": queue,
-                    "idx": 0,
-                    "last_sent_minute": None
-                }
-                st = _MORNING_STATE[tenant_id]
-                has_active_queue = True
-                _wa_dbg(tenant_id, f"coda costruita: {len(queue)} target")
-
-            # Niente coda attiva da processare -> esci
-            if not has_active_queue:
-                _wa_dbg(tenant_id, f"skip: niente da inviare. ora={now_time.strftime('%H:%M')} done_oggi={already_done_today}")
-                return
-
-            # Se non c'è più nulla da inviare, reset
-            if not st or st.get("idx", 0) >= len(st.get("queue", [])):
-                _wa_dbg(tenant_id, "nessun messaggio da inviare")
-                _MORNING_STATE.pop(tenant_id, None)
-                return
-
-            # 1 invio per minuto (ancorato al minuto intero)
-            current_slot = now.replace(second=0, microsecond=0)
-            last_slot = st.get("last_sent_minute")
-            can_send = (last_slot is None) or (current_slot > last_slot)
-
-            _wa_dbg(tenant_id, f"tick: idx={st['idx']}/{len(st['queue'])}, last_slot={last_slot}, current_slot={current_slot}, can_send={can_send}")
-
-            if can_send:
-                item = st["queue"][st["idx"]]
-                st["idx"] += 1  # avanza sempre, anche su errore
-
-                try:
-                    text_to_send = _render_morning_text(session, msg_text, item)
-                except Exception as e:
-                    _wa_dbg(tenant_id, f"render error appt_id={item.get('appointment_id')}: {repr(e)}")
-                    text_to_send = msg_text or ""
-
-                creds = _get_unipile_creds(tenant_id, session=session)
-                ok = False
-                if creds:
+                messaggi = []
+                for item in queue:
                     try:
-                        ok = _send_unipile_message(creds, item["phone"], text_to_send)
+                        text = _render_morning_text(msg_text, item, business_info=biz)
                     except Exception as e:
-                        _wa_dbg(tenant_id, f"send raised exception appt_id={item.get('appointment_id')}: {repr(e)}")
-                        ok = False
-                else:
-                    _wa_dbg(tenant_id, "credenziali mancanti")
-
-                _wa_dbg(tenant_id, f"inviato={ok} appt_id={item['appointment_id']} -> {item['phone']}")
-                if ok:
-                    # Idempotenza su DB: segna che il memo di oggi per questo appuntamento
-                    # è partito. _build_today_targets lo escluderà -> dopo un riavvio la
-                    # coda riprende senza rimandare i memo già spediti. Il commit avviene
-                    # in fondo a questo tick.
-                    try:
-                        appt = session.get(Appointment, item["appointment_id"])
-                        if appt is not None:
-                            appt.morning_memo_sent_date = today
-                    except Exception as e:
-                        _wa_dbg(tenant_id, f"marca memo_sent fallita appt_id={item.get('appointment_id')}: {repr(e)}")
-                st["last_sent_minute"] = current_slot  # blocca ulteriori invii in questo minuto
-
-            # Fine coda -> reset
-            if st.get("idx", 0) >= len(st.get("queue", [])):
-                _wa_dbg(tenant_id, "tutti i messaggi inviati: reset")
-                _MORNING_STATE.pop(tenant_id, None)
+                        _wa_dbg(tenant_id, f"render error appt_id={item.get('appointment_id')}: {repr(e)}")
+                        text = msg_text or ""
+                    messaggi.append({
+                        "dedupe_key": f"morning:{today.isoformat()}:{item['appointment_id']}",
+                        "ref_id": item["appointment_id"],
+                        "to_phone": item["phone"],
+                        "text": text,
+                    })
+                # dedupe_key unica: se un altro worker/istanza ha già accodato, qui non entra nulla
+                nuovi = accoda_whatsapp(session, 'morning', messaggi, expires_at=_fine_giornata(now))
+                pulisci_wa_outbox(session)
+                session.commit()
+                # Marca il giorno come avviato solo DOPO l'accodamento su DB: evita di
+                # ricostruire la coda a ogni tick (la correttezza è sulla dedupe_key).
+                _MORNING_DONE[tenant_id] = today
+                _wa_dbg(tenant_id, f"coda costruita: {len(queue)} target, {nuovi} nuovi in wa_outbox")
             else:
-                _MORNING_STATE[tenant_id] = st
-
-            session.commit()
+                _wa_dbg(tenant_id, f"skip: coda già costruita oggi o fuori finestra. ora={now.strftime('%H:%M')}")
         except Exception as e:
             session.rollback()
             print(f"[WA-MORNING][{tenant_id}] error: {repr(e)}")
@@ -2327,9 +2297,17 @@ def _fmt_data_italiana(dt):
     mesi = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno", "Luglio", "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
     return f"{giorni[dt.weekday()]} {dt.day} {mesi[dt.month - 1]}"
 
-def _build_operator_targets_for_tomorrow(session, require_phone: bool = True):  # AGGIUNTO: parametro session
+def _build_operator_targets_for_tomorrow(session, require_phone: bool = True):
+    """
+    Target dei messaggi turni di DOMANI, uno per operatore con turno (non giorno libero).
+    Query a insiemi, indipendenti dal numero di operatori: operatori, turni di domani,
+    appuntamenti di domani (predicato di intervallo su start_time, usa l'indice) con
+    cliente e servizio in join; il raggruppamento per operatore avviene in memoria.
+    """
     tomorrow = datetime.now().date() + timedelta(days=1)
-    
+    start = datetime.combine(tomorrow, time.min)
+    end = datetime.combine(tomorrow + timedelta(days=1), time.min)
+
     # Query operators who are active, visible, not machines, and opted for WhatsApp notifications
     operators = session.query(Operator).filter(
         Operator.is_deleted == False,
@@ -2337,106 +2315,112 @@ def _build_operator_targets_for_tomorrow(session, require_phone: bool = True):
         Operator.user_tipo != 'macchinario',
         Operator.notify_turni_via_whatsapp == True
     ).all()
-    
+    if not operators:
+        return []
+    op_ids = [op.id for op in operators]
+
+    # Turno di domani per operatore (il primo, come prima con .first())
+    shift_by_op = {}
+    for shift in session.query(OperatorShift).filter(
+        OperatorShift.operator_id.in_(op_ids),
+        OperatorShift.shift_date == tomorrow
+    ).order_by(OperatorShift.id.asc()).all():
+        shift_by_op.setdefault(shift.operator_id, shift)
+
+    # Appuntamenti di domani di tutti gli operatori, esclusi gli annullati
+    appts_by_op = {}
+    for row in session.query(
+        Appointment.operator_id, Appointment.start_time, Appointment._duration, Appointment.note,
+        Client.id.label('client_id'), Client.cliente_nome, Client.cliente_cognome,
+        Service.id.label('service_id'), Service.servizio_nome, Service.servizio_tag,
+    ).outerjoin(Client, Client.id == Appointment.client_id
+    ).outerjoin(Service, Service.id == Appointment.service_id
+    ).filter(
+        Appointment.operator_id.in_(op_ids),
+        Appointment.is_cancelled_by_client == False,
+        Appointment.start_time >= start,
+        Appointment.start_time < end,
+    ).order_by(Appointment.start_time.asc(), Appointment.id.asc()).all():
+        appts_by_op.setdefault(row.operator_id, []).append(row)
+
     targets = []
     for op in operators:
         phone = _normalize_for_unipile(op.user_cellulare)
         if require_phone and (not phone or len(phone) < 4):
             continue
-        
-        # Fetch the shift for tomorrow
-        shift = session.query(OperatorShift).filter(
-            OperatorShift.operator_id == op.id,
-            OperatorShift.shift_date == tomorrow
-        ).first()
-        
+
+        shift = shift_by_op.get(op.id)
         if not shift:
             continue  # Skip operators with no shift for tomorrow
 
         if shift.shift_start_time == shift.shift_end_time:
             continue  # Skip day off
-        
-        # Fetch appointments for tomorrow, excluding cancelled ones
-        appointments = session.query(Appointment).filter(
-            Appointment.operator_id == op.id,
-            Appointment.is_cancelled_by_client == False,
-            func.date(Appointment.start_time) == tomorrow
-        ).order_by(Appointment.start_time.asc()).all()
-        
+
         schedule_items = []
         first_app_label = None
         first_app_time = None
         pausa_label = None
         pausa_time = None
-        
-        for appt in appointments:
+
+        for appt in appts_by_op.get(op.id, []):
             # Filter out appointments outside the shift time
-            if shift:
-                shift_start = shift.shift_start_time
-                shift_end = shift.shift_end_time
-                appt_time = appt.start_time.time()
-                if appt_time < shift_start or appt_time >= shift_end:
-                    continue
-            
+            appt_time = appt.start_time.time()
+            if appt_time < shift.shift_start_time or appt_time >= shift.shift_end_time:
+                continue
+
             # Determine if it's an OFF slot
-            client = appt.client
-            service = session.get(Service, appt.service_id) if appt.service_id else None
-            
             client_is_dummy = (
-                client is None or
-                (client.cliente_nome or '').strip().lower() == 'dummy' and
-                (client.cliente_cognome or '').strip().lower() == 'dummy'
+                appt.client_id is None or
+                (appt.cliente_nome or '').strip().lower() == 'dummy' and
+                (appt.cliente_cognome or '').strip().lower() == 'dummy'
             )
-            
+
             service_is_dummy = (
-                service is None or
-                (getattr(service, 'servizio_nome', '') or '').strip().lower() == 'dummy' or
-                (getattr(service, 'servizio_tag', '') or '').strip().lower() == 'dummy'
+                appt.service_id is None or
+                (appt.servizio_nome or '').strip().lower() == 'dummy' or
+                (appt.servizio_tag or '').strip().lower() == 'dummy'
             )
-            
+
             is_off = client_is_dummy or service_is_dummy
-            
+
             if is_off:
                 titolo = (appt.note or '').strip()
                 label = titolo if titolo else 'OFF'
-                duration = appt.duration if isinstance(appt.duration, int) else None
+                duration = appt._duration if isinstance(appt._duration, int) else None
                 if label.upper() == 'PAUSA':
                     pausa_label = label
                     pausa_time = appt.start_time.strftime('%H:%M')
             else:
                 # Prefer name over tag for service label
-                if service:
-                    label = (getattr(service, 'servizio_nome', '') or '').strip() or (getattr(service, 'servizio_tag', '') or '').strip()
-                else:
-                    label = ''
+                label = (appt.servizio_nome or '').strip() or (appt.servizio_tag or '').strip()
                 duration = None
-            
+
             # Set first appointment if not set and not off
             if first_app_label is None and not is_off:
                 first_app_label = label or ''
                 first_app_time = appt.start_time.strftime('%H:%M')
-            
+
             schedule_items.append({
                 "ora": appt.start_time.strftime('%H:%M'),
                 "label": label,
                 "is_off": is_off,
                 "durata": duration
             })
-        
+
         targets.append({
             "operator_id": op.id,
             "operatore_nome": (op.user_nome or "").strip(),  # First name only
             "phone": phone,
             "date": str(tomorrow),
-            "shift_start": shift.shift_start_time.strftime('%H:%M') if shift else None,
-            "shift_end": shift.shift_end_time.strftime('%H:%M') if shift else None,
+            "shift_start": shift.shift_start_time.strftime('%H:%M'),
+            "shift_end": shift.shift_end_time.strftime('%H:%M'),
             "schedule": schedule_items,
             "primo_app_label": first_app_label,
             "primo_app_time": first_app_time,
             "pausa_label": pausa_label,
             "pausa_time": pausa_time,
         })
-    
+
     return targets
 
 def _render_operator_msg(tpl: str, target: dict, business_info=None):
@@ -2520,8 +2504,9 @@ def preview_route(tenant_id):
     
 def process_operator_tick(app, tenant_id: str):
     """
-    Ogni 60s: al minuto del reminder costruisce la coda degli operatori per DOMANI.
-    Poi invia 1 messaggio al minuto finché la coda non è vuota.
+    Ogni 60s: dall'ora del reminder costruisce in wa_outbox la coda degli operatori
+    per DOMANI (una riga per operatore, idempotente).
+    L'invio lo fa process_wa_send_tick, al ritmo dell'account.
     Logica multi-tenant allineata a process_morning_tick.
     """
     lock = _OP_LOCKS.get(tenant_id)
@@ -2536,7 +2521,6 @@ def process_operator_tick(app, tenant_id: str):
             biz = session.query(BusinessInfo).first()
             if not biz or not getattr(biz, 'operator_whatsapp_notification_enabled', False):
                 _op_dbg(tenant_id, "disabilitato o BusinessInfo assente")
-                _OP_STATE_MAP.pop(tenant_id, None)
                 return
 
             reminder_time = getattr(biz, 'operator_whatsapp_notification_time', time(20, 0))
@@ -2546,85 +2530,37 @@ def process_operator_tick(app, tenant_id: str):
                 return
 
             now = _now_rome()
-            now_time = now.time()
-            if getattr(now_time, 'tzinfo', None) is not None:
-                now_time = now_time.replace(tzinfo=None)
-
             today = now.date()
-            st = _OP_STATE_MAP.get(tenant_id)
-            has_active_queue = bool(st and st.get("date") == today and st.get("idx", 0) < len(st.get("queue", [])))
 
             # Catch-up window: stessa logica di process_morning_tick. Costruisce la coda se
             # è ORA o è GIÀ PASSATA l'ora del reminder (entro la finestra) e oggi non è
             # ancora stata avviata. NON dipende dal minuto esatto -> con più tenant nessuno
-            # viene saltato. Qui lo stato è SOLO in memoria (niente colonna DB): un
-            # eventuale doppio invio dopo un riavvio è raro e poco grave per gli operatori.
+            # viene saltato. La dedupe_key su wa_outbox (operatore + giorno del turno)
+            # evita i doppi invii dopo un riavvio o con più worker.
             reminder_dt = now.replace(hour=reminder_time.hour, minute=reminder_time.minute, second=0, microsecond=0)
             within_window = reminder_dt <= now <= reminder_dt + timedelta(minutes=MORNING_CATCHUP_MINUTES)
-            already_done_today = (_OP_DONE.get(tenant_id) == today)
 
-            if within_window and not already_done_today and not has_active_queue:
+            if within_window and _OP_DONE.get(tenant_id) != today:
                 queue = _build_operator_targets_for_tomorrow(session, require_phone=True)
-                _OP_DONE[tenant_id] = today
-                if not queue:
-                    _op_dbg(tenant_id, "coda vuota per domani")
-                    return
-                _OP_STATE_MAP[tenant_id] = {
-                    "date": today,
-                    "queue": queue,
-                    "idx": 0,
-                    "last_sent_minute": None
-                }
-                st = _OP_STATE_MAP[tenant_id]
-                has_active_queue = True
-                _op_dbg(tenant_id, f"coda operatori costruita: {len(queue)} target")
-
-            if not has_active_queue:
-                _op_dbg(tenant_id, f"skip: niente da inviare. ora={now_time.strftime('%H:%M')} done_oggi={already_done_today}")
-                return
-
-            if not st or st.get("idx", 0) >= len(st.get("queue", [])):
-                _op_dbg(tenant_id, "nessun messaggio da inviare")
-                _OP_STATE_MAP.pop(tenant_id, None)
-                return
-
-            current_slot = now.replace(second=0, microsecond=0)
-            last_slot = st.get("last_sent_minute")
-            can_send = (last_slot is None) or (current_slot > last_slot)
-
-            _op_dbg(tenant_id, f"tick: idx={st['idx']}/{len(st['queue'])}, last_slot={last_slot}, current_slot={current_slot}, can_send={can_send}")
-
-            if can_send:
-                item = st["queue"][st["idx"]]
-                st["idx"] += 1
-
-                try:
-                    text_to_send = _render_operator_msg(msg_text, item, business_info=biz)
-                except Exception as e:
-                    _op_dbg(tenant_id, f"render error operator_id={item.get('operator_id')}: {repr(e)}")
-                    text_to_send = msg_text or ""
-
-                creds = _get_unipile_creds(tenant_id, session=session)
-                ok = False
-                if creds:
+                messaggi = []
+                for item in queue:
                     try:
-                        ok = _send_unipile_message(creds, item["phone"], text_to_send)
+                        text = _render_operator_msg(msg_text, item, business_info=biz)
                     except Exception as e:
-                        _op_dbg(tenant_id, f"send error: {repr(e)}")
-                        ok = False
-                else:
-                    _op_dbg(tenant_id, "credenziali mancanti")
-
-                _op_dbg(tenant_id, f"inviato={ok} operator_id={item['operator_id']} -> {item['phone']}")
-                st["last_sent_minute"] = current_slot
-
-            if st.get("idx", 0) >= len(st.get("queue", [])):
-                _op_dbg(tenant_id, "tutti i messaggi operatori inviati: reset")
-                _OP_STATE_MAP.pop(tenant_id, None)
+                        _op_dbg(tenant_id, f"render error operator_id={item.get('operator_id')}: {repr(e)}")
+                        text = msg_text or ""
+                    messaggi.append({
+                        "dedupe_key": f"operator:{item['date']}:{item['operator_id']}",
+                        "ref_id": item["operator_id"],
+                        "to_phone": item["phone"],
+                        "text": text,
+                    })
+                nuovi = accoda_whatsapp(session, 'operator', messaggi, expires_at=_fine_giornata(now))
+                session.commit()
+                _OP_DONE[tenant_id] = today
+                _op_dbg(tenant_id, f"coda operatori costruita: {len(queue)} target, {nuovi} nuovi in wa_outbox")
             else:
-                _OP_STATE_MAP[tenant_id] = st
-
-            session.commit()
+                _op_dbg(tenant_id, f"skip: coda già costruita oggi o fuori finestra. ora={now.strftime('%H:%M')}")
         except Exception as e:
             session.rollback()
             print(f"[WA-OP][{tenant_id}] error: {repr(e)}")
@@ -2642,7 +2578,8 @@ def process_operator_tick(app, tenant_id: str):
 def operator_notifications_tick(tenant_id):
     """
     Endpoint da richiamare ogni minuto (Logic App/Function/WebJob).
-    Costruisce la coda degli operatori (domani) al minuto configurato e invia 1 messaggio/minuto.
+    Costruisce la coda degli operatori (domani) dall'ora configurata; gli invii li fa
+    il sender di wa_outbox (process_wa_send_tick) al ritmo dell'account.
     """
     try:
         process_operator_tick(current_app, tenant_id)
@@ -2652,58 +2589,99 @@ def operator_notifications_tick(tenant_id):
         print(f"[WA-OP][{tenant_id}] Traceback: {traceback.format_exc()}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+def _chiave_job_operatori(job_id: str) -> str:
+    return f"operator-job:{job_id}:"
+
 @booking_bp.route('/operator-notifications/trigger', methods=['POST'])
 def operator_notifications_trigger(tenant_id):
     """
-    Invio immediato (forzato) di tutti i messaggi operatori per domani.
-    Non rispetta il rate di 1/minuto. Utile per test.
+    Invio immediato (forzato) di tutti i messaggi operatori per domani, come job:
+    accoda i messaggi in wa_outbox e risponde subito con il job_id. Li invia il
+    sender di wa_outbox (in parallelo, nei limiti di ritmo dell'account); lo stato
+    si legge da GET /operator-notifications/jobs/<job_id>. Utile per test.
     """
+    session = g.db_session
     try:
-        SessionFactory = current_app.config['DB_SESSIONS'][tenant_id]
-        session = SessionFactory()
         biz = session.query(BusinessInfo).first()
         if not biz:
             return jsonify({"success": False, "error": "BusinessInfo assente"}), 400
+        if not _get_unipile_creds(tenant_id, session=session):
+            return jsonify({"success": False, "error": "credenziali mancanti"}), 400
 
         tpl = getattr(biz, 'operator_whatsapp_message_template', None) or \
             "Ciao {{operatore}},\n\nDomani {{data}} il tuo turno sarà: {{ora_inizio}} - {{ora_fine}}\n\n{{sezione_pausa}}\n\nIl primo impegno della giornata sarà alle {{ora_primo_app}} e sarà {{primo_app}}\n\nBuon lavoro :)"
         queue = _build_operator_targets_for_tomorrow(session, require_phone=True)
-        creds = _get_unipile_creds(tenant_id, session=session)
+        if not queue:
+            # nessun operatore con turno e numero per domani: niente job da seguire
+            return jsonify({"success": True, "job_id": None, "total": 0, "done": True}), 200
 
-        sent = 0
-        results = []
+        job_id = uuid.uuid4().hex[:16]
+        messaggi = []
         for item in queue:
             try:
                 text = _render_operator_msg(tpl, item, business_info=biz)
             except Exception as e:
                 print(f"[WA-OP][{tenant_id}] render error operator_id={item.get('operator_id')}: {repr(e)}")
                 text = tpl or ""
-            ok = False
-            if creds:
-                try:
-                    ok = _send_unipile_message(creds, item["phone"], text)
-                except Exception as e:
-                    ok = False
-                    print(f"[WA-OP][{tenant_id}] send error operator_id={item.get('operator_id')}: {repr(e)}")
-                    results.append({"operator_id": item["operator_id"], "ok": False, "error": str(e)})
-                    continue
-            else:
-                results.append({"operator_id": item["operator_id"], "ok": False, "error": "credenziali mancanti"})
-                continue
-            if ok:
-                sent += 1
-            results.append({"operator_id": item["operator_id"], "ok": ok})
-
-        try:
-            session.close()
-        finally:
-            try:
-                SessionFactory.remove()
-            except Exception:
-                pass
+            messaggi.append({
+                "dedupe_key": _chiave_job_operatori(job_id) + str(item["operator_id"]),
+                "ref_id": item["operator_id"],
+                "to_phone": item["phone"],
+                "text": text,
+            })
+        accoda_whatsapp(session, 'operator', messaggi, expires_at=_fine_giornata(_now_rome()))
+        print(f"[WA-OP][{tenant_id}] job {job_id}: {len(messaggi)} messaggi accodati")
 
-        return jsonify({"success": True, "sent": sent, "total": len(queue), "results": results}), 200
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "total": len(messaggi),
+            "done": False,
+            "status_url": url_for('booking.operator_notifications_job', tenant_id=tenant_id, job_id=job_id),
+        }), 202
     except Exception as e:
+        session.rollback()
         print(f"[WA-OP][{tenant_id}] ERROR operator_notifications_trigger: {repr(e)}")
         print(f"[WA-OP][{tenant_id}] Traceback: {traceback.format_exc()}")
-        return jsonify({"success": False, "error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@booking_bp.route('/operator-notifications/jobs/<job_id>', methods=['GET'])
+def operator_notifications_job(tenant_id, job_id):
+    """Avanzamento di un job di /operator-notifications/trigger, con l'esito per operatore."""
+    session = g.db_session
+    try:
+        righe = session.query(WaOutbox).filter(
+            WaOutbox.dedupe_key.startswith(_chiave_job_operatori(job_id), autoescape=True)
+        ).order_by(WaOutbox.id.asc()).all()
+        if not righe:
+            return jsonify({"success": False, "error": "job non trovato"}), 404
+
+        nomi = dict(session.query(Operator.id, Operator.user_nome).filter(
+            Operator.id.in_([r.ref_id for r in righe])).all())
+        conteggi = {}
+        results = []
+        for r in righe:
+            conteggi[r.status] = conteggi.get(r.status, 0) + 1
+            results.append({
+                "operator_id": r.ref_id,
+                "operatore": (nomi.get(r.ref_id) or "").strip(),
+                "status": r.status,
+                "ok": r.status == 'sent',
+                "attempts": r.attempts,
+                "sent_at": r.sent_at.isoformat() if r.sent_at else None,
+                "error": r.last_error,
+            })
+        in_corso = conteggi.get('pending', 0) + conteggi.get('sending', 0)
+        return jsonify({
+            "success": True,
+            "job_id": job_id,
+            "done": in_corso == 0,
+            "total": len(righe),
+            "sent": conteggi.get('sent', 0),
+            "in_progress": in_corso,
+            "failed": conteggi.get('failed', 0) + conteggi.get('expired', 0),
+            "results": results,
+        }), 200
+    except Exception as e:
+        print(f"[WA-OP][{tenant_id}] ERROR operator_notifications_job: {repr(e)}")
+        return jsonify({"success": False, "error": str(e)}), 500